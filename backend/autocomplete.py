@@ -0,0 +1,328 @@
+"""In-memory prefix index of artist, album and title values for /api/autocomplete.
+
+Each field keeps its distinct values with track counts, and a sorted array of search
+keys (the normalized value, plus the value without a leading article) searched with
+bisect. A prefix matches a contiguous range of keys; a max segment tree over the keys'
+counts yields the top-K of any range in O(K log n), however many values it covers.
+
+Values first seen since the last rebuild sit in a small sorted pending list that is
+scanned directly, and count changes are applied to the tree in place, so refreshing
+after a scan only reads the rows that changed.
+"""
+import sys
+import time
+import heapq
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func
+from database import Database
+from models import MusicFileDB
+from normalization import normalize_text, strip_article, prefix_range
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("artist", "album", "title")
+
+# keys are cut to this many characters, which bounds the memory used per value
+MAX_KEY_LENGTH = 48
+
+# values added since the last rebuild before the arrays and tree are rebuilt
+MAX_PENDING = 2000
+
+# a refresh touching more than this fraction of the library rebuilds instead
+REBUILD_FRACTION = 0.2
+
+def search_keys(key: str) -> List[str]:
+    key = key[:MAX_KEY_LENGTH]
+    stripped = strip_article(key)
+    return [key, stripped] if stripped != key else [key]
+
+
+class FieldIndex:
+    """Completions for one field."""
+
+    def __init__(self):
+        self.values: List[str] = []
+        self.counts = array("q")
+        self.ids: Dict[str, int] = {}
+        self.keys: List[str] = []
+        self.key_values = array("q")
+        self.tree = array("q")
+        self.size = 0
+        self.indexed = 0
+        self.pending: List[Tuple[str, int]] = []
+
+    def value_id(self, value: Optional[str]) -> int:
+        """The id of a value, added with a count of zero if it is new; -1 for no value."""
+        key = normalize_text(value)
+        if not key:
+            return -1
+
+        value_id = self.ids.get(key)
+        if value_id is None:
+            value_id = self.ids[key] = len(self.values)
+            self.values.append(value)
+            self.counts.append(0)
+        return value_id
+
+    def rebuild(self):
+        entries = sorted((search_key, value_id) for key, value_id in self.ids.items() for search_key in search_keys(key))
+        self.keys = [key for key, _ in entries]
+        self.key_values = array("q", (value_id for _, value_id in entries))
+        self.indexed = len(self.values)
+        self.pending = []
+
+        self.size = 1
+        while self.size < len(self.keys):
+            self.size *= 2
+        self.tree = array("q", [-1]) * (2 * self.size)
+        self.tree[self.size:self.size + len(self.keys)] = array("q", range(len(self.keys)))
+        for node in range(self.size - 1, 0, -1):
+            self.tree[node] = self._better(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def sync(self, changed_values):
+        """Bring the tree up to date after counts changed and values were added."""
+        if len(self.values) - self.indexed > MAX_PENDING:
+            self.rebuild()
+            return
+
+        self.pending = sorted(
+            (search_key, value_id)
+            for value_id in range(self.indexed, len(self.values))
+            for search_key in search_keys(normalize_text(self.values[value_id]))
+        )
+        for value_id in changed_values:
+            if value_id < self.indexed:
+                self._update(value_id)
+
+    def complete(self, prefix: str, limit: int) -> List[Tuple[str, int]]:
+        prefix = prefix[:MAX_KEY_LENGTH]
+        first, last = prefix_range(prefix)
+        lo = bisect_left(self.keys, first)
+        hi = bisect_left(self.keys, last, lo)
+
+        found = {}
+        heap = []
+        self._push(heap, lo, hi)
+        while heap and len(found) < limit:
+            count, position, start, end = heapq.heappop(heap)
+            if count == 0:
+                break
+            value_id = self.key_values[position]
+            found.setdefault(value_id, (count, self.keys[position], value_id))
+            self._push(heap, start, position)
+            self._push(heap, position + 1, end)
+
+        start = bisect_left(self.pending, (first,))
+        end = bisect_left(self.pending, (last,), start)
+        for key, value_id in self.pending[start:end]:
+            if self.counts[value_id] > 0:
+                found.setdefault(value_id, (-self.counts[value_id], key, value_id))
+
+        ranked = sorted(found.items(), key=lambda item: item[1])[:limit]
+        return [(self.values[value_id], self.counts[value_id]) for value_id, _ in ranked]
+
+    def memory_bytes(self) -> int:
+        # keys are often the very string objects held by ids, so count each object once
+        strings = {id(s): s for s in (*self.values, *self.ids, *self.keys)}
+        containers = (self.values, self.counts, self.ids, self.keys, self.key_values, self.tree, self.pending)
+        pending = sum(sys.getsizeof(entry) + sys.getsizeof(entry[0]) for entry in self.pending)
+        return sum(map(sys.getsizeof, strings.values())) + sum(map(sys.getsizeof, containers)) + pending
+
+    def _better(self, a: int, b: int) -> int:
+        # more tracks first, then the earlier key
+        if a < 0:
+            return b
+        if b < 0:
+            return a
+        count_a = self.counts[self.key_values[a]]
+        count_b = self.counts[self.key_values[b]]
+        return a if count_a > count_b or (count_a == count_b and a < b) else b
+
+    def _best(self, lo: int, hi: int) -> int:
+        best = -1
+        lo += self.size
+        hi += self.size
+        while lo < hi:
+            if lo & 1:
+                best = self._better(best, self.tree[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                best = self._better(best, self.tree[hi])
+            lo //= 2
+            hi //= 2
+        return best
+
+    def _push(self, heap: list, lo: int, hi: int):
+        if lo < hi:
+            position = self._best(lo, hi)
+            heapq.heappush(heap, (-self.counts[self.key_values[position]], position, lo, hi))
+
+    def _update(self, value_id: int):
+        for key in search_keys(normalize_text(self.values[value_id])):
+            position = bisect_left(self.keys, key)
+            while self.key_values[position] != value_id:
+                position += 1
+
+            node = (position + self.size) // 2
+            while node:
+                self.tree[node] = self._better(self.tree[2 * node], self.tree[2 * node + 1])
+                node //= 2
+
+
+class CompletionIndex:
+    """Top-K completions over the music files that are not missing."""
+
+    def __init__(self):
+        # guards the index for readers; updates are serialized by update_lock
+        self.lock = threading.Lock()
+        self.update_lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.ready = False
+        self.built_at: Optional[datetime] = None
+        self.refreshed_at: Optional[datetime] = None
+        self.build_seconds = 0.0
+        self.fields = {field: FieldIndex() for field in FIELDS}
+        # value ids per file, to move counts when a file's tags change
+        self.file_ids = array("q")
+        self.file_values = {field: array("q") for field in FIELDS}
+        self.watermark: Optional[datetime] = None
+
+    def build(self):
+        with self.update_lock:
+            self._build()
+
+    def ensure_built(self):
+        if not self.ready:
+            with self.update_lock:
+                if not self.ready:
+                    self._build()
+
+    def refresh(self):
+        """Apply the files scanned since the last build or refresh."""
+        if not self.ready:
+            return
+
+        with self.update_lock:
+            db = Database.get_session()
+            try:
+                rows = self._query(db).filter(MusicFileDB.last_scanned >= self.watermark).all() if self.watermark else []
+                live = db.query(func.count(MusicFileDB.id)).filter(MusicFileDB.missing == False).scalar()
+            finally:
+                db.close()
+
+            if len(rows) > REBUILD_FRACTION * len(self.file_ids):
+                self._build()
+                return
+
+            with self.lock:
+                changed = {field: set() for field in FIELDS}
+                for row in rows:
+                    self._remove_file(row.id, changed)
+                    if not row.missing:
+                        self._add_file(row, changed)
+                    if row.last_scanned and row.last_scanned > self.watermark:
+                        self.watermark = row.last_scanned
+
+                for field, index in self.fields.items():
+                    index.sync(changed[field])
+                self.refreshed_at = datetime.now()
+
+            # rows deleted outright, or missing files found again, leave no trace to refresh from
+            if live != len(self.file_ids):
+                self._build()
+
+    def complete(self, prefix: str, limit=10) -> Dict[str, List[Tuple[str, int]]]:
+        key = normalize_text(prefix)
+        if prefix[-1:].isspace() and key:
+            key += " "
+
+        with self.lock:
+            return {field: index.complete(key, limit) for field, index in self.fields.items()}
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "ready": self.ready,
+                "files": len(self.file_ids),
+                "values": {field: len(index.ids) for field, index in self.fields.items()},
+                "keys": sum(len(index.keys) + len(index.pending) for index in self.fields.values()),
+                "pending_keys": sum(len(index.pending) for index in self.fields.values()),
+                "memory_bytes": self._memory_bytes(),
+                "built_at": self.built_at,
+                "refreshed_at": self.refreshed_at,
+                "build_seconds": self.build_seconds,
+            }
+
+    def _query(self, db):
+        return db.query(
+            MusicFileDB.id,
+            MusicFileDB.artist,
+            MusicFileDB.album,
+            MusicFileDB.title,
+            MusicFileDB.missing,
+            MusicFileDB.last_scanned,
+        )
+
+    def _build(self):
+        start_time = time.perf_counter()
+        built = CompletionIndex()
+
+        db = Database.get_session()
+        try:
+            rows = self._query(db).filter(MusicFileDB.missing == False).order_by(MusicFileDB.id).yield_per(5000)
+            for row in rows:
+                built._add_file(row)
+                if row.last_scanned and (built.watermark is None or row.last_scanned > built.watermark):
+                    built.watermark = row.last_scanned
+        finally:
+            db.close()
+
+        for index in built.fields.values():
+            index.rebuild()
+
+        with self.lock:
+            self.fields, self.file_ids, self.file_values = built.fields, built.file_ids, built.file_values
+            self.watermark = built.watermark or datetime.now()
+            self.ready = True
+            self.built_at = self.refreshed_at = datetime.now()
+            self.build_seconds = time.perf_counter() - start_time
+
+        logger.info(f"Built autocomplete index of {len(self.file_ids)} files in {self.build_seconds:.2f}s")
+
+    def _add_file(self, row, changed: Optional[Dict[str, set]] = None):
+        position = bisect_left(self.file_ids, row.id)
+        self.file_ids.insert(position, row.id)
+        for field, index in self.fields.items():
+            value_id = index.value_id(getattr(row, field))
+            self.file_values[field].insert(position, value_id)
+            if value_id >= 0:
+                index.counts[value_id] += 1
+                if changed is not None:
+                    changed[field].add(value_id)
+
+    def _remove_file(self, file_id: int, changed: Dict[str, set]):
+        position = bisect_left(self.file_ids, file_id)
+        if position == len(self.file_ids) or self.file_ids[position] != file_id:
+            return
+
+        del self.file_ids[position]
+        for field, index in self.fields.items():
+            value_id = self.file_values[field].pop(position)
+            if value_id >= 0:
+                index.counts[value_id] -= 1
+                changed[field].add(value_id)
+
+    def _memory_bytes(self) -> int:
+        arrays = [self.file_ids, *self.file_values.values()]
+        return sum(index.memory_bytes() for index in self.fields.values()) + sum(map(sys.getsizeof, arrays))
+
+
+completion_index = CompletionIndex()
@@ -0,0 +1,237 @@
+"""Time the library scanner against a generated library.
+
+    python -m benchmarks.scan_benchmark --files 5000 --workers 4
+
+Builds N tagged MP3/FLAC files in a temp directory and times a full scan, an
+incremental scan with nothing changed, an incremental scan after 1% of the
+library changed, and a prune, against a SQLite database file of its own.
+"""
+import os
+import json
+import time
+import random
+import struct
+import argparse
+import resource
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional
+from mutagen.easyid3 import EasyID3
+from mutagen.flac import FLAC
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from database import Database, enable_wal
+from models import Base
+from migrations import migrate
+from scanner import scan_directory, prune_music_files
+
+GENRES = [
+    ("Rock", 20), ("Pop", 16), ("Electronic", 12), ("Hip-Hop", 10), ("Jazz", 8), ("Classical", 7),
+    ("Metal", 6), ("Folk", 5), ("R&B", 5), ("Indie Rock", 4), ("Ambient", 3), ("Soundtrack", 2),
+]
+WORDS = (
+    "night light love heart fire river dream blue gold city road summer shadow echo "
+    "stone rain wild glass silver ocean ghost paper star time home electric morning"
+).split()
+NAME_ACCENTS = ["Björk", "Sigur Rós", "Mötley", "Beyoncé", "Café", "Zoë", "Ñu", "Ångström"]
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz, no padding: 417 bytes per frame
+MP3_FRAME = b"\xff\xfb\x90\x64" + bytes(413)
+MP3_FRAMES = 8
+
+
+def random_name(rng: random.Random, words=(1, 3)) -> str:
+    name = " ".join(rng.choice(WORDS) for _ in range(rng.randint(*words))).title()
+    if rng.random() < 0.05:
+        name = f"{rng.choice(NAME_ACCENTS)} {name}"
+    return name
+
+
+def write_silent_mp3(path: Path, tags: dict):
+    path.write_bytes(MP3_FRAME * MP3_FRAMES)
+    audio = EasyID3()
+    for key, value in tags.items():
+        audio[key] = value
+    audio.save(path)
+
+
+def write_silent_flac(path: Path, tags: dict):
+    # STREAMINFO only: 4096-sample blocks, 44.1 kHz, stereo, 16 bit, no frames
+    info = struct.pack(">HH", 4096, 4096) + bytes(6)
+    info += ((44100 << 44) | (1 << 41) | (15 << 36)).to_bytes(8, "big") + bytes(16)
+    path.write_bytes(b"fLaC" + bytes([0x80]) + len(info).to_bytes(3, "big") + info)
+
+    audio = FLAC(path)
+    for key, value in tags.items():
+        audio[key] = value
+    audio.save()
+
+
+def write_track(path: Path, tags: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix == ".flac":
+        write_silent_flac(path, tags)
+    else:
+        write_silent_mp3(path, tags)
+
+
+def generate_library(root: Path, files: int, seed=0, flac_ratio=0.3) -> List[Path]:
+    """Write files tracks laid out as Artist/Album/NN - Title.ext.
+
+    A few artists have most of the albums, most tracks have one genre and a few have
+    none or several, and some tags are missing, as in a real collection.
+    """
+    rng = random.Random(seed)
+    artists = [random_name(rng, (1, 2)) for _ in range(max(files // 40, 1))]
+    artist_weights = [1 / (rank + 1) for rank in range(len(artists))]
+    genre_names, genre_weights = zip(*GENRES)
+
+    paths = []
+    while len(paths) < files:
+        artist = rng.choices(artists, artist_weights)[0]
+        album = random_name(rng)
+        year = str(min(int(rng.triangular(1960, 2025, 2015)), 2024))
+        album_genres = rng.choices(genre_names, genre_weights, k=rng.choices([0, 1, 2], [10, 75, 15])[0])
+        extension = ".flac" if rng.random() < flac_ratio else ".mp3"
+
+        for number in range(1, min(rng.randint(8, 14), files - len(paths)) + 1):
+            title = random_name(rng, (1, 4))
+            tags = {"title": title, "artist": artist, "date": year, "tracknumber": str(number)}
+            if rng.random() > 0.03:
+                tags["album"] = album
+                tags["albumartist"] = artist
+            if album_genres:
+                tags["genre"] = list(album_genres)
+
+            path = root / artist / f"{album} ({year})" / f"{number:02d} - {title}{extension}"
+            write_track(path, tags)
+            paths.append(path)
+
+    return paths
+
+
+def change_library(paths: List[Path], fraction=0.01, seed=1) -> int:
+    """Retag a fraction of the tracks and add as many new ones next to them.
+
+    Retagged files are written to a temporary name and renamed over the original, as sync
+    tools do; an edit made in place does not touch the directory mtime, so incremental
+    scans leave it to the next full scan.
+    """
+    rng = random.Random(seed)
+    count = max(int(len(paths) * fraction / 2), 1)
+
+    for path in rng.sample(paths, count):
+        temporary = path.with_name(f".{path.name}.tmp{path.suffix}")
+        write_track(temporary, {"title": f"{path.stem} (Remastered)", "artist": path.parent.parent.name})
+        os.replace(temporary, path)
+
+    for i, path in enumerate(rng.sample(paths, count)):
+        write_track(path.with_name(f"99 - Bonus Track {i}{path.suffix}"), {"title": f"Bonus Track {i}"})
+
+    return count * 2
+
+
+@contextmanager
+def use_database(path: Path):
+    """Point Database at a fresh SQLite file for the duration of the benchmark."""
+    saved = Database._instance, Database._engine, Database._sessionmaker
+
+    engine = create_engine(f"sqlite:///{path}")
+    event.listen(engine, "connect", enable_wal)
+    Base.metadata.create_all(bind=engine)
+    migrate(engine)
+
+    Database._instance = object.__new__(Database)
+    Database._engine = engine
+    Database._sessionmaker = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    try:
+        yield engine
+    finally:
+        Database._instance, Database._engine, Database._sessionmaker = saved
+        engine.dispose()
+
+
+def lifetime_peak_rss_mb() -> float:
+    """Peak RSS of this process plus its largest child so far, which never goes down between phases."""
+    # ru_maxrss is in kilobytes on Linux; children covers the tag-reader pool
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return (own + children) / 1024
+
+
+def measure(engine, name: str, files: int, run) -> dict:
+    queries = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    start = time.perf_counter()
+    try:
+        results = run()
+    finally:
+        seconds = time.perf_counter() - start
+        event.remove(engine, "before_cursor_execute", count)
+
+    return {
+        "phase": name,
+        "seconds": round(seconds, 3),
+        "files_per_second": round(files / seconds, 1) if seconds else None,
+        "queries": len(queries),
+        "lifetime_peak_rss_mb": round(lifetime_peak_rss_mb(), 1),
+        "results": results,
+    }
+
+
+def run_benchmark(files: int, workers: Optional[int] = None, directory: Optional[Path] = None, seed=0) -> List[dict]:
+    with tempfile.TemporaryDirectory(prefix="scan-benchmark-") as temp:
+        root = Path(directory or temp) / "library"
+        paths = generate_library(root, files, seed=seed)
+
+        with use_database(Path(temp) / "benchmark.db") as engine:
+            phases = [
+                measure(engine, "full", files, lambda: scan_directory(str(root), full=True, workers=workers)),
+                measure(engine, "incremental", files, lambda: scan_directory(str(root), workers=workers)),
+            ]
+
+            changed = change_library(paths)
+            # the scan's walk yields the seen paths that the prune takes, as in run_library_scan
+            seen_paths = set()
+            phases.append(measure(
+                engine, "incremental (1% changed)", files + changed // 2,
+                lambda: scan_directory(str(root), workers=workers, seen_paths=seen_paths),
+            ))
+            phases.append(measure(engine, "prune", files + changed // 2, lambda: prune_music_files(seen_paths)))
+
+        return phases
+
+
+def print_report(phases: List[dict]):
+    print(f"{'phase':<26}{'seconds':>10}{'files/s':>12}{'queries':>10}{'max RSS so far MB':>20}")
+    for phase in phases:
+        print(
+            f"{phase['phase']:<26}{phase['seconds']:>10.2f}{phase['files_per_second'] or 0:>12.0f}"
+            f"{phase['queries']:>10}{phase['lifetime_peak_rss_mb']:>20.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scan_directory against a synthetic library")
+    parser.add_argument("--files", type=int, default=2000, help="number of tracks to generate")
+    parser.add_argument("--workers", type=int, default=None, help="tag-reader processes (default: SCAN_WORKERS or CPU count)")
+    parser.add_argument("--directory", type=Path, default=None, help="generate the library here instead of a temp dir")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the raw results as JSON")
+    args = parser.parse_args()
+
+    phases = run_benchmark(args.files, workers=args.workers, directory=args.directory, seed=args.seed)
+    if args.json:
+        print(json.dumps(phases, indent=2, default=str))
+    else:
+        print_report(phases)
+
+
+if __name__ == "__main__":
+    main()
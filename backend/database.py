@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 import os
 import dotenv
@@ -8,6 +8,13 @@ dotenv.load_dotenv(override=True)
 Base = declarative_base()
 
 
+def enable_wal(dbapi_connection, connection_record):
+    # lets readers keep working while a scan holds the write lock
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
+
 class Database:
     _instance = None
     _engine = None
@@ -18,6 +25,8 @@ class Database:
             cls._instance = super(Database, cls).__new__(cls)
             DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:////data/playlists.db")
             cls._engine = create_engine(DATABASE_URL, echo = (os.getenv("LOG_LEVEL", "INFO") == "DEBUG"))
+            if DATABASE_URL.startswith("sqlite"):
+                event.listen(cls._engine, "connect", enable_wal)
             cls._sessionmaker = sessionmaker(
                 autocommit=False, autoflush=False, bind=cls._engine
             )
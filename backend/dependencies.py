@@ -2,6 +2,7 @@ from fastapi import Depends
 from database import Database
 from repositories.music_file import MusicFileRepository
 from repositories.playlist import PlaylistRepository
+from repositories.genre import GenreRepository
 
 
 def get_db():
@@ -18,3 +19,7 @@ def get_music_file_repository(session=Depends(get_db)):
 
 def get_playlist_repository(session=Depends(get_db)):
     return PlaylistRepository(session)
+
+
+def get_genre_repository(session=Depends(get_db)):
+    return GenreRepository(session)
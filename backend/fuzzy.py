@@ -0,0 +1,31 @@
+from typing import List, Optional
+
+
+def trigrams(term: str) -> List[str]:
+    """Trigrams of a term padded the way pg_trgm does, so short terms and word starts count."""
+    padded = f"  {term} "
+    return sorted({padded[i:i + 3] for i in range(len(padded) - 2)})
+
+
+def edit_distance(a: str, b: str, max_distance: Optional[int] = None) -> int:
+    """Levenshtein distance, giving up with max_distance + 1 once it is certainly exceeded."""
+    if max_distance is not None and abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+
+    return previous[-1]
+
+
+def max_typos(term: str) -> int:
+    # one typo per four characters, e.g. "beyonse" -> 1, "radiohed" -> 2
+    return max(1, len(term) // 4)
@@ -2,14 +2,12 @@ import os
 import pathlib
 import logging
 import urllib.parse
-from fastapi import FastAPI, Query, APIRouter, Request, Depends
+from fastapi import FastAPI, Query, APIRouter, Request, Depends, Response
 import uvicorn
-from mutagen.easyid3 import EasyID3
-from mutagen.flac import FLAC
 import dotenv
 from typing import Optional, List, Callable
 import time
-from tqdm import tqdm
+import threading
 from datetime import datetime
 from fastapi.exceptions import HTTPException, RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
@@ -20,16 +18,24 @@ from sqlalchemy.orm import joinedload
 from fastapi.responses import StreamingResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 import io
+from contextlib import asynccontextmanager
 from database import Database
+from migrations import migrate
 from models import *
 import urllib
 import requests_cache
 from response_models import *
-from dependencies import get_music_file_repository, get_playlist_repository
-from repositories.music_file import MusicFileRepository
+from dependencies import get_music_file_repository, get_playlist_repository, get_genre_repository
+from repositories.music_file import MusicFileRepository, library_facets
 from repositories.playlist import PlaylistRepository
+from repositories.genre import GenreRepository
 from repositories.open_ai_repository import open_ai_repository
 from repositories.last_fm_repository import last_fm_repository
+from scan_jobs import scan_job_manager, ScanAlreadyRunning
+from scanner import on_library_changed
+from pagination import InvalidCursor, Page
+from autocomplete import completion_index
+from watcher import create_library_watcher
 from plexapi.server import PlexServer
 from plexapi.playlist import Playlist as PlexPlaylist
 from redis import Redis
@@ -63,7 +69,24 @@ class TimingMiddleware(BaseHTTPMiddleware):
             
         return response
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # startup work lives here rather than at import: spawned scan workers may import this module
+    Base.metadata.create_all(bind=Database.get_engine())
+    migrate(Database.get_engine())
+
+    threading.Thread(target=completion_index.build, name="autocomplete-build", daemon=True).start()
+
+    watcher = create_library_watcher()
+    if watcher:
+        watcher.start()
+
+    yield
+
+    if watcher:
+        watcher.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 requests_cache_session = requests_cache.CachedSession(
     "lastfm_cache", backend="memory", expire_after=3600
@@ -76,6 +99,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor"],
 )
 
 app.add_middleware(TimingMiddleware)
@@ -88,169 +112,80 @@ log_level = os.getenv("LOG_LEVEL", "INFO").upper()
 # Set up logging
 logging.basicConfig(level=log_level)
 
-# Create the database tables
-Base.metadata.create_all(bind=Database.get_engine())
-
-SUPPORTED_FILETYPES = (".mp3", ".flac", ".wav", ".ogg", ".m4a")
-
 redis_session = None
 REDIS_HOST = os.getenv("REDIS_HOST", None)
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 if REDIS_HOST and REDIS_PORT:
     redis_session = Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
 
-def extract_metadata(file_path, extractor):
-    try:
-        audio = extractor(file_path)
-        result = {
-            "title": audio.get("title", [None])[0],
-            "artist": audio.get("artist", [None])[0],
-            "album": audio.get("album", [None])[0],
-            "album_artist": audio.get("albumartist", [None])[0],
-            "year": audio.get("date", [None])[0],
-            "length": int(audio.info.length) if hasattr(audio, "info") else None,
-            "publisher": audio.get("organization", [None])[0],
-            "kind": audio.mime[0] if hasattr(audio, "mime") else None,
-            "genres": audio.get("genre", list()),
-        }
-        return result
-    except Exception as e:
-        logging.error(f"Failed to read metadata for {file_path}: {e}")
+router = APIRouter()
 
-    return {}
 
+@on_library_changed
+def library_changed(results: dict):
+    completion_index.refresh()
+    library_facets.clear()
 
-def scan_directory(directory: str, full=False):
-    directory = pathlib.Path(directory)
-    if not directory.exists():
-        logging.error(f"Directory {directory} does not exist")
-        return []
 
-    logging.info(f"Scanning directory {directory}")
-    start_time = time.time()
-    new_adds = 0
 
-    # Get a list of all files in the directory
-    all_files = [
-        os.path.join(root, file)
-        for root, _, files in os.walk(directory)
-        for file in files
-    ]
+@router.get("/purge")
+def purge_data():
+    engine = Database.get_engine()
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
 
-    db = Database.get_session()
 
-    files_seen = 0
-    files_skipped = 0
-    for full_path in tqdm(all_files, desc="Scanning files"):
-        if not full_path.lower().endswith(SUPPORTED_FILETYPES):
-            continue
+def run_scan_job(full: bool) -> ScanResults:
+    try:
+        job = scan_job_manager.run(full=full)
+    except ScanAlreadyRunning as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
-        files_seen += 1
+    if job.status != "completed":
+        raise HTTPException(status_code=500, detail=job.error or f"Scan {job.status}")
 
-        last_modified_time = datetime.fromtimestamp(os.path.getmtime(full_path))
-        existing_file = (
-            db.query(MusicFileDB).filter(MusicFileDB.path == full_path).first()
-        )
+    return job.results
 
-        found_existing_file = False
-        if existing_file and existing_file.missing:
-            found_existing_file = True
-            existing_file.missing = False
-
-        if (not full) and (not found_existing_file) and existing_file and existing_file.last_scanned >= last_modified_time:
-            files_skipped += 1
-            continue  # Skip files that have not changed
-
-        metadata = {}
-
-        if full_path.lower().endswith(".mp3"):
-            metadata = extract_metadata(full_path, EasyID3)
-        elif full_path.lower().endswith(".flac"):
-            metadata = extract_metadata(full_path, FLAC)
-        else:
-            logging.debug(f"Skipping file {full_path} with unsupported file type")
-            continue
-
-        if not metadata:
-            continue
-
-        # Update or add the file in the database
-        if existing_file:
-            existing_file.last_modified = last_modified_time
-            existing_file.title = metadata.get("title")
-            existing_file.artist = metadata.get("artist")
-            existing_file.album = metadata.get("album")
-            existing_file.album_artist = metadata.get("album_artist")
-            existing_file.year = metadata.get("year")
-            existing_file.length = metadata.get("length")
-            existing_file.publisher = metadata.get("publisher")
-            existing_file.kind = metadata.get("kind")
-            existing_file.last_scanned = datetime.now()
-            existing_file.genres = [
-                TrackGenreDB(parent_type="music_file", genre=genre)
-                for genre in metadata.get("genres", [])
-            ]
-        else:
-            new_adds += 1
-
-            db.add(
-                MusicFileDB(
-                    path=full_path,
-                    title=metadata.get("title"),
-                    artist=metadata.get("artist"),
-                    album=metadata.get("album"),
-                    genres=[
-                        TrackGenreDB(parent_type="music_file", genre=genre)
-                        for genre in metadata.get("genres", [])
-                    ],
-                    album_artist=metadata.get("album_artist"),
-                    year=metadata.get("year"),
-                    length=metadata.get("length"),
-                    publisher=metadata.get("publisher"),
-                    kind=metadata.get("kind"),
-                    last_scanned=datetime.now(),
-                )
-            )
 
-    logging.info(
-        f"Scanned {files_seen} music files ({files_seen - files_skipped} existing, {new_adds} new) in {time.time() - start_time:.2f} seconds"
-    )
+@router.get("/scan", response_model=ScanResults)
+def scan():
+    return run_scan_job(full=False)
 
-    db.commit()
-    db.close()
 
-    return {
-        "files_scanned": files_seen,
-        "files_indexed": files_seen - files_skipped,
-        "new_files_added": new_adds,
-        "files_updated": files_seen - files_skipped - new_adds,
-    }
+@router.get("/fullscan", response_model=ScanResults)
+def full_scan():
+    return run_scan_job(full=True)
 
 
-router = APIRouter()
+@router.post("/scan/jobs", response_model=ScanJobStatus, status_code=202)
+def start_scan_job(full: bool = False):
+    try:
+        return scan_job_manager.start(full=full).to_status()
+    except ScanAlreadyRunning as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
-@router.get("/purge")
-def purge_data():
-    engine = Database.get_engine()
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+@router.get("/scan/jobs", response_model=List[ScanJobStatus])
+def list_scan_jobs():
+    return [job.to_status() for job in scan_job_manager.list()]
 
 
-@router.get("/scan", response_model=ScanResults)
-def scan(repo: PlaylistRepository = Depends(get_playlist_repository), music_files: MusicFileRepository = Depends(get_music_file_repository)):
-    scan_results = scan_directory(os.getenv("MUSIC_PATH", "/music"), full=False)
-    prune_results = prune_music_files()
+@router.get("/scan/jobs/{job_id}", response_model=ScanJobStatus)
+def get_scan_job(job_id: str):
+    job = scan_job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Scan job not found")
 
-    return ScanResults(**scan_results, **prune_results)
+    return job.to_status()
 
 
-@router.get("/fullscan", response_model=ScanResults)
-def full_scan(repo: PlaylistRepository = Depends(get_playlist_repository), music_files: MusicFileRepository = Depends(get_music_file_repository)):
-    scan_results = scan_directory(os.getenv("MUSIC_PATH", "/music"), full=True)
-    prune_results = prune_music_files()
+@router.post("/scan/jobs/{job_id}/cancel", response_model=ScanJobStatus)
+def cancel_scan_job(job_id: str):
+    job = scan_job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Scan job not found")
 
-    return ScanResults(**scan_results, **prune_results)
+    return job.to_status()
 
 def drop_music_files():
     db = Database.get_session()
@@ -262,53 +197,89 @@ def drop_music_files():
     db.close()
 
 
-def prune_music_files():
-    db = Database.get_session()
-    existing_files = db.query(MusicFileDB).all()
-
-    prunes = 0
-    for existing_file in existing_files:
-        if (not existing_file.missing) and not pathlib.Path(existing_file.path).exists():
-            prunes += 1
-            logging.debug(
-                f"Marking nonexistent music file {existing_file.path} as missing"
-            )
-
-            existing_file.last_scanned = datetime.now()
-            existing_file.missing = True
-
-    if prunes:
-        logging.info(f"Pruned {prunes} music files from the database")
-
-    db.commit()
-    db.close()
+def paged(response: Response, get_page: Callable[[], Page]) -> list:
+    """Run a paged query, returning its results with the next page's cursor in the X-Next-Cursor header."""
+    try:
+        page = get_page()
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    return {
-        "files_missing": prunes
-    }
+    if page.next_cursor:
+        response.headers["X-Next-Cursor"] = page.next_cursor
+    return page.results
 
 
 @router.get("/filter", response_model=List[MusicFile])
 def filter_music_files(
+    response: Response,
     title: Optional[str] = None,
     artist: Optional[str] = None,
     album: Optional[str] = None,
     genre: Optional[str] = None,
     limit: int = 50,
+    cursor: Optional[str] = None,
     repo: MusicFileRepository = Depends(get_music_file_repository),
 ):
-    return repo.filter(
-        title=title, artist=artist, album=album, genre=genre, limit=limit
-    )
+    return paged(response, lambda: repo.filter_page(
+        title=title, artist=artist, album=album, genre=genre, limit=limit, cursor=cursor
+    ))
 
 
 @router.get("/search", response_model=List[MusicFile])
 def search_music_files(
+    response: Response,
     query: str = Query(..., min_length=1),
     limit: int = 50,
+    fuzzy: bool = False,
+    cursor: Optional[str] = None,
     repo: MusicFileRepository = Depends(get_music_file_repository),
 ):
-    return repo.search(query=query, limit=limit)
+    return paged(response, lambda: repo.search_page(query=query, limit=limit, fuzzy=fuzzy, cursor=cursor))
+
+
+@router.get("/facets", response_model=FacetResults)
+def facet_music_files(
+    response: Response,
+    title: Optional[str] = None,
+    artist: Optional[str] = None,
+    album: Optional[str] = None,
+    genre: Optional[str] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    top: int = Query(10, ge=1, le=100),
+    repo: MusicFileRepository = Depends(get_music_file_repository),
+):
+    filters = dict(title=title, artist=artist, album=album, genre=genre)
+    results = paged(response, lambda: repo.filter_page(**filters, limit=limit, cursor=cursor))
+
+    facets = repo.facets(**filters, top=top)
+    return FacetResults(
+        results=results,
+        facets={
+            facet: [FacetCount(value=value, count=count, artist=artist) for value, count, artist in counts]
+            for facet, counts in facets.items()
+        },
+    )
+
+
+@router.get("/autocomplete", response_model=Completions)
+def autocomplete(prefix: str = Query(..., min_length=1), limit: int = Query(10, ge=1, le=50)):
+    completion_index.ensure_built()
+    completions = completion_index.complete(prefix, limit)
+    return Completions(**{
+        f"{field}s": [Completion(value=value, count=count) for value, count in values]
+        for field, values in completions.items()
+    })
+
+
+@router.get("/autocomplete/stats", response_model=AutocompleteStats)
+def autocomplete_stats():
+    return completion_index.stats()
+
+
+@router.get("/genres", response_model=List[Genre])
+def list_genres(repo: GenreRepository = Depends(get_genre_repository)):
+    return repo.list_genres()
 
 
 @router.post("/playlists", response_model=Playlist)
@@ -347,6 +318,18 @@ async def get_playlist(
     finally:
         db.close()
 
+@router.get("/playlists/{playlist_id}/entries", response_model=PlaylistEntriesPage)
+def get_playlist_entries(
+    playlist_id: int,
+    after_order: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    repo: PlaylistRepository = Depends(get_playlist_repository),
+):
+    page = repo.get_entries_page(playlist_id, after_order, limit)
+    if not page.entries and after_order is None and repo.get_by_id(playlist_id) is None:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    return page
+
 @router.get("/playlists/{playlist_id}/count")
 async def get_playlist_count(
     playlist_id: int, repo: PlaylistRepository = Depends(get_playlist_repository)
@@ -520,8 +503,12 @@ def sync_playlist_to_plex(playlist_id: int, repo: PlaylistRepository = Depends(g
         raise HTTPException(status_code=500, detail="Failed to sync playlist to Plex")
 
 @router.post("/library/findlocals")
-def find_local_files(tracks: List[TrackDetails], repo: MusicFileRepository = Depends(get_music_file_repository)):
-    return repo.find_local_files(tracks)
+def find_local_files(
+    tracks: List[TrackDetails],
+    tolerance: int = Query(0, ge=0, le=3),
+    repo: MusicFileRepository = Depends(get_music_file_repository),
+):
+    return repo.find_local_files(tracks, tolerance)
 
 @router.get("/lastfm", response_model=LastFMTrack | None)
 def get_lastfm_track(title: str = Query(...), artist: str = Query(...)):
@@ -534,13 +521,17 @@ def get_lastfm_track(title: str = Query(...), artist: str = Query(...)):
 
 # get similar tracks using last.fm API
 @router.get("/lastfm/similar", response_model=List[LastFMTrack])
-def get_similar_tracks(title: str = Query(...), artist: str = Query(...)):
+def get_similar_tracks(
+    title: str = Query(...),
+    artist: str = Query(...),
+    music_files: MusicFileRepository = Depends(get_music_file_repository),
+):
     api_key = os.getenv("LASTFM_API_KEY")
     if not api_key:
         raise HTTPException(status_code=500, detail="Last.FM API key not configured")
 
     repo = last_fm_repository(api_key, requests_cache_session)
-    return repo.get_similar_tracks(artist, title)
+    return music_files.annotate_local_files(repo.get_similar_tracks(artist, title))
 
 @router.get("/lastfm/albumart")
 def get_album_art(artist: str = Query(...), album: str = Query(...)):
@@ -552,15 +543,20 @@ def get_album_art(artist: str = Query(...), album: str = Query(...)):
     return repo.get_album_art(artist, album, redis_session=redis_session)
 
 # get similar tracks
-@router.get("/openai/similar")
-def get_similar_tracks_with_openai(title: str = Query(...), artist: str = Query(...)):
+@router.get("/openai/similar", response_model=SimilarTracks)
+def get_similar_tracks_with_openai(
+    title: str = Query(...),
+    artist: str = Query(...),
+    music_files: MusicFileRepository = Depends(get_music_file_repository),
+):
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
     
     repo = open_ai_repository(api_key)
-
-    return repo.get_similar_tracks(artist, title)
+    similar = SimilarTracks(**repo.get_similar_tracks(artist, title))
+    music_files.annotate_local_files(similar.tracks)
+    return similar
 
 @router.get("/testing/dumpLibrary/{playlistID}")
 def dump_library(playlistID: int, repo: PlaylistRepository = Depends(get_playlist_repository), music_files: MusicFileRepository = Depends(get_music_file_repository)):
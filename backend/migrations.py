@@ -0,0 +1,159 @@
+import logging
+from sqlalchemy import inspect, text, select, insert, delete, update, or_
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
+from models import (
+    Base, TrackGenreDB, GenreDB, MusicFileGenreDB, MusicFileDB, SearchTermDB,
+    genre_key, track_match_keys, create_search_index, ORDER_GAP,
+)
+from normalization import words
+from repositories.search_term import SearchTermRepository
+
+
+def add_missing_columns(engine):
+    """Add columns declared on the models that an older database does not have yet.
+
+    create_all() only creates missing tables, so nullable columns added to existing
+    models are brought in with ALTER TABLE here, followed by any missing indexes.
+    """
+    inspector = inspect(engine)
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                logging.info(f"Adding column {table.name}.{column.name}")
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def migrate_music_file_genres(engine):
+    """Move music file genres from per-track strings in track_genres to the genres/music_file_genres tables."""
+    with engine.begin() as conn:
+        rows = conn.execute(
+            select(TrackGenreDB.music_file_id, TrackGenreDB.genre)
+            .where(TrackGenreDB.parent_type == "music_file", TrackGenreDB.genre.is_not(None))
+            .order_by(TrackGenreDB.music_file_id, TrackGenreDB.id)
+        ).all()
+        if not rows:
+            return
+
+        logging.info(f"Migrating {len(rows)} music file genres")
+        ids = dict(conn.execute(select(GenreDB.name, GenreDB.id)).all())
+        for name in sorted({genre for _, genre in rows if genre and genre not in ids}):
+            ids[name] = conn.execute(
+                insert(GenreDB).values(name=name, key=genre_key(name)).returning(GenreDB.id)
+            ).scalar_one()
+
+        links = {}
+        for music_file_id, genre in rows:
+            if genre:
+                positions = links.setdefault(music_file_id, {})
+                positions.setdefault(ids[genre], len(positions))
+
+        link_rows = [
+            {"music_file_id": music_file_id, "genre_id": genre_id, "position": position}
+            for music_file_id, positions in links.items()
+            for genre_id, position in positions.items()
+        ]
+        if link_rows:
+            conn.execute(insert(MusicFileGenreDB).prefix_with("OR IGNORE"), link_rows)
+        conn.execute(delete(TrackGenreDB).where(TrackGenreDB.parent_type == "music_file"))
+
+
+def add_search_index(engine):
+    """Create and fill the full-text index for databases created before it existed."""
+    if inspect(engine).has_table("music_files_fts"):
+        return
+
+    with engine.begin() as conn:
+        if create_search_index(conn, rebuild=True):
+            logging.info("Built full-text search index")
+        else:
+            logging.warning("SQLite was built without FTS5, search falls back to LIKE")
+
+
+def build_search_terms(engine):
+    """Fill the fuzzy search vocabulary for libraries scanned before it existed."""
+    with Session(engine) as session:
+        if session.query(SearchTermDB.id).first() is not None or session.query(MusicFileDB.id).first() is None:
+            return
+
+        logging.info("Building fuzzy search vocabulary")
+        search_terms = SearchTermRepository(session)
+        rows = session.query(MusicFileDB.title, MusicFileDB.artist, MusicFileDB.album).yield_per(1000)
+        search_terms.add(word for row in rows for word in words(*row))
+        session.commit()
+
+
+def backfill_match_keys(engine, batch_size=1000):
+    """Fill the *_key columns for music files written before the columns existed."""
+    with Session(engine) as session:
+        unkeyed = or_(
+            MusicFileDB.title_key.is_(None) & MusicFileDB.title.is_not(None),
+            MusicFileDB.artist_key.is_(None) & MusicFileDB.artist.is_not(None),
+            MusicFileDB.album_key.is_(None) & MusicFileDB.album.is_not(None),
+            MusicFileDB.album_artist_key.is_(None) & MusicFileDB.album_artist.is_not(None),
+        )
+        rows = (
+            session.query(MusicFileDB.id, MusicFileDB.title, MusicFileDB.artist, MusicFileDB.album, MusicFileDB.album_artist)
+            .filter(unkeyed)
+            .all()
+        )
+        if not rows:
+            return
+
+        logging.info(f"Computing match keys for {len(rows)} music files")
+        for start in range(0, len(rows), batch_size):
+            session.execute(
+                update(MusicFileDB),
+                [{"id": row.id, **track_match_keys(row.title, row.artist, row.album, row.album_artist)} for row in rows[start:start + batch_size]],
+            )
+        session.commit()
+
+
+def space_playlist_orders(engine):
+    """Spread playlist entries written with dense positions out to sparse order keys.
+
+    Runs before the unique (playlist_id, order) index is created, which is what marks
+    a database as already converted.
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table("playlist_entries"):
+        return
+
+    indexes = {index["name"]: index for index in inspector.get_indexes("playlist_entries")}
+    index = indexes.get("playlist_entries_playlist_order_idx")
+    if index is not None and index["unique"]:
+        return
+
+    logging.info("Spacing out playlist entry order keys")
+    with engine.begin() as conn:
+        if index is not None:
+            conn.execute(text("DROP INDEX playlist_entries_playlist_order_idx"))
+        conn.execute(text("""
+            UPDATE playlist_entries SET "order" = ranked.position * :gap
+            FROM (
+                SELECT id, row_number() OVER (PARTITION BY playlist_id ORDER BY "order", id) - 1 AS position
+                FROM playlist_entries
+            ) AS ranked
+            WHERE playlist_entries.id = ranked.id
+        """), {"gap": ORDER_GAP})
+
+
+def migrate(engine):
+    space_playlist_orders(engine)
+    add_missing_columns(engine)
+    backfill_match_keys(engine)
+    migrate_music_file_genres(engine)
+    add_search_index(engine)
+    build_search_terms(engine)
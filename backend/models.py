@@ -1,5 +1,5 @@
 from __future__ import annotations
-from sqlalchemy import Column, Integer, String, DateTime, JSON, ForeignKey, Enum, Text, Boolean, Index
+from sqlalchemy import Column, Integer, String, DateTime, JSON, ForeignKey, Enum, Text, Boolean, Index, Float, DDL, event
 from sqlalchemy.orm import (
     relationship,
     declarative_base,
@@ -8,7 +8,7 @@ from sqlalchemy.orm import (
     mapped_column,
 )
 from typing import List, Optional
-from sqlalchemy.ext.orderinglist import ordering_list
+from normalization import match_key
 
 Base = declarative_base()
 
@@ -62,19 +62,175 @@ class TrackGenreDB(Base):
     genre = Column(String, index=True)
 
 
+def genre_key(name: str) -> str:
+    return name.strip().casefold()
+
+
+def track_match_keys(title: Optional[str], artist: Optional[str], album: Optional[str], album_artist: Optional[str] = None) -> dict:
+    return {
+        "title_key": match_key(title),
+        "artist_key": match_key(artist),
+        "album_key": match_key(album),
+        "album_artist_key": match_key(album_artist),
+    }
+
+
+class GenreDB(Base):
+    """One row per distinct genre name, shared by every music file tagged with it."""
+    __tablename__ = "genres"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    # case-insensitive lookup key
+    key = Column(String, index=True, nullable=False)
+
+
+class MusicFileGenreDB(Base):
+    __tablename__ = "music_file_genres"
+    music_file_id = Column(Integer, ForeignKey("music_files.id", ondelete="CASCADE"), primary_key=True)
+    genre_id = Column(Integer, ForeignKey("genres.id"), primary_key=True)
+    # order the genres appear in the file's tags
+    position = Column(Integer, default=0)
+
+    genre = relationship("GenreDB")
+
+    __table_args__ = (
+        # the primary key covers lookups by file, this one lookups by genre
+        Index("ix_music_file_genres_genre_id_music_file_id", "genre_id", "music_file_id"),
+    )
+
+
 class MusicFileDB(BaseNode, TrackDetailsMixin):
     __tablename__ = "music_files"
     id = Column(Integer, ForeignKey("base_elements.id"), primary_key=True)
     path = Column(String, index=True)
     kind = Column(String, index=True)
     last_scanned = Column(DateTime, index=True)
-    genres = relationship(
-        "TrackGenreDB",
-        primaryjoin="and_(TrackGenreDB.music_file_id==MusicFileDB.id, TrackGenreDB.parent_type=='music_file')",
+    genre_links = relationship(
+        "MusicFileGenreDB",
+        order_by="MusicFileGenreDB.position",
         cascade="all, delete-orphan",
     )
+    genres = relationship(
+        "GenreDB",
+        secondary="music_file_genres",
+        order_by="MusicFileGenreDB.position",
+        viewonly=True,
+    )
     missing = Column(Boolean, default=False)
 
+    # fingerprint used to recognise a file that was moved or renamed between scans
+    size = Column(Integer, nullable=True)
+    mtime = Column(Float, nullable=True)
+    inode = Column(Integer, nullable=True)
+    device = Column(Integer, nullable=True)
+    partial_hash = Column(String, nullable=True)
+
+    # normalization.match_key of the tags, written alongside them, for case-, accent-
+    # and article-insensitive lookups that are index seeks
+    title_key = Column(String, nullable=True)
+    artist_key = Column(String, nullable=True)
+    album_key = Column(String, nullable=True)
+    album_artist_key = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index("ix_music_files_artist_key_title_key", "artist_key", "title_key"),
+        Index("ix_music_files_title_key", "title_key"),
+        Index("ix_music_files_album_key", "album_key"),
+    )
+
+
+@event.listens_for(MusicFileDB, "before_insert")
+@event.listens_for(MusicFileDB, "before_update")
+def set_match_keys(mapper, connection, target: MusicFileDB):
+    # bulk writes (the scanner's) bypass this and include the keys in their rows
+    for key, value in track_match_keys(target.title, target.artist, target.album, target.album_artist).items():
+        setattr(target, key, value)
+
+
+# FTS5 index over music file tags for /api/search, kept in sync with music_files by triggers
+MUSIC_FILES_FTS_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS music_files_fts USING fts5(
+        title, artist, album,
+        content='music_files', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS music_files_fts_insert AFTER INSERT ON music_files BEGIN
+        INSERT INTO music_files_fts(rowid, title, artist, album) VALUES (new.id, new.title, new.artist, new.album);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS music_files_fts_delete AFTER DELETE ON music_files BEGIN
+        INSERT INTO music_files_fts(music_files_fts, rowid, title, artist, album) VALUES ('delete', old.id, old.title, old.artist, old.album);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS music_files_fts_update AFTER UPDATE OF title, artist, album ON music_files BEGIN
+        INSERT INTO music_files_fts(music_files_fts, rowid, title, artist, album) VALUES ('delete', old.id, old.title, old.artist, old.album);
+        INSERT INTO music_files_fts(rowid, title, artist, album) VALUES (new.id, new.title, new.artist, new.album);
+    END
+    """,
+]
+
+
+def create_search_index(connection, rebuild=False) -> bool:
+    """Create the full-text index and its triggers, if this SQLite has FTS5."""
+    if connection.dialect.name != "sqlite":
+        return False
+    if not connection.exec_driver_sql("SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar():
+        return False
+
+    for statement in MUSIC_FILES_FTS_DDL:
+        connection.exec_driver_sql(statement)
+    if rebuild:
+        connection.exec_driver_sql("INSERT INTO music_files_fts(music_files_fts) VALUES ('rebuild')")
+
+    return True
+
+
+event.listen(MusicFileDB.__table__, "after_create", lambda target, connection, **kw: create_search_index(connection))
+event.listen(MusicFileDB.__table__, "before_drop", DDL("DROP TABLE IF EXISTS music_files_fts").execute_if(dialect="sqlite"))
+
+
+class SearchTermDB(Base):
+    """Distinct normalized words of music file titles, artists and albums, for fuzzy search."""
+    __tablename__ = "search_terms"
+    id = Column(Integer, primary_key=True, index=True)
+    term = Column(String, unique=True, nullable=False)
+
+
+class SearchTermTrigramDB(Base):
+    __tablename__ = "search_term_trigrams"
+    trigram = Column(String, primary_key=True)
+    term_id = Column(Integer, ForeignKey("search_terms.id", ondelete="CASCADE"), primary_key=True)
+
+    __table_args__ = {"sqlite_with_rowid": False}
+
+
+class LibraryDirectoryDB(Base):
+    __tablename__ = "library_directories"
+    id = Column(Integer, primary_key=True, index=True)
+    path = Column(String, unique=True, index=True)
+    mtime = Column(Float)
+    file_count = Column(Integer)
+    last_scanned = Column(DateTime)
+
+
+class ScanCheckpointDB(Base):
+    """Progress of the latest scan of a library root, so an interrupted scan can resume."""
+    __tablename__ = "scan_checkpoints"
+    id = Column(Integer, primary_key=True, index=True)
+    root = Column(String, unique=True, index=True)
+    generation = Column(Integer, default=1)
+    full = Column(Boolean, default=False)
+    # last directory committed, relative to root
+    last_directory = Column(String, nullable=True)
+    started_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    completed = Column(Boolean, default=False)
+
 
 class LastFMTrackDB(BaseNode, TrackDetailsMixin):
     __tablename__ = "lastfm_tracks"
@@ -111,7 +267,6 @@ class PlaylistDB(Base):
     entries: Mapped[List["PlaylistEntryDB"]] = relationship(
         order_by="PlaylistEntryDB.order",
         back_populates="playlist",
-        collection_class=ordering_list("order"),
         passive_deletes=True,
         single_parent=True
     )
@@ -131,6 +286,10 @@ class PlaylistEntryDB(Base):
     __mapper_args__ = {"polymorphic_on": entry_type, "polymorphic_identity": "entry"}
 
 Index("playlist_entries_playlist_idx", PlaylistEntryDB.playlist_id)
+Index("playlist_entries_playlist_order_idx", PlaylistEntryDB.playlist_id, PlaylistEntryDB.order, unique=True)
+
+# entries are ordered by sparse keys, appended this far apart so moves fit between neighbours
+ORDER_GAP = 1024
 
 class MusicFileEntryDB(PlaylistEntryDB):
     __tablename__ = "music_file_entries"
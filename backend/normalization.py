@@ -0,0 +1,44 @@
+import re
+import unicodedata
+from typing import List, Optional, Tuple
+
+NON_WORD = re.compile(r"[\W_]+")
+
+# "Beatles, The" as library sort names are often written
+TRAILING_ARTICLE = re.compile(r",\s*(?:the|a|an)\s*$", re.IGNORECASE)
+
+
+def normalize_text(value: Optional[str]) -> str:
+    """Casefold, strip accents and collapse punctuation and whitespace to single spaces."""
+    if not value:
+        return ""
+
+    decomposed = unicodedata.normalize("NFKD", value.casefold())
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return NON_WORD.sub(" ", stripped).strip()
+
+
+def words(*values: Optional[str]) -> List[str]:
+    return [word for value in values for word in normalize_text(value).split()]
+
+
+ARTICLES = ("the", "a", "an")
+
+
+def strip_article(key: str) -> str:
+    """Drop a leading article from normalized text, so "the beatles" also files under "beatles"."""
+    first, _, rest = key.partition(" ")
+    return rest if rest and first in ARTICLES else key
+
+
+def match_key(value: Optional[str]) -> Optional[str]:
+    """Key under which tag values compare equal: "The Beatles", "the beatles" and "Beatles, The" all give "beatles"."""
+    if value is None:
+        return None
+
+    return strip_article(normalize_text(TRAILING_ARTICLE.sub("", value)))
+
+
+def prefix_range(key: str) -> Tuple[str, str]:
+    """Bounds of the keys starting with key, for an index range scan instead of LIKE."""
+    return key, key + "\U0010ffff"
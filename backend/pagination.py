@@ -0,0 +1,37 @@
+import json
+import base64
+from typing import List, NamedTuple, Optional
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Page(NamedTuple):
+    results: list
+    next_cursor: Optional[str]
+
+
+def encode_cursor(*values) -> str:
+    """Opaque cursor holding the sort values of the last row of a page."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> List:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise InvalidCursor(f"Invalid cursor {cursor!r}")
+
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursor(f"Invalid cursor {cursor!r}")
+    return values
+
+
+def paginate(rows: list, limit: int, sort_values) -> Page:
+    """Trim rows fetched with limit + 1 to a page, with a cursor after its last row if there is more."""
+    if len(rows) <= limit:
+        return Page(rows, None)
+
+    rows = rows[:limit]
+    return Page(rows, encode_cursor(*sort_values(rows[-1])))
@@ -0,0 +1,66 @@
+from .base import BaseRepository
+from models import GenreDB, MusicFileDB, MusicFileGenreDB, genre_key
+from typing import Dict, Iterable, List, Tuple
+from response_models import Genre
+from sqlalchemy import insert, delete, func
+
+
+class GenreRepository(BaseRepository[GenreDB]):
+    def __init__(self, session):
+        super().__init__(session, GenreDB)
+        # genre name -> id, filled as names are interned
+        self.ids: Dict[str, int] = {}
+
+    def intern(self, names: Iterable[str]) -> Dict[str, int]:
+        """Look up or create the genre rows for names, returning the name -> id cache."""
+        wanted = {name for name in names if name and name not in self.ids}
+        if not wanted:
+            return self.ids
+
+        existing = self.session.query(GenreDB.name, GenreDB.id).filter(GenreDB.name.in_(wanted))
+        self.ids.update({name: genre_id for name, genre_id in existing})
+
+        new_names = sorted(wanted - self.ids.keys())
+        if new_names:
+            ids = self.session.execute(
+                insert(GenreDB).returning(GenreDB.id, sort_by_parameter_order=True),
+                [{"name": name, "key": genre_key(name)} for name in new_names],
+            ).scalars().all()
+            self.ids.update(zip(new_names, ids))
+
+        return self.ids
+
+    def link(self, files: Iterable[Tuple[int, List[str]]]):
+        """Bulk insert the genre links for (music_file_id, genre names) pairs."""
+        files = list(files)
+        ids = self.intern(name for _, names in files for name in names)
+
+        rows = []
+        for music_file_id, names in files:
+            genre_ids = dict.fromkeys(ids[name] for name in names if name)
+            rows.extend(
+                {"music_file_id": music_file_id, "genre_id": genre_id, "position": position}
+                for position, genre_id in enumerate(genre_ids)
+            )
+
+        if rows:
+            self.session.execute(insert(MusicFileGenreDB), rows)
+
+    def unlink(self, music_file_ids: List[int]):
+        self.session.execute(delete(MusicFileGenreDB).where(MusicFileGenreDB.music_file_id.in_(music_file_ids)))
+
+    def list_genres(self) -> List[Genre]:
+        counts = (
+            self.session.query(MusicFileGenreDB.genre_id, func.count().label("count"))
+            .join(MusicFileDB, MusicFileDB.id == MusicFileGenreDB.music_file_id)
+            .filter(MusicFileDB.missing.is_not(True))
+            .group_by(MusicFileGenreDB.genre_id)
+            .subquery()
+        )
+        rows = (
+            self.session.query(GenreDB.name, counts.c.count)
+            .join(counts, counts.c.genre_id == GenreDB.id)
+            .order_by(GenreDB.key)
+        )
+
+        return [Genre(name=name, count=count) for name, count in rows]
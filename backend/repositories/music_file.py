@@ -1,12 +1,62 @@
 from .base import BaseRepository
-from models import MusicFileDB, TrackGenreDB
-from typing import Optional
+from models import MusicFileDB, GenreDB, MusicFileGenreDB, genre_key
+from typing import Callable, Dict, List, Optional, Tuple
 from response_models import MusicFile, SearchQuery, RequestedTrack, TrackDetails, Playlist, MusicFileEntry
-from sqlalchemy import text, or_
+from sqlalchemy import text, or_, and_, case, func, table, column, literal, literal_column, select, union_all
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import selectinload
 import time
 import urllib
 import logging
+import threading
 from repositories.playlist import PlaylistRepository
+from repositories.genre import GenreRepository
+from repositories.search_term import SearchTermRepository
+from normalization import words, match_key
+from fuzzy import edit_distance
+from pagination import Page, decode_cursor, paginate
+
+# the FTS5 table created alongside music_files, see models.MUSIC_FILES_FTS_DDL
+search_index = table("music_files_fts", column("rowid"))
+
+# (artist_key, title_key) pairs, or ids, looked up per statement when matching tracks
+MATCH_BATCH_SIZE = 1000
+
+# bm25 weights for title, artist and album, matching the old title > artist > album scoring
+SEARCH_WEIGHTS = (10.0, 4.0, 2.0)
+
+
+FACETS = ("artist", "album", "genre", "year")
+
+
+class FacetCache:
+    """Facet counts of the whole library, kept until the next scan or watcher update clears them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts: Dict[int, dict] = {}
+        self.generation = 0
+
+    def get(self, top: int, compute: Callable[[], dict]) -> dict:
+        with self.lock:
+            if top in self.counts:
+                return self.counts[top]
+            generation = self.generation
+
+        counts = compute()
+        with self.lock:
+            # a scan that finished while computing makes these stale already
+            if generation == self.generation:
+                self.counts[top] = counts
+        return counts
+
+    def clear(self):
+        with self.lock:
+            self.counts = {}
+            self.generation += 1
+
+
+library_facets = FacetCache()
 
 
 def to_music_file(music_file_db: MusicFileDB) -> MusicFile:
@@ -21,7 +71,7 @@ def to_music_file(music_file_db: MusicFileDB) -> MusicFile:
         length=music_file_db.length,
         publisher=music_file_db.publisher,
         kind=music_file_db.kind,
-        genres=[g.genre for g in music_file_db.genres] or [],
+        genres=[g.name for g in music_file_db.genres] or [],
         last_scanned=music_file_db.last_scanned,
         missing=music_file_db.missing,
     )
@@ -31,13 +81,94 @@ class MusicFileRepository(BaseRepository[MusicFileDB]):
     def __init__(self, session):
         super().__init__(session, MusicFileDB)
 
-    def search(self, query: str, limit: int = 50) -> list[MusicFile]:
+    def search(self, query: str, limit: int = 50, fuzzy=False) -> list[MusicFile]:
+        return self.search_page(query, limit, fuzzy).results
+
+    def search_page(self, query: str, limit: int = 50, fuzzy=False, cursor: Optional[str] = None) -> Page:
+        """One page of search results by relevance, with the cursor of the next page if there is one."""
         query_package = SearchQuery(full_search=query, limit=limit)
         start_time = time.time()
 
         search_query = urllib.parse.unquote(query_package.full_search or "")
         tokens = search_query.split()
 
+        if fuzzy:
+            # a word that no vocabulary term starts with may match terms within a few typos of it
+            search_terms = SearchTermRepository(self.session)
+            alternatives = [
+                [word] if search_terms.has_prefix(word) else [word, *search_terms.similar(word)]
+                for word in words(search_query)
+            ]
+            tokens = [terms[1] if len(terms) > 1 else terms[0] for terms in alternatives]
+            if not alternatives and search_query.strip():
+                # punctuation only: nothing to match, rather than no filter at all
+                return Page([], None)
+        else:
+            alternatives = [[token] for token in tokens]
+
+        page = None
+        if tokens:
+            try:
+                page = self._search_index(alternatives, query_package.limit, cursor)
+            except OperationalError as e:
+                logging.warning(f"Full-text search failed, falling back to LIKE: {e}")
+
+        if page is None:
+            page = self._search_like(tokens, query_package.limit, cursor)
+
+        logging.info(
+            f"Search query: {search_query} returned {len(page.results)} results in {time.time() - start_time:.2f} seconds"
+        )
+
+        return Page([to_music_file(r) for r in page.results], page.next_cursor)
+
+    def _search_index(self, alternatives: list[list[str]], limit: int, cursor: Optional[str] = None) -> Page:
+        # every token must match, as a prefix of a word in any of the columns, or one of
+        # its fuzzy alternatives as a whole word
+        def quote(term):
+            return '"' + term.replace('"', '""') + '"'
+
+        match = " AND ".join(
+            "(" + " OR ".join([quote(token) + "*"] + [quote(term) for term in terms]) + ")"
+            for token, *terms in alternatives
+        )
+        rank = func.bm25(literal_column("music_files_fts"), *SEARCH_WEIGHTS)
+
+        # files matching every token as typed come before those that need a typo alternative
+        tier = literal(0)
+        if any(terms for _, *terms in alternatives):
+            exact = " AND ".join(quote(token) + "*" for token, *_ in alternatives)
+            tier = case(
+                (
+                    text(
+                        "music_files.id IN (SELECT rowid FROM music_files_fts WHERE music_files_fts MATCH :exact)"
+                    ).bindparams(exact=exact),
+                    0,
+                ),
+                else_=1,
+            )
+
+        query = (
+            self.session.query(MusicFileDB, tier, rank)
+            .join(search_index, search_index.c.rowid == MusicFileDB.id)
+            .filter(literal_column("music_files_fts").op("MATCH")(match))
+        )
+        if cursor:
+            # bm25 is lower for better matches; ties continue by id
+            last_tier, last_rank, last_id = decode_cursor(cursor, 3)
+            query = query.filter(
+                or_(
+                    tier > last_tier,
+                    and_(tier == last_tier, rank > last_rank),
+                    and_(tier == last_tier, rank == last_rank, MusicFileDB.id > last_id),
+                )
+            )
+
+        rows = query.order_by(tier, rank, MusicFileDB.id).limit(limit + 1).all()
+        page = paginate(rows, limit, lambda row: (row[1], row[2], row[0].id))
+        return Page([row[0] for row in page.results], page.next_cursor)
+
+    def _search_like(self, tokens: list[str], limit: int, cursor: Optional[str] = None) -> Page:
         # Build scoring expression
         scoring = """
             CASE
@@ -62,7 +193,7 @@ class MusicFileRepository(BaseRepository[MusicFileDB]):
         # Add score for each token
         score_sum = "+".join(
             [scoring.replace(":token", f":token{i}") for i in range(len(tokens))]
-        )
+        ) or "0"
 
         # Build query with scoring
         query = self.session.query(MusicFileDB, text(f"({score_sum}) as relevance"))
@@ -80,17 +211,19 @@ class MusicFileRepository(BaseRepository[MusicFileDB]):
                 )
             )
 
-        # Order by relevance score
-        results = (
-            query.order_by(text("relevance DESC")).limit(query_package.limit).all()
-        )
+        if cursor:
+            # cursors have the (tier, score, id) shape of full-text ones; every LIKE match is in tier 0
+            _, last_score, last_id = decode_cursor(cursor, 3)
+            query = query.filter(
+                text(f"(({score_sum}) < :last_score OR (({score_sum}) = :last_score AND music_files.id > :last_id))")
+            ).params(last_score=last_score, last_id=last_id)
 
-        logging.info(
-            f"Search query: {search_query} returned {len(results)} results in {time.time() - start_time:.2f} seconds"
-        )
+        # Order by relevance score, then id so that pages follow on from each other
+        rows = query.order_by(text("relevance DESC"), MusicFileDB.id).limit(limit + 1).all()
 
         # Extract just the MusicFileDB objects from results
-        return [to_music_file(r.MusicFileDB) for r in results]
+        page = paginate(rows, limit, lambda row: (0, row[1], row[0].id))
+        return Page([row.MusicFileDB for row in page.results], page.next_cursor)
 
     def filter(
         self,
@@ -101,29 +234,142 @@ class MusicFileRepository(BaseRepository[MusicFileDB]):
         exact=False,
         limit: int = 50,
     ) -> list[MusicFile]:
+        return self.filter_page(title, artist, album, genre, exact, limit).results
+
+    def filter_page(
+        self,
+        title: Optional[str] = None,
+        artist: Optional[str] = None,
+        album: Optional[str] = None,
+        genre: Optional[str] = None,
+        exact=False,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+    ) -> Page:
+        """One page of matching files in id order, with the cursor of the next page if there is one."""
+        query = self._filter_query(title, artist, album, genre, exact)
+        if cursor:
+            (last_id,) = decode_cursor(cursor, 1)
+            query = query.filter(MusicFileDB.id > last_id)
+
+        rows = query.order_by(MusicFileDB.id).limit(limit + 1).all()
+        page = paginate(rows, limit, lambda music_file: (music_file.id,))
+
+        return Page([to_music_file(music_file) for music_file in page.results], page.next_cursor)
+
+    def facets(
+        self,
+        title: Optional[str] = None,
+        artist: Optional[str] = None,
+        album: Optional[str] = None,
+        genre: Optional[str] = None,
+        exact=False,
+        top: int = 10,
+    ) -> Dict[str, List[Tuple[str, int, Optional[str]]]]:
+        """The top (value, count, artist) of each facet over the files filter() would match.
+
+        Albums are counted per album artist (or artist), which comes back with them so that
+        albums sharing a title stay apart; the other facets have no artist.
+        """
+        if not (title or artist or album or genre):
+            return library_facets.get(top, lambda: self._facets(self._filter_query(), top))
+
+        return self._facets(self._filter_query(title, artist, album, genre, exact), top)
+
+    def _facets(self, query, top: int) -> Dict[str, List[Tuple[str, int, Optional[str]]]]:
+        # a single statement: the filtered files once, grouped per facet, ranked per facet
+        filtered = query.with_entities(
+            MusicFileDB.id,
+            MusicFileDB.artist,
+            MusicFileDB.artist_key,
+            MusicFileDB.album,
+            MusicFileDB.album_key,
+            func.coalesce(MusicFileDB.album_artist, MusicFileDB.artist).label("album_artist"),
+            func.coalesce(MusicFileDB.album_artist_key, MusicFileDB.artist_key).label("album_artist_key"),
+            MusicFileDB.year,
+        ).cte("filtered").prefix_with("MATERIALIZED")
+
+        def grouped(facet, value, key, artist=None, artist_key=None):
+            # spellings that share a match key count together, under the first of them;
+            # values that belong to an artist are counted per artist
+            by_artist = () if artist_key is None else (artist_key,)
+            return (
+                select(
+                    literal(facet).label("facet"),
+                    func.min(value).label("value"),
+                    func.count().label("count"),
+                    (literal(None) if artist is None else func.min(artist)).label("artist"),
+                )
+                .where(key.is_not(None))
+                .group_by(*by_artist, key)
+            )
+
+        genres = (
+            select(literal("genre"), func.min(GenreDB.name), func.count(), literal(None))
+            .select_from(filtered)
+            .join(MusicFileGenreDB, MusicFileGenreDB.music_file_id == filtered.c.id)
+            .join(GenreDB, GenreDB.id == MusicFileGenreDB.genre_id)
+            .group_by(GenreDB.key)
+        )
+        counts = union_all(
+            grouped("artist", filtered.c.artist, filtered.c.artist_key),
+            grouped("album", filtered.c.album, filtered.c.album_key, filtered.c.album_artist, filtered.c.album_artist_key),
+            grouped("year", filtered.c.year, filtered.c.year),
+            genres,
+        ).subquery()
+        rank = func.row_number().over(partition_by=counts.c.facet, order_by=(counts.c.count.desc(), counts.c.value, counts.c.artist))
+        ranked = select(counts, rank.label("rank")).subquery()
+
+        facets = {facet: [] for facet in FACETS}
+        rows = self.session.execute(
+            select(ranked.c.facet, ranked.c.value, ranked.c.count, ranked.c.artist)
+            .where(ranked.c.rank <= top)
+            .order_by(ranked.c.facet, ranked.c.rank)
+        )
+        for facet, value, count, artist in rows:
+            facets[facet].append((value, count, artist))
+        return facets
+
+    def _filter_query(
+        self,
+        title: Optional[str] = None,
+        artist: Optional[str] = None,
+        album: Optional[str] = None,
+        genre: Optional[str] = None,
+        exact=False,
+    ):
         query = self.session.query(MusicFileDB)
 
-        if title:
-            if exact:
-                query = query.filter(MusicFileDB.title == title)
-            else:
-                query = query.filter(MusicFileDB.title.ilike(f"%{title}%"))
-        if artist:
-            if exact:
-                query = query.filter(MusicFileDB.artist == artist)
-            else:
-                query = query.filter(MusicFileDB.artist.ilike(f"%{artist}%"))
-        if album:
-            if exact:
-                query = query.filter(MusicFileDB.album == album)
-            else:
-                query = query.filter(MusicFileDB.album.ilike(f"%{album}%"))
+        for value, raw, key_column in (
+            (title, MusicFileDB.title, MusicFileDB.title_key),
+            (artist, MusicFileDB.artist, MusicFileDB.artist_key),
+            (album, MusicFileDB.album, MusicFileDB.album_key),
+        ):
+            if value:
+                query = query.filter(self._match(value, raw, key_column, exact))
         if genre:
-            query = query.filter(MusicFileDB.genres.any(genre))
+            # genres.key -> (genre_id, music_file_id) index, no scan of music_files
+            tagged = (
+                self.session.query(MusicFileGenreDB.music_file_id)
+                .join(GenreDB, GenreDB.id == MusicFileGenreDB.genre_id)
+                .filter(GenreDB.key == genre_key(genre))
+            )
+            query = query.filter(MusicFileDB.id.in_(tagged))
+
+        return query
 
-        results = query.limit(limit).all()
+    @staticmethod
+    def _match(value: str, raw, key_column, exact: bool):
+        # equal keys when exact, a seek on the key indexes; otherwise the value's key
+        # anywhere in the key, so "ight" finds both "Night" and "Light"
+        key = match_key(value)
+        if not key:
+            # nothing but punctuation or a lone article, compare the tag itself
+            return raw == value if exact else raw.ilike(f"%{value}%")
+        if exact:
+            return key_column == key
 
-        return [to_music_file(music_file) for music_file in results]
+        return key_column.contains(key, autoescape=True)
 
     def add_music_file(self, music_file: MusicFile) -> MusicFile:
         music_file_db = MusicFileDB(
@@ -140,11 +386,11 @@ class MusicFileRepository(BaseRepository[MusicFileDB]):
         )
 
         self.session.add(music_file_db)
-        self.session.commit()
+        self.session.flush()
 
         # Add genres
-        for genre in music_file.genres:
-            music_file_db.genres.append(TrackGenreDB(parent_type="music_file", genre=genre))
+        GenreRepository(self.session).link([(music_file_db.id, music_file.genres)])
+        SearchTermRepository(self.session).add(words(music_file.title, music_file.artist, music_file.album))
 
         self.session.commit()
         self.session.refresh(music_file_db)
@@ -180,44 +426,108 @@ class MusicFileRepository(BaseRepository[MusicFileDB]):
 
         self.session.commit()
     
-    def find_local_files(self, tracks: list[TrackDetails]):
-        results = []
-
-        for t in tracks:
-            existing_files = self.filter(title=t.title, artist=t.artist, exact=True)
-            if existing_files:
-                results.append(existing_files[0])
-            else:
-                results.append(t)
+    def find_local_files(self, tracks: list[TrackDetails], tolerance: int = 0):
+        """Each track's local file, or the track itself where there is none, in input order."""
+        ids = self.match_local_files(tracks, tolerance)
+
+        files = {}
+        matched = sorted({music_file_id for music_file_id in ids if music_file_id is not None})
+        for start in range(0, len(matched), MATCH_BATCH_SIZE):
+            query = (
+                self.session.query(MusicFileDB)
+                .options(selectinload(MusicFileDB.genres))
+                .filter(MusicFileDB.id.in_(matched[start:start + MATCH_BATCH_SIZE]))
+            )
+            files.update((music_file.id, to_music_file(music_file)) for music_file in query)
 
-        return results
-    
-    def contains(self, tracks: list[TrackDetails]):
-        filters = or_([MusicFileDB.title == track.title and MusicFileDB.artist == track.artist for track in tracks])
-        existing_tracks = self.session.query(MusicFileDB).filter(filters).all()
+        return [files[music_file_id] if music_file_id is not None else t for t, music_file_id in zip(tracks, ids)]
 
-        results = []
+    def match_local_files(self, tracks: list[TrackDetails], tolerance: int = 0) -> list[Optional[int]]:
+        """The id of the local file with each track's artist and title keys, in input order.
 
-        for track in tracks:
-            found = False
-            if track.title in [t.title for t in existing_tracks]:
-                if track.artist in [t.artist for t in existing_tracks]:
-                    found = True
-            
-            results.append({"exists": found, "title": track.title, "artist": track.artist})
+        With a tolerance, a track without an exact match may also match a file with the
+        same artist key and a title key within that many edits, or the other way round.
+        Tracks without both an artist and a title do not match.
+        """
+        keys = [(match_key(t.artist), match_key(t.title)) for t in tracks]
+        wanted = {key for key in keys if key[0] and key[1]}
+
+        found = self._match_keys(wanted)
+        if tolerance > 0 and len(found) < len(wanted):
+            found.update(self._match_keys_fuzzy(wanted - found.keys(), tolerance))
+
+        return [found.get(key) for key in keys]
+
+    def _match_keys(self, keys) -> dict[tuple[str, str], int]:
+        # one lookup per batch: the keys as a VALUES table driving seeks on the
+        # (artist_key, title_key) index; files that are not missing win
+        keys = list(keys)
+        found = {}
+        for start in range(0, len(keys), MATCH_BATCH_SIZE):
+            batch = keys[start:start + MATCH_BATCH_SIZE]
+            params = {}
+            for i, (artist_key, title_key) in enumerate(batch):
+                params[f"artist{i}"] = artist_key
+                params[f"title{i}"] = title_key
+            wanted = ", ".join(f"(:artist{i}, :title{i})" for i in range(len(batch)))
+
+            rows = self.session.execute(text(f"""
+                WITH wanted(artist_key, title_key) AS (VALUES {wanted})
+                SELECT music_files.id, music_files.artist_key, music_files.title_key
+                FROM wanted
+                JOIN music_files ON music_files.artist_key = wanted.artist_key AND music_files.title_key = wanted.title_key
+                ORDER BY music_files.missing, music_files.id
+            """), params)
+            for row in rows:
+                found.setdefault((row.artist_key, row.title_key), row.id)
+
+        return found
+
+    def _match_keys_fuzzy(self, keys: set[tuple[str, str]], tolerance: int) -> dict[tuple[str, str], int]:
+        # candidates share the artist or the title key exactly, and are ranked by the
+        # edit distance of the other one
+        music_files = MusicFileDB.__table__
+        by_artist, by_title = {}, {}
+        for key_column, values, candidates, other in (
+            (music_files.c.artist_key, sorted({a for a, _ in keys}), by_artist, music_files.c.title_key),
+            (music_files.c.title_key, sorted({t for _, t in keys}), by_title, music_files.c.artist_key),
+        ):
+            for start in range(0, len(values), MATCH_BATCH_SIZE):
+                rows = self.session.execute(
+                    select(key_column, other, music_files.c.missing, music_files.c.id)
+                    .where(key_column.in_(values[start:start + MATCH_BATCH_SIZE]))
+                )
+                for key, other_key, missing, music_file_id in rows:
+                    if other_key:
+                        candidates.setdefault(key, []).append((other_key, bool(missing), music_file_id))
+
+        found = {}
+        for artist_key, title_key in keys:
+            ranked = [
+                (edit_distance(wanted, other_key, tolerance), missing, music_file_id)
+                for wanted, candidates in ((title_key, by_artist.get(artist_key, [])), (artist_key, by_title.get(title_key, [])))
+                for other_key, missing, music_file_id in candidates
+            ]
+            best = min(ranked, default=None)
+            if best is not None and best[0] <= tolerance:
+                found[(artist_key, title_key)] = best[2]
+
+        return found
 
-        return results
+    def contains(self, tracks: list[TrackDetails]):
+        ids = self.match_local_files(tracks)
+        return [
+            {"exists": music_file_id is not None, "title": track.title, "artist": track.artist}
+            for track, music_file_id in zip(tracks, ids)
+        ]
+
+    def annotate_local_files(self, tracks: list[TrackDetails]) -> list[TrackDetails]:
+        """Set music_file_id on the tracks that are in the library."""
+        for track, music_file_id in zip(tracks, self.match_local_files(tracks)):
+            track.music_file_id = music_file_id
+        return tracks
 
     def dump_library_to_playlist(self, playlist: Playlist, repo: PlaylistRepository) -> Playlist:
-        # get all music files
-        music_files = self.session.query(MusicFileDB).all()
-
-        i = len(playlist.entries)
-        for music_file in music_files:
-            repo.add_entry(playlist.id, MusicFileEntry(entry_type="music_file", order=i, music_file_id=music_file.id, details=MusicFile.from_orm(music_file)), commit=False)
-            i+= 1
-
-            if i % 100 == 0:
-                self.session.commit()
-
+        music_file_ids = self.session.scalars(select(MusicFileDB.id).order_by(MusicFileDB.id)).all()
+        repo.insert_entries(playlist.id, [MusicFileEntry(entry_type="music_file", music_file_id=i) for i in music_file_ids])
         self.session.commit()
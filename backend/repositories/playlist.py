@@ -5,22 +5,26 @@ from models import (
     LastFMEntryDB,
     LastFMTrackDB,
     MusicFileEntryDB,
+    NestedPlaylistEntryDB,
     RequestedTrackEntryDB,
     RequestedTrackDB,
     MusicFileDB,
     TrackGenreDB,
-    BaseNode
+    BaseNode,
+    ORDER_GAP,
 )
 from response_models import (
     Playlist,
+    PlaylistEntriesPage,
     PlaylistEntryBase,
     MusicFileEntry,
     NestedPlaylistEntry,
     LastFMEntry,
     RequestedTrackEntry,
 )
-from sqlalchemy.orm import joinedload, aliased, contains_eager, selectin_polymorphic, selectinload, with_polymorphic
-from sqlalchemy import select
+from sqlalchemy.orm import selectinload, with_polymorphic
+from sqlalchemy import delete, func, insert, or_, select, update
+from collections import defaultdict
 from typing import List, Optional
 import warnings
 import os
@@ -31,6 +35,17 @@ dotenv.load_dotenv(override=True)
 import logging
 logger = logging.getLogger(__name__)
 
+# values bound into one IN list, e.g. Last.fm urls looked up or entry ids deleted
+LOOKUP_BATCH_SIZE = 1000
+
+# entry table and details column per entry type
+ENTRY_DETAILS = {
+    "music_file": (MusicFileEntryDB, "music_file_id"),
+    "nested_playlist": (NestedPlaylistEntryDB, "nested_playlist_id"),
+    "lastfm": (LastFMEntryDB, "lastfm_track_id"),
+    "requested": (RequestedTrackEntryDB, "requested_track_id"),
+}
+
 def playlist_orm_to_response(playlist: PlaylistEntryDB):
     if playlist.entry_type == "music_file":
         return MusicFileEntry.from_orm(playlist)
@@ -43,31 +58,16 @@ def playlist_orm_to_response(playlist: PlaylistEntryDB):
     else:
         raise ValueError(f"Unknown entry type: {playlist.entry_type}")
 
+def with_positions(entries: list, start=0) -> list:
+    """Report entries' positions in the playlist as their order, rather than their sparse keys."""
+    for position, entry in enumerate(entries, start):
+        entry.order = position
+    return entries
+
 class PlaylistRepository(BaseRepository[PlaylistDB]):
     def __init__(self, session):
         super().__init__(session, PlaylistDB)
     
-    def _get_playlist_query(self, playlist_id: int, details=False, limit=None, offset=None):
-        query = (self.session.query(PlaylistDB)
-            .filter(PlaylistDB.id == playlist_id)
-        )
-
-        if limit is not None and offset is not None:
-            subquery = (
-                self.session.query(PlaylistEntryDB.id)
-                    .filter(PlaylistEntryDB.playlist_id == playlist_id)
-                    .order_by(PlaylistEntryDB.order)
-                    .limit(limit).offset(offset)
-            )
-            
-            subquery = subquery.subquery("subquery")
-
-            query = query.join(PlaylistEntryDB, PlaylistDB.entries).filter(PlaylistEntryDB.id.in_(select(subquery.c.id)))
-        elif details:
-            query = query.outerjoin(PlaylistEntryDB)
-
-        return query
-    
     def get_count(self, playlist_id: int):
         return {"count": self.session.query(PlaylistEntryDB).filter(PlaylistEntryDB.playlist_id == playlist_id).count()}
     
@@ -77,20 +77,56 @@ class PlaylistRepository(BaseRepository[PlaylistDB]):
         if result is None:
             return None
 
-        entries = [playlist_orm_to_response(e) for e in result.entries]
+        entries = with_positions([playlist_orm_to_response(e) for e in result.entries])
         return Playlist(id=result.id, name=result.name, entries=entries)
 
     def get_with_entries(self, playlist_id: int, limit=None, offset=None) -> Optional[Playlist]:
-        query = self._get_playlist_query(playlist_id, details=True, limit=limit, offset=offset)
-        result = query.first()
-        
-        if result is None:
+        playlist = self.session.query(PlaylistDB).filter(PlaylistDB.id == playlist_id).first()
+
+        if playlist is None:
             return None
 
+        query = self._entries_query(playlist_id)
+        if limit is not None and offset is not None:
+            query = query.limit(limit).offset(offset)
+
         return Playlist(
-            id=result.id,
-            name=result.name,
-            entries=[playlist_orm_to_response(e) for e in result.entries]
+            id=playlist.id,
+            name=playlist.name,
+            entries=with_positions([playlist_orm_to_response(e) for e in query], offset or 0)
+        )
+
+    def get_entries_page(self, playlist_id: int, after_order: Optional[int] = None, limit=100) -> PlaylistEntriesPage:
+        """A page of entries after the one keyed after_order, seeking the (playlist_id, order) index.
+
+        Entries report their sort key as order here, since that is what after_order takes.
+        Keys are unique within a playlist, so they alone continue the (order, id) ordering.
+        """
+        query = self._entries_query(playlist_id)
+        if after_order is not None:
+            query = query.filter(PlaylistEntryDB.order > after_order)
+        rows = query.limit(limit + 1).all()
+
+        next_after_order = rows[limit - 1].order if len(rows) > limit else None
+        return PlaylistEntriesPage(
+            entries=[playlist_orm_to_response(e) for e in rows[:limit]],
+            next_after_order=next_after_order,
+        )
+
+    def _entries_query(self, playlist_id: int):
+        """Entries in order with their details, in one statement per entry type rather than per entry."""
+        entry = with_polymorphic(PlaylistEntryDB, [MusicFileEntryDB, NestedPlaylistEntryDB, LastFMEntryDB, RequestedTrackEntryDB])
+
+        return (
+            self.session.query(entry)
+            .filter(entry.playlist_id == playlist_id)
+            .order_by(entry.order, entry.id)
+            .options(
+                selectinload(entry.MusicFileEntryDB.details).selectinload(MusicFileDB.genres),
+                selectinload(entry.NestedPlaylistEntryDB.details),
+                selectinload(entry.LastFMEntryDB.details),
+                selectinload(entry.RequestedTrackEntryDB.details),
+            )
         )
 
     def get_all(self):
@@ -103,43 +139,14 @@ class PlaylistRepository(BaseRepository[PlaylistDB]):
         self.session.add(playlist_db)
         self.session.commit()
 
-        for entry in playlist.entries:
-            self.add_entry(playlist_db.id, entry)
+        self.insert_entries(playlist_db.id, playlist.entries)
 
         self.session.commit()
         self.session.refresh(playlist_db)
         return Playlist.from_orm(playlist_db)
 
     def add_entry(self, playlist_id: int, entry: PlaylistEntryBase, commit=False) -> None:
-        if entry.entry_type == "lastfm":
-            track = (
-                self.session.query(LastFMTrackDB)
-                .filter(LastFMTrackDB.url == entry.url)
-                .first()
-            )
-            if not track:
-                track = entry.to_db()
-                self.session.add(track)
-                self.session.commit()
-
-            entry.details = track
-        elif entry.entry_type == "requested":
-            track = (
-                self.session.query(RequestedTrackDB).filter(RequestedTrackDB.artist == entry.details.artist, RequestedTrackDB.title == entry.details.title).first()
-            )
-            if not track:
-                track = entry.to_db()
-                self.session.add(track)
-                self.session.commit()
-            
-            entry.details = track
-
-        this_playlist = (
-            self.session.query(PlaylistDB).filter(PlaylistDB.id == playlist_id).first()
-        )
-
-        playlist_entry = entry.to_playlist(playlist_id)
-        this_playlist.entries.append(playlist_entry)
+        self.insert_entries(playlist_id, [entry])
 
         if commit:
             self.session.commit()
@@ -153,41 +160,132 @@ class PlaylistRepository(BaseRepository[PlaylistDB]):
         if not entries:
             return Playlist(id=playlist_id, name="", entries=[])
 
-        for entry in entries:
-            self.add_entry(playlist_id, entry, commit=False)
-        
+        self.insert_entries(playlist_id, entries)
         self.session.commit()
-    
+
+    def insert_entries(self, playlist_id: int, entries: List[PlaylistEntryBase]) -> None:
+        """Append entries after the last one, without loading the playlist's entries.
+
+        Tracks are resolved with one lookup per track type, then the entry rows go in
+        with one executemany per table. Core inserts are used because the ORM flush
+        inserts joined-inheritance rows one at a time on SQLite.
+        """
+        if not entries:
+            return
+
+        self._resolve_tracks(entries)
+        self.session.flush()
+
+        next_order = self._next_order(playlist_id)
+        entries_table = PlaylistEntryDB.__table__
+        ids = dict(self.session.execute(
+            insert(entries_table).returning(entries_table.c.order, entries_table.c.id),
+            [
+                {"playlist_id": playlist_id, "entry_type": entry.entry_type, "order": next_order + i * ORDER_GAP}
+                for i, entry in enumerate(entries)
+            ],
+        ).all())
+
+        rows = defaultdict(list)
+        for i, entry in enumerate(entries):
+            model, column = ENTRY_DETAILS[entry.entry_type]
+            rows[model].append({"id": ids[next_order + i * ORDER_GAP], column: self._details_id(entry)})
+
+        for model, values in rows.items():
+            self.session.execute(insert(model.__table__), values)
+
+    def _details_id(self, entry: PlaylistEntryBase) -> Optional[int]:
+        if entry.entry_type == "music_file":
+            return entry.music_file_id
+        if entry.entry_type in ("lastfm", "requested"):
+            return entry.details.id
+        return None
+
+    def _next_order(self, playlist_id: int) -> int:
+        last = (
+            self.session.query(func.max(PlaylistEntryDB.order))
+            .filter(PlaylistEntryDB.playlist_id == playlist_id)
+            .scalar()
+        )
+        return 0 if last is None else last + ORDER_GAP
+
+    def _resolve_tracks(self, entries: List[PlaylistEntryBase]) -> None:
+        """Point Last.fm and requested entries at their stored tracks, creating the missing ones."""
+        lastfm = [e for e in entries if e.entry_type == "lastfm"]
+        if lastfm:
+            tracks = {
+                track.url: track
+                for track in self._lookup(LastFMTrackDB, LastFMTrackDB.url, {e.url for e in lastfm})
+            }
+            for entry in lastfm:
+                if entry.url not in tracks:
+                    tracks[entry.url] = entry.to_db()
+                    self.session.add(tracks[entry.url])
+                entry.details = tracks[entry.url]
+
+        requested = [e for e in entries if e.entry_type == "requested"]
+        if requested:
+            tracks = {
+                (track.artist, track.title): track
+                for track in self._lookup(RequestedTrackDB, RequestedTrackDB.title, {e.details.title for e in requested})
+            }
+            for entry in requested:
+                key = (entry.details.artist, entry.details.title)
+                if key not in tracks:
+                    tracks[key] = entry.to_db()
+                    self.session.add(tracks[key])
+                entry.details = tracks[key]
+
+    def _lookup(self, model, column, values: set) -> list:
+        values = list(values)
+        condition = [column.is_(None)] if None in values else []
+        values = [v for v in values if v is not None]
+
+        found = []
+        for start in range(0, max(len(values), 1), LOOKUP_BATCH_SIZE):
+            batch = values[start:start + LOOKUP_BATCH_SIZE]
+            found.extend(self.session.query(model).filter(or_(column.in_(batch), *condition)))
+            condition = []
+        return found
+
     def remove_entries(
         self, playlist_id: int, entries: List[int], undo=False
     ) -> None:
         if undo:
             return self.undo_remove_entries(playlist_id, entries)
         
-        playlist_entries = (
-            self._get_playlist_query(playlist_id, details=False)
-            .filter(self.model.id == playlist_id)
-            .first()
-        ).entries
-
-        for entry in playlist_entries:
-            if entry.order in entries:
-                self.session.delete(entry)
+        positions = [e if isinstance(e, int) else e.order for e in entries]
+        entry_ids = list(self._at_positions(playlist_id, positions))
+        for start in range(0, len(entry_ids), LOOKUP_BATCH_SIZE):
+            self._delete_entries(playlist_id, PlaylistEntryDB.id.in_(entry_ids[start:start + LOOKUP_BATCH_SIZE]))
 
         self.session.commit()
 
+    def _delete_entries(self, playlist_id: int, *conditions) -> None:
+        """Delete entries of the playlist matching conditions, and their rows in the per-type tables.
+
+        The other entries keep their keys, so nothing is shifted.
+        """
+        entries_table = PlaylistEntryDB.__table__
+        deleted = self.session.scalars(
+            delete(entries_table)
+            .where(entries_table.c.playlist_id == playlist_id, *conditions)
+            .returning(entries_table.c.id)
+        ).all()
+
+        # the per-type rows reference the entries with ON DELETE CASCADE, which SQLite
+        # only enforces with foreign keys turned on; batched, as replacing a whole
+        # playlist deletes all of its entries
+        for start in range(0, len(deleted), LOOKUP_BATCH_SIZE):
+            batch = deleted[start:start + LOOKUP_BATCH_SIZE]
+            for model, _ in ENTRY_DETAILS.values():
+                self.session.execute(delete(model.__table__).where(model.__table__.c.id.in_(batch)))
+
     def replace_entries(
         self, playlist_id: int, entries: List[PlaylistEntryBase]
     ) -> None:
         warnings.warn("use add/remove/reorder entries instead", DeprecationWarning)
-        current_records = (
-            self.session.query(PlaylistEntryDB)
-            .filter(PlaylistEntryDB.playlist_id == playlist_id)
-            .all()
-        )
-        for record in current_records:
-            self.session.delete(record)
-
+        self._delete_entries(playlist_id)
         self.session.commit()
 
         return self.add_entries(playlist_id, entries)
@@ -210,70 +308,143 @@ class PlaylistRepository(BaseRepository[PlaylistDB]):
         return m3u
     
     def get_playlist_entry_details(self, playlist_id: int, entry_ids: List[int]):
-        playlist = (
-            self._get_playlist_query(playlist_id, details=False)
-            .filter(PlaylistDB.id == playlist_id)
-            .join(PlaylistDB.entries)
-            .filter(PlaylistEntryDB.order.in_(entry_ids))
-            .first()
-        )
-        
-        if playlist is None:
+        positions = self._at_positions(playlist_id, entry_ids)
+        if not positions:
             return []
 
-        entries = [entry for entry in playlist.entries if entry.order in entry_ids]
+        entries = [
+            playlist_orm_to_response(e)
+            for e in self._entries_query(playlist_id).filter(PlaylistEntryDB.id.in_(list(positions)))
+        ]
+        for entry in entries:
+            entry.order = positions[entry.id]
+
+        return entries
+
+    def _at_positions(self, playlist_id: int, positions: List[int]) -> dict:
+        """Map the ids of the entries at the given positions to their positions.
+
+        Positions are counted along the (playlist_id, order) index, which covers the
+        query, so no entry rows are read.
+        """
+        ranked = (
+            select(
+                PlaylistEntryDB.id,
+                (func.row_number().over(order_by=PlaylistEntryDB.order) - 1).label("position"),
+            )
+            .where(PlaylistEntryDB.playlist_id == playlist_id)
+            .subquery()
+        )
+        rows = self.session.execute(select(ranked.c.id, ranked.c.position).where(ranked.c.position.in_(positions)))
+        return {row.id: row.position for row in rows}
+
+    def _entry_keys(self, playlist_id: int) -> List[tuple]:
+        """(id, order) of every entry in order, read from the (playlist_id, order) index."""
+        return self.session.execute(
+            select(PlaylistEntryDB.id, PlaylistEntryDB.order)
+            .where(PlaylistEntryDB.playlist_id == playlist_id)
+            .order_by(PlaylistEntryDB.order)
+        ).all()
 
-        return [playlist_orm_to_response(e) for e in entries]
-    
     def undo_reorder_entries(self, playlist_id: int, indices_to_reorder: List[int], new_index: int):
-        playlist_entries = (
-            self._get_playlist_query(playlist_id, details=False)
-            .filter(self.model.id == playlist_id)
-            .first()
-        ).entries
-
-        entries_to_move = []
-        for _ in indices_to_reorder:
-            entries_to_move.append(playlist_entries.pop(new_index))
-        
-        reversed_list = sorted(indices_to_reorder)
+        keys = self._entry_keys(playlist_id)
+        ids = [entry_id for entry_id, _ in keys]
 
-        for i in reversed_list:
-            entry = entries_to_move.pop(0)
-            playlist_entries.insert(i, entry)
+        moved = ids[new_index:new_index + len(indices_to_reorder)]
+        arrangement = ids[:new_index] + ids[new_index + len(moved):]
+        for position, entry_id in zip(sorted(indices_to_reorder), moved):
+            arrangement.insert(position, entry_id)
 
+        self._arrange(playlist_id, dict(keys), arrangement, moved)
         self.session.commit()
 
     def reorder_entries(self, playlist_id: int, indices_to_reorder: List[int], new_index: int):
-        playlist = (
-            self._get_playlist_query(playlist_id, details=False)
-            .filter(self.model.id == playlist_id)
-            .first()
-        )
+        keys = self._entry_keys(playlist_id)
+        ids = [entry_id for entry_id, _ in keys]
 
-        playlist_entries = playlist.entries
-
-        reversed_list = sorted(indices_to_reorder, reverse=True)
-
-        entries_to_move = [playlist_entries.pop(i) for i in reversed_list]
+        moving = set(indices_to_reorder)
+        moved = [ids[i] for i in sorted(moving)]
+        rest = [entry_id for i, entry_id in enumerate(ids) if i not in moving]
 
         # move block of entries to new index
-        for entry in entries_to_move:
-            playlist_entries.insert(new_index, entry)
-        
+        self._arrange(playlist_id, dict(keys), rest[:new_index] + moved + rest[new_index:], moved)
         self.session.commit()
 
-    def undo_add_entries(self, playlist_id: int, entries: List[PlaylistEntryBase]):
-        playlist = self._get_playlist_query(playlist_id).first()
-        if playlist is None:
+    def _arrange(self, playlist_id: int, keys: dict, arrangement: List[int], moved: List[int]):
+        """Give the moved entries keys between their new neighbours; only their rows are updated.
+
+        When a gap between neighbours has run out, the whole playlist is spaced out again.
+        """
+        moved = set(moved)
+        new_keys = {}
+        run = []
+        lo = -1
+        for entry_id in arrangement + [None]:
+            if entry_id in moved:
+                run.append(entry_id)
+                continue
+
+            hi = keys[entry_id] if entry_id is not None else None
+            if run:
+                allocated = self._allocate(lo, hi, len(run))
+                if allocated is None:
+                    self._rebalance(playlist_id, arrangement)
+                    return
+                new_keys.update(zip(run, allocated))
+                run = []
+            lo = hi
+
+        self._write_keys(playlist_id, new_keys)
+
+    def _park(self, *conditions):
+        # move rows to negative keys first, so the new keys never collide on the unique index
+        self.session.execute(
+            update(PlaylistEntryDB)
+            .where(*conditions)
+            .values(order=-PlaylistEntryDB.id)
+            .execution_options(synchronize_session=False)
+        )
+
+    def _allocate(self, lo: int, hi: Optional[int], count: int) -> Optional[List[int]]:
+        """count increasing keys strictly between lo and hi (no upper bound if hi is None)."""
+        if hi is None:
+            return [lo + ORDER_GAP * (i + 1) for i in range(count)]
+
+        step = (hi - lo) // (count + 1)
+        if step == 0:
             return None
-        
-        num_entries_to_remove = len(entries)
-        entries_to_remove = playlist.entries[-num_entries_to_remove:]
+        return [lo + step * (i + 1) for i in range(count)]
+
+    def _rebalance(self, playlist_id: int, arrangement: List[int]):
+        logger.info(f"Spacing out order keys of playlist {playlist_id}")
+        self._park(PlaylistEntryDB.playlist_id == playlist_id)
+        self.session.execute(
+            update(PlaylistEntryDB),
+            [{"id": entry_id, "order": i * ORDER_GAP} for i, entry_id in enumerate(arrangement)],
+        )
+
+    def _write_keys(self, playlist_id: int, keys: dict):
+        if not keys:
+            return
 
-        for e in entries_to_remove:
-            self.session.delete(e)
+        self._park(PlaylistEntryDB.playlist_id == playlist_id, PlaylistEntryDB.id.in_(list(keys)))
+        self.session.execute(
+            update(PlaylistEntryDB),
+            [{"id": entry_id, "order": order} for entry_id, order in keys.items()],
+        )
 
+    def undo_add_entries(self, playlist_id: int, entries: List[PlaylistEntryBase]):
+        if not entries:
+            return
+
+        # the added entries are the last ones, read backwards off the (playlist_id, order) index
+        last = (
+            select(PlaylistEntryDB.id)
+            .where(PlaylistEntryDB.playlist_id == playlist_id)
+            .order_by(PlaylistEntryDB.order.desc())
+            .limit(len(entries))
+        )
+        self._delete_entries(playlist_id, PlaylistEntryDB.id.in_(last))
         self.session.commit()
     
     def undo_remove_entries(self, playlist_id: int, entries: List[PlaylistEntryBase]):
@@ -0,0 +1,53 @@
+from .base import BaseRepository
+from models import SearchTermDB, SearchTermTrigramDB
+from typing import Iterable, List, Set
+from sqlalchemy import insert, func
+from fuzzy import trigrams, edit_distance, max_typos
+from normalization import prefix_range
+
+# terms sharing the most trigrams with a word that are checked by edit distance
+FUZZY_CANDIDATES = 100
+
+
+class SearchTermRepository(BaseRepository[SearchTermDB]):
+    def __init__(self, session):
+        super().__init__(session, SearchTermDB)
+        # terms already in the vocabulary, so repeated words are not sent again
+        self.known: Set[str] = set()
+
+    def add(self, terms: Iterable[str]):
+        """Add terms that are not in the vocabulary yet, along with their trigrams."""
+        new_terms = sorted({term for term in terms if term and term not in self.known})
+        if not new_terms:
+            return
+
+        self.known.update(new_terms)
+        inserted = self.session.execute(
+            insert(SearchTermDB).prefix_with("OR IGNORE").returning(SearchTermDB.id, SearchTermDB.term),
+            [{"term": term} for term in new_terms],
+        ).all()
+
+        rows = [{"trigram": trigram, "term_id": term_id} for term_id, term in inserted for trigram in trigrams(term)]
+        if rows:
+            self.session.execute(insert(SearchTermTrigramDB), rows)
+
+    def has_prefix(self, word: str) -> bool:
+        """Whether some vocabulary term is word or starts with it."""
+        first, last = prefix_range(word)
+        return self.session.query(SearchTermDB.id).filter(SearchTermDB.term >= first, SearchTermDB.term < last).first() is not None
+
+    def similar(self, word: str, limit: int = 5) -> List[str]:
+        """Vocabulary terms within a few typos of word, closest first."""
+        shared = func.count().label("shared")
+        candidates = (
+            self.session.query(SearchTermDB.term, shared)
+            .join(SearchTermTrigramDB, SearchTermTrigramDB.term_id == SearchTermDB.id)
+            .filter(SearchTermTrigramDB.trigram.in_(trigrams(word)))
+            .group_by(SearchTermDB.id)
+            .order_by(shared.desc())
+            .limit(FUZZY_CANDIDATES)
+        )
+
+        allowed = max_typos(word)
+        ranked = sorted((edit_distance(word, term, allowed), -count, term) for term, count in candidates)
+        return [term for distance, _, term in ranked if distance <= allowed][:limit]
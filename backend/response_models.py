@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional, Union, Literal
+from typing import Dict, List, Optional, Union, Literal
 from enum import Enum
 from datetime import datetime
 from models import (
@@ -64,7 +64,7 @@ class MusicFile(MusicEntity, TrackDetails):
             year=obj.year,
             length=obj.length,
             publisher=obj.publisher,
-            genres=[str(s.genre) for s in obj.genres],
+            genres=[str(s.name) for s in obj.genres],
             missing=obj.missing,
         )
 
@@ -122,7 +122,7 @@ class MusicFileEntry(PlaylistEntryBase):
                 year=obj.details.year,
                 length=obj.details.length,
                 publisher=obj.details.publisher,
-                genres=[str(s.genre) for s in obj.details.genres],
+                genres=[str(s.name) for s in obj.details.genres],
                 missing=obj.details.missing,
             ) if obj.details is not None else None,
         )
@@ -160,6 +160,14 @@ class LastFMTrack(MusicEntity, TrackDetails):
     music_file_id: Optional[int] = None  # linked music file if available
 
 
+class SuggestedTrack(TrackDetails):
+    music_file_id: Optional[int] = None  # linked music file if available
+
+
+class SimilarTracks(BaseModel):
+    tracks: List[SuggestedTrack] = []
+
+
 class LastFMEntry(PlaylistEntryBase):
     entry_type: Literal["lastfm"]
     url: str
@@ -266,9 +274,18 @@ class Playlist(PlaylistBase):
             else:
                 raise ValueError(f"Unknown entry type: {entry.entry_type}")
 
+        # entries are stored with sparse order keys; clients see positions
+        for position, entry in enumerate(entries):
+            entry.order = position
+
         return cls(id=obj.id, name=obj.name, entries=entries)
 
 
+class PlaylistEntriesPage(BaseModel):
+    entries: List[PlaylistEntry]
+    next_after_order: Optional[int] = None
+
+
 class SearchQuery(BaseModel):
     full_search: Optional[str] = None  # title, artist, and album are scored
     album: Optional[str] = None
@@ -276,12 +293,67 @@ class SearchQuery(BaseModel):
     artist: Optional[str] = None
     limit: Optional[int] = 50
 
+class Genre(BaseModel):
+    name: str
+    count: int
+
+class Completion(BaseModel):
+    value: str
+    count: int
+
+class Completions(BaseModel):
+    artists: List[Completion]
+    albums: List[Completion]
+    titles: List[Completion]
+
+class AutocompleteStats(BaseModel):
+    ready: bool
+    files: int
+    values: Dict[str, int]
+    keys: int
+    pending_keys: int
+    memory_bytes: int
+    built_at: Optional[datetime] = None
+    refreshed_at: Optional[datetime] = None
+    build_seconds: float = 0
+
+class FacetCount(BaseModel):
+    value: str
+    count: int
+    artist: Optional[str] = None
+
+class FacetResults(BaseModel):
+    results: List[MusicFile]
+    facets: Dict[str, List[FacetCount]]
+
 class ScanResults(BaseModel):
     files_scanned: int
     files_indexed: int
     new_files_added: int
     files_updated: int
     files_missing: int
+    workers: int = 1
+    directories_skipped: int = 0
+    files_found: int = 0
+    files_moved: int = 0
+    scan_seconds: float = 0
+    prune_seconds: float = 0
+    scan_generation: int = 0
+    resumed: bool = False
+
+class ScanJobStatus(BaseModel):
+    id: str
+    full: bool
+    status: Literal["running", "completed", "failed", "cancelled"]
+    phase: str
+    files_seen: int
+    files_indexed: int
+    rate: float  # files walked per second
+    eta_seconds: Optional[float] = None
+    started_at: datetime
+    finished_at: Optional[datetime] = None
+    results: Optional[ScanResults] = None
+    error: Optional[str] = None
 
 class LibraryStats(BaseModel):
     trackCount: int
@@ -0,0 +1,123 @@
+import os
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, List, Optional
+from response_models import ScanJobStatus, ScanResults
+from scanner import ScanCancelled, ScanProgress, run_library_scan
+
+logger = logging.getLogger(__name__)
+
+# finished jobs kept around for their results
+MAX_FINISHED_JOBS = 20
+
+
+class ScanAlreadyRunning(Exception):
+    def __init__(self, job: "ScanJob"):
+        super().__init__(f"Scan {job.id} is already running")
+        self.job = job
+
+
+class ScanJob:
+    def __init__(self, full: bool):
+        self.id = uuid.uuid4().hex
+        self.full = full
+        self.status = "running"
+        self.progress = ScanProgress()
+        self.results: Optional[ScanResults] = None
+        self.error: Optional[str] = None
+        self.started_at = datetime.now()
+        self.finished_at: Optional[datetime] = None
+        self.done = threading.Event()
+
+    def to_status(self) -> ScanJobStatus:
+        return ScanJobStatus(
+            id=self.id,
+            full=self.full,
+            status=self.status,
+            phase=self.progress.phase,
+            files_seen=self.progress.files_seen,
+            files_indexed=self.progress.files_indexed,
+            rate=self.progress.rate,
+            eta_seconds=self.progress.eta_seconds,
+            started_at=self.started_at,
+            finished_at=self.finished_at,
+            results=self.results,
+            error=self.error,
+        )
+
+
+def scan_music_path(full: bool, progress: ScanProgress) -> ScanResults:
+    return ScanResults(**run_library_scan(os.getenv("MUSIC_PATH", "/music"), full=full, progress=progress))
+
+
+class ScanJobManager:
+    """Runs library scans on a background thread, one at a time."""
+
+    def __init__(self, run_scan: Callable[[bool, ScanProgress], ScanResults] = scan_music_path):
+        self.run_scan = run_scan
+        self.lock = threading.Lock()
+        self.jobs: "OrderedDict[str, ScanJob]" = OrderedDict()
+        self.current: Optional[ScanJob] = None
+        # held while a scan runs; the library watcher takes it to apply its batches in between
+        self.library_lock = threading.Lock()
+
+    def start(self, full=False) -> ScanJob:
+        with self.lock:
+            if self.current is not None:
+                raise ScanAlreadyRunning(self.current)
+
+            job = ScanJob(full)
+            self.current = job
+            self.jobs[job.id] = job
+            self._trim()
+
+        threading.Thread(target=self._run, args=(job,), name=f"scan-{job.id}", daemon=True).start()
+        return job
+
+    def run(self, full=False) -> ScanJob:
+        """Start a scan and block until it has finished."""
+        job = self.start(full)
+        job.done.wait()
+        return job
+
+    def get(self, job_id: str) -> Optional[ScanJob]:
+        return self.jobs.get(job_id)
+
+    def list(self) -> List[ScanJob]:
+        return list(reversed(self.jobs.values()))
+
+    def cancel(self, job_id: str) -> Optional[ScanJob]:
+        job = self.jobs.get(job_id)
+        if job is not None and job.status == "running":
+            job.progress.cancel()
+        return job
+
+    def _run(self, job: ScanJob):
+        try:
+            with self.library_lock:
+                job.results = self.run_scan(job.full, job.progress)
+            job.status = "completed"
+        except ScanCancelled:
+            logger.info(f"Scan {job.id} cancelled")
+            job.status = "cancelled"
+        except Exception as e:
+            logger.error(f"Scan {job.id} failed: {e}", exc_info=True)
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.progress.phase = "done"
+            job.finished_at = datetime.now()
+            with self.lock:
+                self.current = None
+            job.done.set()
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job is not self.current]
+        for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
+
+
+scan_job_manager = ScanJobManager()
@@ -0,0 +1,955 @@
+import os
+import pathlib
+import logging
+import time
+import hashlib
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import get_context
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+import mutagen
+from mutagen.easyid3 import EasyID3
+from mutagen.flac import FLAC
+from tqdm import tqdm
+from sqlalchemy import insert, update, delete, and_, func
+from database import Database
+from models import MusicFileDB, LibraryDirectoryDB, ScanCheckpointDB, track_match_keys
+from repositories.genre import GenreRepository
+from repositories.search_term import SearchTermRepository
+from normalization import words
+from tag_reader import read_tags
+
+SUPPORTED_FILETYPES = (".mp3", ".flac", ".wav", ".ogg", ".m4a")
+
+# number of files handed to a worker process at a time
+EXTRACT_CHUNK_SIZE = 64
+
+# bytes read from each end of a file for the move-detection hash
+PARTIAL_HASH_BYTES = 64 * 1024
+
+# number of rows written per bulk INSERT/UPDATE
+SCAN_BATCH_SIZE = int(os.getenv("SCAN_BATCH_SIZE", "500"))
+
+# called with the results once a scan or a batch of watcher changes has been committed
+library_listeners: List[Callable[[dict], None]] = []
+
+
+def on_library_changed(listener: Callable[[dict], None]) -> Callable[[dict], None]:
+    library_listeners.append(listener)
+    return listener
+
+
+def notify_library_changed(results: dict):
+    for listener in list(library_listeners):
+        try:
+            listener(results)
+        except Exception as e:
+            logging.error(f"Library change listener {listener} failed: {e}", exc_info=True)
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def get_scan_workers() -> int:
+    workers = os.getenv("SCAN_WORKERS")
+    if workers:
+        return max(1, int(workers))
+
+    return os.cpu_count() or 1
+
+
+def extract_metadata(file_path, extractor):
+    try:
+        audio = extractor(file_path)
+        result = {
+            "title": audio.get("title", [None])[0],
+            "artist": audio.get("artist", [None])[0],
+            "album": audio.get("album", [None])[0],
+            "album_artist": audio.get("albumartist", [None])[0],
+            "year": audio.get("date", [None])[0],
+            "length": int(audio.info.length) if hasattr(audio, "info") else None,
+            "publisher": audio.get("organization", [None])[0],
+            "kind": audio.mime[0] if hasattr(audio, "mime") else None,
+            "genres": audio.get("genre", list()),
+        }
+        return result
+    except Exception as e:
+        logging.error(f"Failed to read metadata for {file_path}: {e}")
+
+    return {}
+
+
+def read_metadata(full_path: str) -> dict:
+    """Read tags for a single file; runs in the scan worker processes, so it must only return plain data.
+
+    Tags are read from the header region by tag_reader, falling back to mutagen for files
+    it cannot parse.
+    """
+    try:
+        metadata = read_tags(full_path)
+        if metadata is not None:
+            return metadata
+    except Exception as e:
+        logging.debug(f"Falling back to mutagen for {full_path}: {e}")
+
+    if full_path.lower().endswith(".mp3"):
+        return extract_metadata(full_path, EasyID3)
+    elif full_path.lower().endswith(".flac"):
+        return extract_metadata(full_path, FLAC)
+    elif full_path.lower().endswith(SUPPORTED_FILETYPES):
+        return extract_metadata(full_path, lambda path: mutagen.File(path, easy=True))
+
+    logging.debug(f"Skipping file {full_path} with unsupported file type")
+    return {}
+
+
+def partial_hash(full_path: str) -> Optional[str]:
+    """Hash the size plus the first and last PARTIAL_HASH_BYTES of a file."""
+    try:
+        with open(full_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+            digest.update(f.read(PARTIAL_HASH_BYTES))
+            if size > 2 * PARTIAL_HASH_BYTES:
+                f.seek(-PARTIAL_HASH_BYTES, os.SEEK_END)
+                digest.update(f.read(PARTIAL_HASH_BYTES))
+            return digest.hexdigest()
+    except OSError as e:
+        logging.warning(f"Failed to hash {full_path}: {e}")
+        return None
+
+
+def read_file(full_path: str) -> Tuple[dict, Optional[str]]:
+    """Scan worker entry point: the file's tags plus its partial content hash."""
+    metadata = read_metadata(full_path)
+    return metadata, partial_hash(full_path) if metadata else None
+
+
+def create_extractor_pool(workers: int) -> Optional[ProcessPoolExecutor]:
+    if workers <= 1:
+        return None
+
+    # spawn rather than fork: the server process runs threads that must not be duplicated
+    return ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"))
+
+
+def extract_all(paths: List[str], executor: Optional[ProcessPoolExecutor] = None):
+    """Yield (path, (metadata, partial_hash)) pairs in input order, parsing tags on the pool when one is given."""
+    if executor is None or len(paths) <= 1:
+        for path in paths:
+            yield path, read_file(path)
+        return
+
+    yield from zip(paths, executor.map(read_file, paths, chunksize=EXTRACT_CHUNK_SIZE))
+
+
+class WalkEntry(NamedTuple):
+    path: str
+    mtime: Optional[float]  # None when the file sits in a directory skipped as unchanged
+    size: Optional[int]
+    inode: Optional[int] = None
+    device: Optional[int] = None
+
+    @classmethod
+    def from_stat(cls, path: str, stat: os.stat_result) -> "WalkEntry":
+        # SQLite integers are signed 64-bit; some network filesystems report larger inode numbers
+        inode = stat.st_ino if stat.st_ino < 2**63 else None
+        return cls(path, stat.st_mtime, stat.st_size, inode, stat.st_dev)
+
+
+class DirectoryState:
+    """Directory mtimes recorded by the previous scan and the ones observed during this walk.
+
+    Directories up to and including resume_after, in walk order, were committed by an
+    interrupted scan and are skipped like unchanged ones if their mtime still matches.
+    """
+
+    def __init__(
+        self,
+        known: Optional[Dict[str, Tuple[int, float]]] = None,
+        skip_unchanged=True,
+        resume_after: Optional[Tuple[str, ...]] = None,
+    ):
+        self.known = known or {}
+        self.skip_unchanged = skip_unchanged
+        self.resume_after = resume_after
+        self.seen: Set[str] = set()
+        # (path, mtime, file_count) of directories walked since the last save, in walk order
+        self.pending: List[Tuple[str, float, int]] = []
+        self.last_key: Optional[Tuple[str, ...]] = None
+        self.directories_skipped = 0
+
+    def is_unchanged(self, path: str, mtime: float, key: Tuple[str, ...] = ()) -> bool:
+        record = self.known.get(path)
+        if record is None or record[1] != mtime:
+            return False
+        return self.skip_unchanged or (self.resume_after is not None and key <= self.resume_after)
+
+    def walked(self, path: str, mtime: float, file_count: int, key: Tuple[str, ...]):
+        self.seen.add(path)
+        self.pending.append((path, mtime, file_count))
+        self.last_key = key
+
+
+def walk_music_files(
+    directory: str,
+    directories: Optional[DirectoryState] = None,
+    unreadable: Optional[Set[str]] = None,
+) -> Iterator[WalkEntry]:
+    """Yield supported files under directory using the stat info from a single os.scandir pass.
+
+    The walk is depth-first in name order, so a directory's position can be compared by the
+    tuple of its path components relative to directory. When a DirectoryState is given,
+    files in directories whose mtime matches the previous scan are yielded without being
+    stat'ed. Subdirectories are still descended into, since a change below does not touch
+    the parent's mtime. Paths that could not be listed or stat'ed are added to unreadable,
+    so their files are not taken for deleted.
+    """
+    if unreadable is None:
+        unreadable = set()
+
+    try:
+        stack = [(str(directory), os.stat(directory).st_mtime, ())]
+    except OSError as e:
+        logging.error(f"Failed to stat directory {directory}: {e}")
+        unreadable.add(str(directory))
+        return
+
+    while stack:
+        current, current_mtime, key = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            logging.warning(f"Failed to list directory {current}: {e}")
+            unreadable.add(current)
+            continue
+
+        unchanged = directories is not None and directories.is_unchanged(current, current_mtime, key)
+        if unchanged:
+            directories.directories_skipped += 1
+
+        subdirectories = []
+        file_count = 0
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append((entry.path, entry.stat(follow_symlinks=False).st_mtime, key + (entry.name,)))
+                elif entry.name.lower().endswith(SUPPORTED_FILETYPES) and entry.is_file():
+                    file_count += 1
+                    if unchanged:
+                        yield WalkEntry(entry.path, None, None)
+                    else:
+                        yield WalkEntry.from_stat(entry.path, entry.stat())
+            except OSError as e:
+                logging.warning(f"Failed to stat {entry.path}: {e}")
+                unreadable.add(entry.path)
+
+        if directories is not None:
+            directories.walked(current, current_mtime, file_count, key)
+
+        stack.extend(reversed(subdirectories))
+
+
+def load_directory_state(db, full=False, resume_after: Optional[Tuple[str, ...]] = None) -> DirectoryState:
+    known = {
+        row.path: (row.id, row.mtime)
+        for row in db.query(LibraryDirectoryDB.path, LibraryDirectoryDB.id, LibraryDirectoryDB.mtime)
+    }
+
+    return DirectoryState(known, skip_unchanged=not full, resume_after=resume_after)
+
+
+def save_directory_state(db, directories: DirectoryState, final=False):
+    """Write back directories walked since the last save whose mtime changed.
+
+    Directories that no longer exist are only dropped on the final save, once the walk
+    has seen everything.
+    """
+    now = datetime.now()
+    inserts = []
+    updates = []
+    for path, mtime, file_count in directories.pending:
+        record = directories.known.get(path)
+        if record is None:
+            inserts.append({"path": path, "mtime": mtime, "file_count": file_count, "last_scanned": now})
+        elif record[1] != mtime or not directories.skip_unchanged:
+            updates.append({"id": record[0], "mtime": mtime, "file_count": file_count, "last_scanned": now})
+    directories.pending = []
+
+    for batch in batched(inserts, SCAN_BATCH_SIZE):
+        db.execute(insert(LibraryDirectoryDB), batch)
+    for batch in batched(updates, SCAN_BATCH_SIZE):
+        db.execute(update(LibraryDirectoryDB), batch)
+
+    if final:
+        removed = [record[0] for path, record in directories.known.items() if path not in directories.seen]
+        for batch in batched(removed, SCAN_BATCH_SIZE):
+            db.execute(delete(LibraryDirectoryDB).where(LibraryDirectoryDB.id.in_(batch)))
+
+
+def start_checkpoint(db, root: str, full: bool) -> Tuple[ScanCheckpointDB, Optional[Tuple[str, ...]]]:
+    """Load the checkpoint for root and return it with the directory to resume after.
+
+    A full scan that did not complete is picked up by the next full scan; any other scan
+    starts a new generation. Incremental scans need no resume point, since the directory
+    records committed so far already let them skip the finished part of the walk.
+    """
+    now = datetime.now()
+    checkpoint = db.query(ScanCheckpointDB).filter(ScanCheckpointDB.root == root).one_or_none()
+    if checkpoint is None:
+        checkpoint = ScanCheckpointDB(root=root, generation=0)
+        db.add(checkpoint)
+    elif full and checkpoint.full and not checkpoint.completed:
+        checkpoint.updated_at = now
+        if checkpoint.last_directory is None:
+            return checkpoint, None
+
+        logging.info(f"Resuming scan {checkpoint.generation} of {root} after '{checkpoint.last_directory}'")
+        parts = checkpoint.last_directory.split(os.sep) if checkpoint.last_directory else []
+        return checkpoint, tuple(parts)
+
+    checkpoint.generation += 1
+    checkpoint.full = full
+    checkpoint.last_directory = None
+    checkpoint.started_at = now
+    checkpoint.updated_at = now
+    checkpoint.completed = False
+
+    return checkpoint, None
+
+
+class IndexedFile(NamedTuple):
+    id: int
+    last_scanned: Optional[datetime]
+    missing: bool
+    size: Optional[int] = None
+    mtime: Optional[float] = None
+    inode: Optional[int] = None
+    device: Optional[int] = None
+    partial_hash: Optional[str] = None
+
+
+def load_file_index(db, paths: Optional[Iterable[str]] = None) -> Dict[str, IndexedFile]:
+    """Load path -> (id, last_scanned, missing, fingerprint) for the whole library in one query, or for the given paths only."""
+    query = db.query(
+        MusicFileDB.path,
+        MusicFileDB.id,
+        MusicFileDB.last_scanned,
+        MusicFileDB.missing,
+        MusicFileDB.size,
+        MusicFileDB.mtime,
+        MusicFileDB.inode,
+        MusicFileDB.device,
+        MusicFileDB.partial_hash,
+    )
+
+    if paths is None:
+        rows = query.all()
+    else:
+        rows = [
+            row
+            for batch in batched(paths, SCAN_BATCH_SIZE)
+            for row in query.filter(MusicFileDB.path.in_(batch))
+        ]
+
+    return {
+        row.path: IndexedFile(
+            row.id, row.last_scanned, bool(row.missing),
+            row.size, row.mtime, row.inode, row.device, row.partial_hash,
+        )
+        for row in rows
+    }
+
+
+class MoveDetector:
+    """Matches a path the index has never seen to an indexed file that has disappeared.
+
+    Files keep their inode, size and mtime when renamed within a filesystem; copies to
+    another filesystem keep size and mtime, and are confirmed with the partial hash.
+    """
+
+    def __init__(self, index: Dict[str, IndexedFile]):
+        self.index = index
+        self._by_inode = None
+        self._by_size = None
+
+    def _build(self):
+        self._by_inode = {}
+        self._by_size = defaultdict(list)
+        for path, indexed in self.index.items():
+            if indexed.size is None or indexed.mtime is None:
+                continue
+            if indexed.inode is not None:
+                self._by_inode[(indexed.device, indexed.inode)] = path
+            self._by_size[(indexed.size, int(indexed.mtime))].append(path)
+
+    def _vanished(self, path: str) -> bool:
+        indexed = self.index.get(path)
+        return indexed is not None and (indexed.missing or not os.path.exists(path))
+
+    def match(self, entry: WalkEntry) -> Optional[str]:
+        if entry.size is None:
+            return None
+        if self._by_inode is None:
+            self._build()
+
+        old_path = self._by_inode.get((entry.device, entry.inode))
+        if old_path is not None and old_path != entry.path:
+            indexed = self.index[old_path]
+            # inodes get reused, so the size and mtime have to agree as well
+            if indexed.size == entry.size and int(indexed.mtime) == int(entry.mtime) and self._vanished(old_path):
+                return old_path
+
+        candidates = [
+            path for path in self._by_size.get((entry.size, int(entry.mtime)), [])
+            if path != entry.path and self.index[path].partial_hash is not None and self._vanished(path)
+        ]
+        if candidates:
+            content_hash = partial_hash(entry.path)
+            for path in candidates:
+                if self.index[path].partial_hash == content_hash:
+                    return path
+
+        return None
+
+    def moved(self, old_path: str, entry: WalkEntry):
+        indexed = self.index.pop(old_path)
+        self.index[entry.path] = indexed._replace(
+            missing=False, size=entry.size, mtime=entry.mtime, inode=entry.inode, device=entry.device
+        )
+        if self._by_inode is not None:
+            self._by_inode.pop((indexed.device, indexed.inode), None)
+            self._by_size[(indexed.size, int(indexed.mtime))].remove(old_path)
+
+
+def _in_directory(column, directory: str):
+    # range comparison instead of LIKE so paths containing % or _ match literally
+    prefix = directory.rstrip(os.sep) + os.sep
+    return and_(column >= prefix, column < prefix[:-1] + chr(ord(os.sep) + 1))
+
+
+def fingerprint_row(entry: WalkEntry, content_hash: Optional[str] = None) -> dict:
+    row = {"size": entry.size, "mtime": entry.mtime, "inode": entry.inode, "device": entry.device}
+    if content_hash is not None:
+        row["partial_hash"] = content_hash
+    return row
+
+
+def metadata_to_row(metadata: dict) -> dict:
+    return {
+        "title": metadata.get("title"),
+        "artist": metadata.get("artist"),
+        "album": metadata.get("album"),
+        "album_artist": metadata.get("album_artist"),
+        "year": metadata.get("year"),
+        "length": metadata.get("length"),
+        "publisher": metadata.get("publisher"),
+        "kind": metadata.get("kind"),
+        **track_match_keys(metadata.get("title"), metadata.get("artist"), metadata.get("album"), metadata.get("album_artist")),
+    }
+
+
+class ScanWriter:
+    """Buffers scanned files and writes them as bulk INSERT/UPDATE statements."""
+
+    def __init__(self, db, batch_size: int = None):
+        self.db = db
+        self.batch_size = batch_size or SCAN_BATCH_SIZE
+        self.genres = GenreRepository(db)
+        self.search_terms = SearchTermRepository(db)
+        self.inserts = []
+        self.updates = []
+        self.moves = []
+
+    def add(self, entry: WalkEntry, metadata: dict, content_hash: Optional[str] = None):
+        self.inserts.append((entry, metadata, content_hash))
+        if len(self.inserts) >= self.batch_size:
+            self.flush()
+
+    def update(self, music_file_id: int, entry: WalkEntry, metadata: dict, content_hash: Optional[str] = None):
+        self.updates.append((music_file_id, entry, metadata, content_hash))
+        if len(self.updates) >= self.batch_size:
+            self.flush()
+
+    def move(self, music_file_id: int, entry: WalkEntry):
+        """Point an existing row at its new path without touching its tags."""
+        self.moves.append((music_file_id, entry))
+        if len(self.moves) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        now = datetime.now()
+        written = [metadata for _, metadata, _ in self.inserts] + [metadata for _, _, metadata, _ in self.updates]
+        self.search_terms.add(
+            word
+            for metadata in written
+            for word in words(metadata.get("title"), metadata.get("artist"), metadata.get("album"))
+        )
+
+        if self.inserts:
+            rows = [
+                {
+                    "path": entry.path,
+                    "missing": False,
+                    "last_scanned": now,
+                    **fingerprint_row(entry, content_hash),
+                    **metadata_to_row(metadata),
+                }
+                for entry, metadata, content_hash in self.inserts
+            ]
+            ids = self.db.execute(
+                insert(MusicFileDB).returning(MusicFileDB.id, sort_by_parameter_order=True),
+                rows,
+            ).scalars().all()
+
+            self.genres.link(zip(ids, (metadata.get("genres", []) for _, metadata, _ in self.inserts)))
+            self.inserts = []
+
+        if self.moves:
+            self.db.execute(
+                update(MusicFileDB),
+                [
+                    {"id": music_file_id, "path": entry.path, "missing": False, **fingerprint_row(entry)}
+                    for music_file_id, entry in self.moves
+                ],
+            )
+            self.moves = []
+
+        if self.updates:
+            ids = [music_file_id for music_file_id, *_ in self.updates]
+            self.db.execute(
+                update(MusicFileDB),
+                [
+                    {
+                        "id": music_file_id,
+                        "missing": False,
+                        "last_scanned": now,
+                        **fingerprint_row(entry, content_hash),
+                        **metadata_to_row(metadata),
+                    }
+                    for music_file_id, entry, metadata, content_hash in self.updates
+                ],
+            )
+            self.genres.unlink(ids)
+            self.genres.link((music_file_id, metadata.get("genres", [])) for music_file_id, _, metadata, _ in self.updates)
+            self.updates = []
+
+
+class ScanCancelled(Exception):
+    pass
+
+
+class ScanProgress:
+    """Live counters for a running scan, written by the scanner and read by the scan job endpoints."""
+
+    def __init__(self):
+        self.phase = "pending"
+        self.files_seen = 0
+        self.files_indexed = 0
+        self.estimated_total: Optional[int] = None
+        self.started_at = time.time()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise ScanCancelled()
+
+    @property
+    def rate(self) -> float:
+        """Files walked per second."""
+        elapsed = time.time() - self.started_at
+        return self.files_seen / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta_seconds(self) -> Optional[float]:
+        # the previous library size is the best guess at how many files the walk will find
+        if self.phase != "scanning" or not self.estimated_total or not self.rate:
+            return None
+        return max(self.estimated_total - self.files_seen, 0) / self.rate
+
+
+class ScanStats:
+    def __init__(self, seen_paths: Optional[Set[str]] = None, progress: Optional[ScanProgress] = None):
+        self.seen_paths = seen_paths
+        self.progress = progress
+        self.files_seen = 0
+        self.files_skipped = 0
+        self.new_adds = 0
+        self.files_moved = 0
+        self.found_ids = []
+
+
+def _files_to_index(
+    entries: Iterable[WalkEntry],
+    index: Dict[str, IndexedFile],
+    full: bool,
+    stats: ScanStats,
+    writer: ScanWriter,
+    moves: Optional[MoveDetector] = None,
+):
+    """Filter walked files down to the ones whose tags need to be (re)read.
+
+    Files recognised as moved are written straight away as path updates.
+    """
+    for entry in entries:
+        stats.files_seen += 1
+        if stats.seen_paths is not None:
+            stats.seen_paths.add(entry.path)
+        if stats.progress is not None:
+            stats.progress.files_seen = stats.files_seen
+            stats.progress.check_cancelled()
+
+        existing_file = index.get(entry.path)
+
+        if entry.mtime is None:
+            # the directory is unchanged since the last scan, so indexed files can be skipped outright
+            if existing_file and not existing_file.missing:
+                stats.files_skipped += 1
+                continue
+
+            try:
+                stat = os.stat(entry.path)
+            except OSError as e:
+                logging.warning(f"Failed to stat {entry.path}: {e}")
+                if stats.seen_paths is not None:
+                    stats.seen_paths.discard(entry.path)
+                continue
+            entry = WalkEntry.from_stat(entry.path, stat)
+
+        if existing_file is None and moves is not None:
+            old_path = moves.match(entry)
+            if old_path is not None:
+                logging.debug(f"Detected move of {old_path} to {entry.path}")
+                writer.move(index[old_path].id, entry)
+                moves.moved(old_path, entry)
+                stats.files_moved += 1
+                continue
+
+        last_modified_time = datetime.fromtimestamp(entry.mtime)
+
+        if existing_file and existing_file.missing:
+            stats.found_ids.append(existing_file.id)
+        elif (
+            (not full)
+            and existing_file
+            and existing_file.last_scanned is not None
+            and existing_file.last_scanned >= last_modified_time
+        ):
+            stats.files_skipped += 1
+            continue  # Skip files that have not changed
+
+        yield entry, existing_file
+
+
+def update_checkpoint(db, checkpoint_id: int, **values):
+    db.execute(
+        update(ScanCheckpointDB)
+        .where(ScanCheckpointDB.id == checkpoint_id)
+        .values(updated_at=datetime.now(), **values)
+    )
+
+
+def commit_chunk(db, writer: ScanWriter, directories: DirectoryState, checkpoint_id: int):
+    """Write out everything buffered so far and move the checkpoint past the finished directories."""
+    writer.flush()
+    save_directory_state(db, directories)
+    if directories.last_key is not None:
+        update_checkpoint(db, checkpoint_id, last_directory=os.sep.join(directories.last_key))
+    db.commit()
+
+
+def scan_directory(
+    directory: str,
+    full=False,
+    workers: int = None,
+    seen_paths: Optional[Set[str]] = None,
+    progress: Optional[ScanProgress] = None,
+    unreadable: Optional[Set[str]] = None,
+):
+    """Index new and changed files under directory.
+
+    Every supported path found by the walk is added to seen_paths when it is given, and
+    every path it failed to read to unreadable, for prune_music_files to compare against. Changes are committed every SCAN_BATCH_SIZE
+    files along with a checkpoint, so the database stays available to readers and an
+    interrupted full scan resumes after the last committed directory. A ScanProgress is
+    kept up to date as the walk goes, and cancelling it raises ScanCancelled, keeping the
+    chunks already committed.
+    """
+    directory = pathlib.Path(directory)
+    if not directory.exists():
+        logging.error(f"Directory {directory} does not exist")
+        return []
+
+    if workers is None:
+        workers = get_scan_workers()
+
+    logging.info(f"Scanning directory {directory} with {workers} worker(s)")
+    start_time = time.time()
+
+    db = Database.get_session()
+    executor = None
+    try:
+        checkpoint, resume_after = start_checkpoint(db, str(directory), full)
+        db.flush()
+        checkpoint_id, generation = checkpoint.id, checkpoint.generation
+        db.commit()
+
+        index = load_file_index(db)
+        directories = load_directory_state(db, full=full, resume_after=resume_after)
+        writer = ScanWriter(db)
+        stats = ScanStats(seen_paths, progress)
+
+        if progress is not None:
+            progress.phase = "scanning"
+            progress.estimated_total = len(index)
+
+        entries = tqdm(walk_music_files(directory, directories, unreadable), desc="Scanning files", unit=" files")
+        pending = _files_to_index(entries, index, full, stats, writer, MoveDetector(index))
+
+        executor = create_extractor_pool(workers)
+
+        # tag parsing is fanned out to the pool; all writes stay on this session
+        for batch in batched(pending, SCAN_BATCH_SIZE):
+            existing_files = {entry.path: (entry, existing_file) for entry, existing_file in batch}
+
+            for full_path, (metadata, content_hash) in extract_all(list(existing_files), executor):
+                if progress is not None:
+                    progress.files_indexed += 1
+
+                if not metadata:
+                    continue
+
+                # Update or add the file in the database
+                entry, existing_file = existing_files[full_path]
+                if existing_file:
+                    writer.update(existing_file.id, entry, metadata, content_hash)
+                else:
+                    stats.new_adds += 1
+                    writer.add(entry, metadata, content_hash)
+
+            commit_chunk(db, writer, directories, checkpoint_id)
+
+        writer.flush()
+        save_directory_state(db, directories, final=True)
+
+        # files that came back but could not be re-read are still present on disk
+        for ids in batched(stats.found_ids, SCAN_BATCH_SIZE):
+            db.execute(update(MusicFileDB).where(MusicFileDB.id.in_(ids)).values(missing=False))
+
+        update_checkpoint(db, checkpoint_id, completed=True)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        db.close()
+
+    files_indexed = stats.files_seen - stats.files_skipped - stats.files_moved
+    logging.info(
+        f"Scanned {stats.files_seen} music files ({files_indexed} existing, {stats.new_adds} new) in {time.time() - start_time:.2f} seconds"
+        f" ({directories.directories_skipped} unchanged directories skipped, {stats.files_moved} moved files)"
+    )
+
+    return {
+        "files_scanned": stats.files_seen,
+        "files_indexed": files_indexed,
+        "new_files_added": stats.new_adds,
+        "files_updated": files_indexed - stats.new_adds,
+        "workers": workers,
+        "directories_skipped": directories.directories_skipped,
+        "files_moved": stats.files_moved,
+        "scan_seconds": time.time() - start_time,
+        "scan_generation": generation,
+        "resumed": resume_after is not None,
+    }
+
+
+def run_library_scan(directory: str, full=False, progress: Optional[ScanProgress] = None) -> dict:
+    """Scan and prune the library, returning the combined ScanResults fields."""
+    if not os.path.isdir(directory):
+        # pruning against an empty walk would mark the whole library missing
+        raise FileNotFoundError(f"Music directory {directory} does not exist")
+
+    seen_paths, unreadable = set(), set()
+    scan_results = scan_directory(directory, full=full, seen_paths=seen_paths, progress=progress, unreadable=unreadable)
+
+    if progress is not None:
+        progress.check_cancelled()
+        progress.phase = "pruning"
+
+    prune_results = prune_music_files(seen_paths, unreadable)
+
+    results = {**scan_results, **prune_results}
+    notify_library_changed(results)
+    return results
+
+
+def apply_file_changes(
+    changed: Iterable[str] = (),
+    removed: Iterable[str] = (),
+    moved: Optional[Dict[str, str]] = None,
+    removed_directories: Iterable[str] = (),
+    moved_directories: Optional[Dict[str, str]] = None,
+):
+    """Apply a batch of filesystem changes to the index in a single transaction.
+
+    Moves rewrite the path in place so ids and playlist entries survive, and only the
+    changed files have their tags read.
+    """
+    db = Database.get_session()
+    try:
+        results = {"files_indexed": 0, "new_files_added": 0, "files_moved": 0, "files_missing": 0}
+        changed = set(changed)
+        now = datetime.now()
+
+        for old, new in (moved_directories or {}).items():
+            old_prefix = old.rstrip(os.sep) + os.sep
+            new_prefix = new.rstrip(os.sep) + os.sep
+            results["files_moved"] += db.execute(
+                update(MusicFileDB)
+                .where(_in_directory(MusicFileDB.path, old))
+                .values(path=new_prefix + func.substr(MusicFileDB.path, len(old_prefix) + 1))
+                .execution_options(synchronize_session=False)
+            ).rowcount
+
+        moved = moved or {}
+        moved_index = load_file_index(db, list(moved) + list(moved.values()))
+        for old, new in moved.items():
+            existing_file = moved_index.get(old)
+            if existing_file and new not in moved_index:
+                db.execute(update(MusicFileDB).where(MusicFileDB.id == existing_file.id).values(path=new, missing=False))
+                results["files_moved"] += 1
+            elif new not in moved_index:
+                changed.add(new)
+
+        for directory in removed_directories:
+            results["files_missing"] += db.execute(
+                update(MusicFileDB)
+                .where(_in_directory(MusicFileDB.path, directory), MusicFileDB.missing == False)
+                .values(missing=True, last_scanned=now)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+
+        for batch in batched(removed, SCAN_BATCH_SIZE):
+            results["files_missing"] += db.execute(
+                update(MusicFileDB)
+                .where(MusicFileDB.path.in_(batch), MusicFileDB.missing == False)
+                .values(missing=True, last_scanned=now)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+
+        entries = []
+        for path in changed:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # gone again before we got to it; a delete event will follow
+            entries.append(WalkEntry.from_stat(path, stat))
+
+        stats = ScanStats()
+        writer = ScanWriter(db)
+        for entry, existing_file in _files_to_index(entries, load_file_index(db, changed), False, stats, writer):
+            metadata, content_hash = read_file(entry.path)
+            if not metadata:
+                continue
+
+            if existing_file:
+                writer.update(existing_file.id, entry, metadata, content_hash)
+            else:
+                stats.new_adds += 1
+                writer.add(entry, metadata, content_hash)
+
+        writer.flush()
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    results["files_indexed"] = stats.files_seen - stats.files_skipped
+    results["new_files_added"] = stats.new_adds
+    notify_library_changed(results)
+    return results
+
+
+def _is_under(path: str, directories: Set[str]) -> bool:
+    while True:
+        if path in directories:
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+
+
+def prune_music_files(seen_paths: Optional[Set[str]] = None, unreadable: Iterable[str] = ()):
+    """Mark files that are gone as missing, and clear the flag on files that came back.
+
+    With the set of paths seen by the scan walk, this is a set difference over the
+    (id, path, missing) columns; without it every indexed path is stat'ed. Files at or
+    under the paths the walk could not read are left as they are.
+    """
+    start_time = time.time()
+    db = Database.get_session()
+
+    if seen_paths is None:
+        exists = os.path.exists
+    else:
+        exists = seen_paths.__contains__
+
+    missing_ids = []
+    found_ids = []
+    unreadable = set(unreadable)
+    for row in db.query(MusicFileDB.id, MusicFileDB.path, MusicFileDB.missing):
+        if unreadable and _is_under(row.path, unreadable):
+            continue
+        if exists(row.path):
+            if row.missing:
+                found_ids.append(row.id)
+        elif not row.missing:
+            missing_ids.append(row.id)
+
+    now = datetime.now()
+    for batch in batched(missing_ids, SCAN_BATCH_SIZE):
+        db.execute(
+            update(MusicFileDB)
+            .where(MusicFileDB.id.in_(batch))
+            .values(missing=True, last_scanned=now)
+            .execution_options(synchronize_session=False)
+        )
+    for batch in batched(found_ids, SCAN_BATCH_SIZE):
+        db.execute(
+            update(MusicFileDB)
+            .where(MusicFileDB.id.in_(batch))
+            .values(missing=False)
+            .execution_options(synchronize_session=False)
+        )
+
+    if missing_ids:
+        logging.info(f"Pruned {len(missing_ids)} music files from the database")
+
+    db.commit()
+    db.close()
+
+    return {
+        "files_missing": len(missing_ids),
+        "files_found": len(found_ids),
+        "prune_seconds": time.time() - start_time,
+    }
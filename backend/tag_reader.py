@@ -0,0 +1,678 @@
+"""Read tags from the header and trailer regions of audio files without decoding the audio.
+
+Each format is parsed from its tag blocks only, seeking over audio data, pictures and
+anything else that is not needed, so a file is read in a few small requests instead of
+being handed to mutagen. The result has the same shape as scanner.extract_metadata.
+"""
+import io
+import os
+import struct
+import zlib
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from mutagen.id3 import TCON
+
+# upper bound on a single read, so a corrupt size field cannot pull in a whole file
+MAX_TAG_BYTES = 16 * 1024 * 1024
+
+# bytes after the ID3v2 tag searched for the first MPEG frame
+MPEG_SYNC_WINDOW = 16 * 1024
+
+# bytes at the end of an Ogg file searched for the last page
+OGG_TAIL_BYTES = 64 * 1024
+
+ID3_FIELDS = {
+    "TIT2": "title", "TPE1": "artist", "TALB": "album", "TPE2": "album_artist",
+    "TDRC": "year", "TYER": "year", "TPUB": "publisher", "TCON": "genres",
+    # ID3v2.2
+    "TT2": "title", "TP1": "artist", "TAL": "album", "TP2": "album_artist",
+    "TYE": "year", "TPB": "publisher", "TCO": "genres",
+}
+
+# Vorbis comments and APE items share the same free-form, case-insensitive keys
+TEXT_FIELDS = {
+    "title": "title", "artist": "artist", "album": "album",
+    "albumartist": "album_artist", "album artist": "album_artist",
+    "date": "year", "year": "year",
+    "organization": "publisher", "publisher": "publisher", "label": "publisher",
+    "genre": "genres",
+}
+
+MP4_FIELDS = {
+    b"\xa9nam": "title", b"\xa9ART": "artist", b"\xa9alb": "album", b"aART": "album_artist",
+    b"\xa9day": "year", b"\xa9gen": "genres", b"gnre": "genres",
+}
+
+RIFF_INFO_FIELDS = {b"INAM": "title", b"IART": "artist", b"IPRD": "album", b"ICRD": "year", b"IGNR": "genres"}
+
+MPEG_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MPEG_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+
+# Tags = field name -> list of values, before they are flattened into the metadata dict
+Tags = Dict[str, List[str]]
+
+
+class TagReadError(Exception):
+    pass
+
+
+class TagFile:
+    """A file opened for bounded reads; bytes_read counts what was actually requested."""
+
+    def __init__(self, fileobj, size: int):
+        self.fileobj = fileobj
+        self.size = size
+        self.bytes_read = 0
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "TagFile":
+        return cls(io.BytesIO(data), len(data))
+
+    def read(self, size: int) -> bytes:
+        if size > MAX_TAG_BYTES:
+            raise TagReadError(f"Refusing to read {size} bytes of tags")
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def read_exact(self, size: int) -> bytes:
+        data = self.read(size)
+        if len(data) < size:
+            raise TagReadError("Unexpected end of file")
+        return data
+
+    def seek(self, offset: int):
+        self.fileobj.seek(offset)
+
+    def tell(self) -> int:
+        return self.fileobj.tell()
+
+
+def to_metadata(tags: Tags, kind: str, length: Optional[float] = None) -> dict:
+    def first(field):
+        values = tags.get(field)
+        return values[0] if values else None
+
+    return {
+        "title": first("title"),
+        "artist": first("artist"),
+        "album": first("album"),
+        "album_artist": first("album_artist"),
+        "year": first("year"),
+        "length": int(length) if length is not None else None,
+        "publisher": first("publisher"),
+        "kind": kind,
+        "genres": tags.get("genres", []),
+    }
+
+
+def merge_tags(*sources: Optional[Tags]) -> Tags:
+    """Combine tags, taking each field from the first source that has it."""
+    tags = {}
+    for source in sources:
+        for field, values in (source or {}).items():
+            tags.setdefault(field, values)
+    return tags
+
+
+def id3_genres(values: List[str]) -> List[str]:
+    # resolves ID3v1 style "(17)" references the way EasyID3 does
+    return TCON(encoding=3, text=values).genres
+
+
+def text_tags(items: Dict[str, List[str]]) -> Tags:
+    tags = {}
+    for key, values in items.items():
+        field = TEXT_FIELDS.get(key)
+        values = [value for value in values if value]
+        if field and values:
+            tags.setdefault(field, values)
+    return tags
+
+
+# --- ID3v2 / ID3v1 / APE -----------------------------------------------------
+
+
+def synchsafe(data: bytes) -> int:
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def remove_unsynchronisation(data: bytes) -> bytes:
+    return data.replace(b"\xff\x00", b"\xff")
+
+
+def decode_id3_text(data: bytes) -> List[str]:
+    if not data:
+        return []
+
+    encoding, body = data[0], data[1:]
+    if encoding == 0:
+        text = body.decode("latin-1")
+    elif encoding == 1:
+        text = body[:len(body) // 2 * 2].decode("utf-16", "replace")
+    elif encoding == 2:
+        text = body[:len(body) // 2 * 2].decode("utf-16-be", "replace")
+    elif encoding == 3:
+        text = body.decode("utf-8", "replace")
+    else:
+        return []
+
+    # ID3v2.4 separates multiple values with NULs, each UTF-16 value with its own BOM
+    values = [value.lstrip("\ufeff") for value in text.split("\x00")]
+    return [value for value in values if value]
+
+
+def decode_id3_frame(data: bytes, major: int, flags: int) -> Optional[bytes]:
+    if major == 4:
+        if flags & 0x40:  # grouping identity
+            data = data[1:]
+        if flags & 0x01:  # data length indicator
+            data = data[4:]
+        if flags & 0x04:  # encrypted
+            return None
+        if flags & 0x02:
+            data = remove_unsynchronisation(data)
+        if flags & 0x08:
+            data = zlib.decompress(data)
+    elif major == 3:
+        if flags & 0x40:
+            return None
+        if flags & 0x80:  # decompressed size
+            data = data[4:]
+        if flags & 0x20:
+            data = data[1:]
+        if flags & 0x80:
+            data = zlib.decompress(data)
+    return data
+
+
+def read_id3_frames(f: TagFile, end: int, major: int) -> Tags:
+    header_size = 6 if major == 2 else 10
+    tags = {}
+
+    while f.tell() + header_size <= end:
+        header = f.read_exact(header_size)
+        if header[0] == 0:
+            break  # padding
+
+        if major == 2:
+            frame_id, size, flags = header[:3], int.from_bytes(header[3:6], "big"), 0
+        else:
+            frame_id = header[:4]
+            size = synchsafe(header[4:8]) if major == 4 else int.from_bytes(header[4:8], "big")
+            flags = header[9]
+
+        field = ID3_FIELDS.get(frame_id.decode("latin-1"))
+        if field is None or field in tags or f.tell() + size > end:
+            # pictures and other frames are skipped without reading them
+            f.seek(f.tell() + size)
+            continue
+
+        data = decode_id3_frame(f.read_exact(size), major, flags)
+        values = decode_id3_text(data) if data else []
+        if values:
+            tags[field] = id3_genres(values) if field == "genres" else values
+
+    return tags
+
+
+def read_id3v2(f: TagFile, offset=0) -> Tuple[Optional[Tags], int]:
+    """Parse an ID3v2 tag at offset, returning its tags (None if there is none) and where it ends."""
+    f.seek(offset)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return None, offset
+
+    major, flags = header[3], header[5]
+    size = synchsafe(header[6:10])
+    end = offset + 10 + size + (10 if major == 4 and flags & 0x10 else 0)
+    if major not in (2, 3, 4):
+        return {}, end
+
+    if flags & 0x80 and major < 4:
+        # the whole tag is unsynchronised, so frame sizes refer to the decoded bytes
+        frames = TagFile.from_bytes(remove_unsynchronisation(f.read_exact(size)))
+        frames_end = frames.size
+    else:
+        frames, frames_end = f, offset + 10 + size
+
+    if flags & 0x40 and major > 2:
+        extended = frames.read_exact(4)
+        extended_size = synchsafe(extended) - 4 if major == 4 else int.from_bytes(extended, "big")
+        frames.seek(frames.tell() + extended_size)
+
+    return read_id3_frames(frames, frames_end, major), end
+
+
+def read_id3v1(data: bytes) -> Tags:
+    def text(start, length):
+        return data[start:start + length].split(b"\x00")[0].decode("latin-1").strip()
+
+    tags = {}
+    for field, start, length in (("title", 3, 30), ("artist", 33, 30), ("album", 63, 30), ("year", 93, 4)):
+        value = text(start, length)
+        if value:
+            tags[field] = [value]
+
+    if data[127] != 255:
+        tags["genres"] = id3_genres([f"({data[127]})"])
+
+    return tags
+
+
+def read_ape_items(data: bytes, count: int) -> Tags:
+    items = {}
+    pos = 0
+    for _ in range(count):
+        size, flags = struct.unpack_from("<II", data, pos)
+        key_end = data.index(b"\x00", pos + 8)
+        key = data[pos + 8:key_end].decode("ascii", "replace").lower()
+        value = data[key_end + 1:key_end + 1 + size]
+        pos = key_end + 1 + size
+
+        # only UTF-8 text items; binary items hold cover art
+        if flags & 0x06 == 0:
+            items[key] = value.decode("utf-8", "replace").split("\x00")
+
+    return text_tags(items)
+
+
+def read_trailing_tags(f: TagFile) -> Tuple[Optional[Tags], Optional[Tags], int]:
+    """Read the APEv2 and ID3v1 tags at the end of the file, returning where the audio ends."""
+    end = f.size
+    id3v1 = None
+    if end >= 128:
+        f.seek(end - 128)
+        data = f.read_exact(128)
+        if data[:3] == b"TAG":
+            id3v1 = read_id3v1(data)
+            end -= 128
+
+    ape = None
+    if end >= 32:
+        f.seek(end - 32)
+        footer = f.read_exact(32)
+        if footer[:8] == b"APETAGEX":
+            _, size, count, flags = struct.unpack_from("<IIII", footer, 8)
+            f.seek(end - size)
+            ape = read_ape_items(f.read_exact(size - 32), count)
+            end -= size + (32 if flags & 0x80000000 else 0)
+
+    return ape, id3v1, end
+
+
+# --- MPEG audio ----------------------------------------------------------------
+
+
+class MpegFrame(NamedTuple):
+    version: float
+    layer: int
+    bitrate: int
+    sample_rate: int
+    mono: bool
+    samples: int
+    length: int
+
+
+def parse_mpeg_header(header: bytes) -> Optional[MpegFrame]:
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+
+    version_bits = (header[1] >> 3) & 3
+    layer_bits = (header[1] >> 1) & 3
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 3
+    if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    version = {0: 2.5, 2: 2, 3: 1}[version_bits]
+    layer = 4 - layer_bits
+    bitrate = MPEG_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 1
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or version == 1 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+
+    return MpegFrame(version, layer, bitrate, sample_rate, header[3] >> 6 == 3, samples, length)
+
+
+def mpeg_length(f: TagFile, start: int, end: int) -> Optional[float]:
+    """Length from the first frame's Xing/VBRI header, or from the bitrate for CBR files."""
+    f.seek(start)
+    data = f.read(min(MPEG_SYNC_WINDOW, max(end - start, 0)))
+
+    pos = data.find(b"\xff")
+    while 0 <= pos <= len(data) - 4:
+        frame = parse_mpeg_header(data[pos:pos + 4])
+        following = pos + frame.length if frame else 0
+        # a sync word followed by another frame header is taken to be the first frame
+        if frame and (following + 4 > len(data) or parse_mpeg_header(data[following:following + 4])):
+            side_info = (32 if not frame.mono else 17) if frame.version == 1 else (17 if not frame.mono else 9)
+            xing = data[pos + 4 + side_info:pos + 16 + side_info]
+            if xing[:4] in (b"Xing", b"Info") and len(xing) == 12 and xing[7] & 0x01:
+                return int.from_bytes(xing[8:12], "big") * frame.samples / frame.sample_rate
+
+            vbri = data[pos + 36:pos + 54]
+            if vbri[:4] == b"VBRI" and len(vbri) == 18:
+                return int.from_bytes(vbri[14:18], "big") * frame.samples / frame.sample_rate
+
+            return (end - start - pos) * 8 / frame.bitrate
+
+        pos = data.find(b"\xff", pos + 1)
+
+    return None
+
+
+def read_mpeg(f: TagFile, id3v2: Optional[Tags], audio_start: int) -> Optional[dict]:
+    ape, id3v1, audio_end = read_trailing_tags(f)
+    length = mpeg_length(f, audio_start, audio_end)
+    if id3v2 is None and ape is None and id3v1 is None and length is None:
+        return None
+
+    return to_metadata(merge_tags(id3v2, ape, id3v1), "audio/mp3", length)
+
+
+# --- FLAC and Ogg --------------------------------------------------------------
+
+
+def read_vorbis_comment(data: bytes) -> Tags:
+    vendor_length = struct.unpack_from("<I", data, 0)[0]
+    pos = 4 + vendor_length
+    count = struct.unpack_from("<I", data, pos)[0]
+    pos += 4
+
+    items = {}
+    for _ in range(count):
+        length = struct.unpack_from("<I", data, pos)[0]
+        key, separator, value = data[pos + 4:pos + 4 + length].decode("utf-8", "replace").partition("=")
+        pos += 4 + length
+        if separator:
+            items.setdefault(key.lower(), []).append(value)
+
+    return text_tags(items)
+
+
+def read_flac(f: TagFile, offset: int) -> dict:
+    """Walk the metadata blocks after the fLaC marker, reading only STREAMINFO and VORBIS_COMMENT."""
+    f.seek(offset)
+    tags = {}
+    length = None
+
+    last = False
+    while not last:
+        header = f.read_exact(4)
+        last = bool(header[0] & 0x80)
+        block_type = header[0] & 0x7F
+        size = int.from_bytes(header[1:4], "big")
+
+        if block_type == 0:
+            info = int.from_bytes(f.read_exact(size)[10:18], "big")
+            sample_rate, total_samples = info >> 44, info & ((1 << 36) - 1)
+            length = total_samples / sample_rate if sample_rate else None
+        elif block_type == 4:
+            tags = read_vorbis_comment(f.read_exact(size))
+        elif block_type == 127:
+            raise TagReadError("Invalid FLAC metadata block")
+        else:
+            f.seek(f.tell() + size)
+
+    return to_metadata(tags, "audio/flac", length)
+
+
+def read_ogg_packets(f: TagFile, count: int) -> Tuple[List[bytes], int]:
+    """Reassemble the first count packets of the first logical stream."""
+    f.seek(0)
+    packets = []
+    packet = bytearray()
+    serial = None
+
+    while len(packets) < count:
+        header = f.read_exact(27)
+        if header[:4] != b"OggS":
+            raise TagReadError("Lost Ogg page sync")
+
+        lacing = f.read_exact(header[26])
+        body = f.read_exact(sum(lacing))
+        page_serial = struct.unpack_from("<I", header, 14)[0]
+        if serial is None:
+            serial = page_serial
+        elif page_serial != serial:
+            continue
+
+        pos = 0
+        for segment in lacing:
+            packet += body[pos:pos + segment]
+            pos += segment
+            if segment < 255:
+                packets.append(bytes(packet))
+                packet = bytearray()
+            elif len(packet) > MAX_TAG_BYTES:
+                raise TagReadError("Ogg header packet too large")
+
+    return packets[:count], serial
+
+
+def last_granule_position(f: TagFile, serial: int) -> Optional[int]:
+    window = min(f.size, OGG_TAIL_BYTES)
+    f.seek(f.size - window)
+    data = f.read(window)
+
+    pos = data.rfind(b"OggS")
+    while pos >= 0:
+        if pos + 27 <= len(data) and struct.unpack_from("<I", data, pos + 14)[0] == serial:
+            granule = struct.unpack_from("<q", data, pos + 6)[0]
+            if granule >= 0:
+                return granule
+        pos = data.rfind(b"OggS", 0, pos)
+
+    return None
+
+
+def read_ogg(f: TagFile) -> Optional[dict]:
+    (identification, comment), serial = read_ogg_packets(f, 2)
+
+    if identification.startswith(b"\x01vorbis") and comment.startswith(b"\x03vorbis"):
+        sample_rate = struct.unpack_from("<I", identification, 12)[0]
+        granule = last_granule_position(f, serial)
+        length = granule / sample_rate if granule is not None and sample_rate else None
+        return to_metadata(read_vorbis_comment(comment[7:]), "audio/vorbis", length)
+
+    if identification.startswith(b"OpusHead") and comment.startswith(b"OpusTags"):
+        pre_skip = struct.unpack_from("<H", identification, 10)[0]
+        granule = last_granule_position(f, serial)
+        length = max(granule - pre_skip, 0) / 48000 if granule is not None else None
+        return to_metadata(read_vorbis_comment(comment[8:]), "audio/ogg", length)
+
+    # Ogg FLAC, Speex etc. are left to mutagen
+    return None
+
+
+# --- MP4 ---------------------------------------------------------------------
+
+
+def iter_atoms(f: TagFile, start: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """Yield (name, data start, atom end) for the atoms between start and end."""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, name = struct.unpack(">I4s", f.read_exact(8))
+        data_start = pos + 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read_exact(8))[0]
+            data_start += 8
+        elif size == 0:
+            size = end - pos
+
+        if pos + size < data_start:
+            raise TagReadError(f"Invalid size for MP4 atom {name!r}")
+
+        yield name, data_start, min(pos + size, end)
+        pos += size
+
+
+def find_atom(f: TagFile, start: int, end: int, name: bytes) -> Optional[Tuple[int, int]]:
+    for atom, data_start, atom_end in iter_atoms(f, start, end):
+        if atom == name:
+            return data_start, atom_end
+    return None
+
+
+def read_ilst(f: TagFile, start: int, end: int) -> Tags:
+    tags = {}
+    for name, item_start, item_end in iter_atoms(f, start, end):
+        if name == b"----":
+            # freeform "com.apple.iTunes:<name>" items, of which only the label is used
+            children = {}
+            for child, child_start, child_end in iter_atoms(f, item_start, item_end):
+                if child in (b"name", b"data"):
+                    f.seek(child_start)
+                    children[child] = f.read_exact(child_end - child_start)
+            key = children.get(b"name", b"")[4:].decode("utf-8", "replace").lower()
+            if TEXT_FIELDS.get(key) == "publisher" and b"data" in children:
+                tags.setdefault("publisher", [children[b"data"][8:].decode("utf-8", "replace")])
+            continue
+
+        field = MP4_FIELDS.get(name)
+        if field is None or (field in tags and name != b"gnre"):
+            continue
+
+        values = []
+        for child, child_start, child_end in iter_atoms(f, item_start, item_end):
+            if child != b"data":
+                continue
+
+            f.seek(child_start)
+            data = f.read_exact(child_end - child_start)
+            data_type, value = int.from_bytes(data[1:4], "big"), data[8:]
+            if name == b"gnre" and len(value) >= 2:
+                values.extend(id3_genres([f"({int.from_bytes(value[:2], 'big') - 1})"]))
+            elif data_type == 1:
+                values.append(value.decode("utf-8", "replace"))
+
+        if values:
+            tags.setdefault(field, values)
+
+    return tags
+
+
+def read_mp4(f: TagFile) -> Optional[dict]:
+    """Read the movie header and the iTunes item list, seeking over mdat and the track tables."""
+    moov = find_atom(f, 0, f.size, b"moov")
+    if moov is None:
+        return None
+
+    tags = {}
+    length = None
+    for name, start, end in iter_atoms(f, *moov):
+        if name == b"mvhd":
+            f.seek(start)
+            header = f.read_exact(min(end - start, 32))
+            if header[0] == 1:
+                timescale, duration = struct.unpack_from(">IQ", header, 20)
+            else:
+                timescale, duration = struct.unpack_from(">II", header, 12)
+            length = duration / timescale if timescale else None
+        elif name == b"udta":
+            meta = find_atom(f, start, end, b"meta")
+            if meta is None:
+                continue
+
+            # meta is a full box with version and flags, except in some QuickTime files
+            f.seek(meta[0])
+            meta_start = meta[0] if f.read_exact(8)[4:8] == b"hdlr" else meta[0] + 4
+            ilst = find_atom(f, meta_start, meta[1], b"ilst")
+            if ilst is not None:
+                tags = read_ilst(f, *ilst)
+
+    return to_metadata(tags, "audio/mp4", length)
+
+
+# --- RIFF/WAVE ---------------------------------------------------------------
+
+
+def iter_riff_chunks(f: TagFile, start: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        chunk_id, size = struct.unpack("<4sI", f.read_exact(8))
+        yield chunk_id, pos + 8, min(pos + 8 + size, end)
+        pos += 8 + size + (size & 1)
+
+
+def read_riff(f: TagFile) -> dict:
+    f.seek(4)
+    riff_end = min(8 + struct.unpack("<I", f.read_exact(4))[0], f.size)
+
+    info = {}
+    id3 = None
+    byte_rate = None
+    data_size = None
+    for chunk_id, start, end in iter_riff_chunks(f, 12, riff_end):
+        if chunk_id == b"fmt ":
+            f.seek(start)
+            byte_rate = struct.unpack_from("<I", f.read_exact(12), 8)[0]
+        elif chunk_id == b"data":
+            data_size = end - start
+        elif chunk_id in (b"id3 ", b"ID3 "):
+            id3, _ = read_id3v2(f, start)
+        elif chunk_id == b"LIST":
+            f.seek(start)
+            if f.read_exact(4) != b"INFO":
+                continue
+            for item_id, item_start, item_end in iter_riff_chunks(f, start + 4, end):
+                field = RIFF_INFO_FIELDS.get(item_id)
+                if field is None:
+                    continue
+                f.seek(item_start)
+                value = f.read_exact(item_end - item_start).split(b"\x00")[0]
+                try:
+                    value = value.decode("utf-8")
+                except UnicodeDecodeError:
+                    value = value.decode("latin-1")
+                if value:
+                    info[field] = [value]
+
+    length = data_size / byte_rate if data_size is not None and byte_rate else None
+    return to_metadata(merge_tags(id3, info), "audio/wav", length)
+
+
+# -----------------------------------------------------------------------------
+
+
+def read_tag_file(f: TagFile, extension: str = "") -> Optional[dict]:
+    """Dispatch on the file's magic bytes; returns None for files this module does not handle."""
+    f.seek(0)
+    magic = f.read(12)
+
+    if magic[:4] == b"OggS":
+        return read_ogg(f)
+    if magic[:4] == b"RIFF" and magic[8:12] == b"WAVE":
+        return read_riff(f)
+    if magic[4:8] == b"ftyp":
+        return read_mp4(f)
+
+    id3v2, audio_start = read_id3v2(f)
+    f.seek(audio_start)
+    if f.read(4) == b"fLaC":
+        return read_flac(f, audio_start + 4)
+    if id3v2 is not None or extension == ".mp3":
+        return read_mpeg(f, id3v2, audio_start)
+
+    return None
+
+
+def read_tags(path: str) -> Optional[dict]:
+    with open(path, "rb") as fileobj:
+        f = TagFile(fileobj, os.fstat(fileobj.fileno()).st_size)
+        return read_tag_file(f, os.path.splitext(path)[1].lower())
@@ -1,7 +1,9 @@
 import pytest
 from fastapi.testclient import TestClient
 from dependencies import get_music_file_repository
-from response_models import MusicFile
+from response_models import MusicFile, LastFMTrack
+from repositories.last_fm_repository import last_fm_repository
+from repositories.open_ai_repository import open_ai_repository
 from database import Base
 from sqlalchemy import create_engine
 
@@ -145,6 +147,37 @@ def test_add_lastfm_to_playlist(client, test_tracks):
     response = client.get(f"/api/playlists/{playlist_id}")
     assert response.json()["entries"][0]["details"]["title"] == "Test Song"
 
+def test_remove_from_playlist_and_undo(client, test_tracks):
+    entries = [{"music_file_id": t.id, "entry_type": "music_file"} for t in test_tracks]
+    playlist_id = client.post("/api/playlists", json={"name": "Test Playlist", "entries": entries}).json()["id"]
+    playlist = client.get(f"/api/playlists/{playlist_id}").json()
+    removed = playlist["entries"][:1]
+
+    response = client.post(f"/api/playlists/{playlist_id}/remove", json=removed)
+    assert response.status_code == 200
+
+    remaining = client.get(f"/api/playlists/{playlist_id}").json()["entries"]
+    assert [e["order"] for e in remaining] == list(range(len(test_tracks) - 1))
+    assert [e["music_file_id"] for e in remaining] == [t.id for t in test_tracks[1:]]
+
+    client.post(f"/api/playlists/{playlist_id}/remove", json=removed, params={"undo": True})
+    restored = client.get(f"/api/playlists/{playlist_id}").json()["entries"]
+    assert len(restored) == len(test_tracks)
+
+def test_playlist_entries_endpoint(client, test_tracks):
+    entries = [{"music_file_id": t.id, "entry_type": "music_file"} for t in test_tracks]
+    playlist_id = client.post("/api/playlists", json={"name": "Test Playlist", "entries": entries}).json()["id"]
+
+    first = client.get(f"/api/playlists/{playlist_id}/entries", params={"limit": 1}).json()
+    assert [e["music_file_id"] for e in first["entries"]] == [test_tracks[0].id]
+
+    params = {"limit": 1, "after_order": first["next_after_order"]}
+    second = client.get(f"/api/playlists/{playlist_id}/entries", params=params).json()
+    assert [e["music_file_id"] for e in second["entries"]] == [test_tracks[1].id]
+    assert second["next_after_order"] is None
+
+    assert client.get("/api/playlists/999/entries").status_code == 404
+
 def test_delete_playlist(client):
     # Create playlist
     response = client.post(
@@ -160,3 +193,56 @@ def test_delete_playlist(client):
     # Verify deletion
     response = client.get("/api/playlists")
     assert len(response.json()) == 0
+
+def test_search_returns_next_cursor(client, test_tracks):
+    response = client.get("/api/search", params={"query": "test", "limit": 1})
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+    cursor = response.headers["X-Next-Cursor"]
+
+    response = client.get("/api/search", params={"query": "test", "limit": 5, "cursor": cursor})
+    assert [track["id"] for track in response.json()] == [track.id for track in test_tracks[1:]]
+    assert "X-Next-Cursor" not in response.headers
+
+    response = client.get("/api/filter", params={"artist": "test artist", "cursor": "not a cursor"})
+    assert response.status_code == 400
+
+def test_facets_endpoint(client, test_tracks):
+    response = client.get("/api/facets", params={"artist": "test artist", "limit": 1})
+    assert response.status_code == 200
+    body = response.json()
+    assert [track["id"] for track in body["results"]] == [test_tracks[0].id]
+    assert response.headers["X-Next-Cursor"]
+    assert "next_cursor" not in body
+
+    response = client.get("/api/facets", params={"artist": "test artist", "cursor": response.headers["X-Next-Cursor"]})
+    assert [track["id"] for track in response.json()["results"]] == [test_tracks[1].id]
+    assert "X-Next-Cursor" not in response.headers
+
+    response = client.get("/api/facets", params={"cursor": "not a cursor"})
+    assert response.status_code == 400
+    assert body["facets"]["artist"] == [{"value": "Test Artist", "count": 2, "artist": None}]
+    assert body["facets"]["genre"] == []
+
+def test_similar_tracks_are_annotated(client, test_tracks, monkeypatch):
+    monkeypatch.setenv("LASTFM_API_KEY", "test")
+    monkeypatch.setattr(last_fm_repository, "get_similar_tracks", lambda self, artist, title: [
+        LastFMTrack(title="test song 2", artist="Test Artist", url="https://last.fm/1"),
+        LastFMTrack(title="Elsewhere", artist="Test Artist", url="https://last.fm/2"),
+    ])
+
+    response = client.get("/api/lastfm/similar", params={"title": "Test Song 1", "artist": "Test Artist"})
+    assert response.status_code == 200
+    assert [track["music_file_id"] for track in response.json()] == [test_tracks[1].id, None]
+
+def test_openai_suggestions_are_annotated(client, test_tracks, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setattr(open_ai_repository, "get_similar_tracks", lambda self, artist, title: {"tracks": [
+        {"title": "Elsewhere", "artist": "Test Artist"},
+        {"title": "Test Song 2", "artist": "test artist"},
+    ]})
+
+    response = client.get("/api/openai/similar", params={"title": "Test Song 1", "artist": "Test Artist"})
+    assert response.status_code == 200
+    tracks = response.json()["tracks"]
+    assert [(track["title"], track["music_file_id"]) for track in tracks] == [("Elsewhere", None), ("Test Song 2", test_tracks[1].id)]
@@ -0,0 +1,123 @@
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import update
+import autocomplete
+from autocomplete import CompletionIndex, FieldIndex, completion_index, search_keys
+from models import MusicFileDB
+
+WORDS = ["the", "a", "love", "lost", "low", "night", "nights", "blue", "bl", "café", "cafe"]
+
+
+def add_files(session, *tags, last_scanned=None):
+    for i, (artist, album, title) in enumerate(tags):
+        session.add(MusicFileDB(
+            path=f"/music/{len(tags)}-{i}-{title}.mp3", artist=artist, album=album, title=title,
+            last_scanned=last_scanned or datetime.now(),
+        ))
+    session.commit()
+
+
+def expected_completions(field: FieldIndex, prefix: str, limit: int):
+    matches = []
+    for key, value_id in field.ids.items():
+        keys = [k for k in search_keys(key) if k.startswith(prefix)]
+        if keys and field.counts[value_id] > 0:
+            matches.append((-field.counts[value_id], min(keys), value_id))
+    return [(field.values[value_id], field.counts[value_id]) for _, _, value_id in sorted(matches)[:limit]]
+
+
+def test_field_index_matches_brute_force():
+    rng = random.Random(0)
+    field = FieldIndex()
+
+    def random_value():
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title()
+
+    for _ in range(300):
+        field.counts[field.value_id(random_value())] += rng.randint(0, 20)
+    field.rebuild()
+
+    prefixes = ["", "l", "lo", "lov", "the", "the ", "a", "cafe", "n", "bl", "zzz"]
+    for prefix in prefixes:
+        assert field.complete(prefix, 7) == expected_completions(field, prefix, 7)
+
+    # new values land in the pending list, count changes go through the tree
+    changed = set()
+    for _ in range(100):
+        value_id = field.value_id(random_value())
+        field.counts[value_id] = rng.randint(0, 40)
+        changed.add(value_id)
+    field.sync(changed)
+
+    assert field.pending
+    for prefix in prefixes:
+        assert field.complete(prefix, 7) == expected_completions(field, prefix, 7)
+
+
+def test_complete_ranks_by_track_count(test_db):
+    index = CompletionIndex()
+    add_files(
+        test_db,
+        ("The Beatles", "Abbey Road", "Come Together"),
+        ("The Beatles", "Abbey Road", "Something"),
+        ("Beach House", "Bloom", "Myth"),
+        ("Björk", "Debut", "Come to Me"),
+    )
+    index.build()
+
+    completions = index.complete("b")
+    assert completions["artist"] == [("The Beatles", 2), ("Beach House", 1), ("Björk", 1)]
+    assert completions["album"] == [("Bloom", 1)]
+    assert index.complete("bjo")["artist"] == [("Björk", 1)]
+    assert index.complete("The B")["artist"] == [("The Beatles", 2)]
+    assert index.complete("come t", limit=1)["title"] == [("Come to Me", 1)]
+    assert index.complete("come tog")["title"] == [("Come Together", 1)]
+
+
+def test_refresh_applies_scanned_changes(test_db, monkeypatch):
+    monkeypatch.setattr(autocomplete, "REBUILD_FRACTION", 10)
+    index = CompletionIndex()
+    earlier = datetime.now() - timedelta(hours=1)
+    add_files(test_db, ("Artist", "Album", "Song"), ("Artist", "Album", "Other Song"), last_scanned=earlier)
+    index.build()
+    assert index.complete("art")["artist"] == [("Artist", 2)]
+
+    test_db.execute(
+        update(MusicFileDB)
+        .where(MusicFileDB.title == "Song")
+        .values(artist="Renamed", last_scanned=datetime.now())
+    )
+    test_db.commit()
+    add_files(test_db, ("New Artist", "New Album", "New Song"))
+    index.refresh()
+
+    assert index.complete("art")["artist"] == [("Artist", 1)]
+    assert index.complete("ren")["artist"] == [("Renamed", 1)]
+    assert index.complete("new")["album"] == [("New Album", 1)]
+
+    test_db.execute(update(MusicFileDB).values(missing=True, last_scanned=datetime.now()))
+    test_db.commit()
+    index.refresh()
+
+    assert index.complete("a") == {"artist": [], "album": [], "title": []}
+    assert index.stats()["files"] == 0
+
+
+def test_autocomplete_endpoints(client, test_db):
+    add_files(test_db, ("Artist", "Album", "Song"), ("Another Artist", "Album", "Second Song"))
+
+    response = client.get("/api/autocomplete", params={"prefix": "a", "limit": 5})
+    assert response.status_code == 200
+    assert response.json() == {
+        "artists": [{"value": "Another Artist", "count": 1}, {"value": "Artist", "count": 1}],
+        "albums": [{"value": "Album", "count": 2}],
+        "titles": [],
+    }
+
+    stats = client.get("/api/autocomplete/stats").json()
+    assert stats["ready"]
+    assert stats["files"] == 2
+    assert stats["values"] == {"artist": 2, "album": 1, "title": 2}
+    assert stats["memory_bytes"] > 0
+
+    completion_index.clear()
@@ -0,0 +1,22 @@
+from benchmarks.scan_benchmark import generate_library, run_benchmark
+from scanner import read_metadata
+
+
+def test_generated_tracks_are_readable(tmp_path):
+    paths = generate_library(tmp_path / "mp3", 15, flac_ratio=0) + generate_library(tmp_path / "flac", 15, flac_ratio=1)
+
+    assert len(paths) == 30
+    assert {path.suffix for path in paths} == {".mp3", ".flac"}
+    assert all(read_metadata(str(path))["title"] for path in paths)
+
+
+def test_run_benchmark():
+    phases = run_benchmark(40, workers=1)
+    full, incremental, changed, prune = phases
+
+    assert full["results"]["new_files_added"] == 40
+    assert incremental["results"]["files_indexed"] == 0
+    assert changed["results"]["new_files_added"] == 1
+    assert changed["results"]["files_updated"] == 1
+    assert prune["results"]["files_missing"] == 0
+    assert all(phase["queries"] > 0 and phase["lifetime_peak_rss_mb"] > 0 for phase in phases)
@@ -1,11 +1,13 @@
 import pytest
 from datetime import datetime
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
-from repositories.music_file import MusicFileRepository
+from repositories.music_file import MusicFileRepository, library_facets
 from repositories.playlist import PlaylistRepository
-from models import Base, MusicFileDB, TrackGenreDB
-from response_models import MusicFile, LastFMTrack, RequestedTrack, RequestedTrackEntry, Playlist, MusicFileEntry
+from models import Base, MusicFileDB, TrackGenreDB, GenreDB, SearchTermDB
+from migrations import migrate_music_file_genres, add_search_index, backfill_match_keys
+from repositories.genre import GenreRepository
+from response_models import MusicFile, LastFMTrack, RequestedTrack, RequestedTrackEntry, Playlist, MusicFileEntry, TrackDetails
 
 @pytest.fixture
 def engine():
@@ -86,3 +88,263 @@ def test_search_and_filter(repo, sample_music_file):
     assert result[0].kind == sample_music_file.kind
     assert result[0].last_scanned == sample_music_file.last_scanned
     assert result[0].genres == sample_music_file.genres
+
+def test_filter_by_genre(repo, session, sample_music_file):
+    repo.add_music_file(sample_music_file)
+    repo.add_music_file(sample_music_file.model_copy(update={"path": "/test/other.mp3", "genres": ["Jazz", "Rock"]}))
+
+    assert len(repo.filter(genre="rock")) == 2
+    assert [f.path for f in repo.filter(genre="Alternative")] == [sample_music_file.path]
+    assert repo.filter(genre="Metal") == []
+
+    # genre names are stored once
+    assert session.query(GenreDB).count() == 3
+    assert [(g.name, g.count) for g in GenreRepository(session).list_genres()] == [
+        ("Alternative", 1), ("Jazz", 1), ("Rock", 2)
+    ]
+
+def test_migrate_music_file_genres(engine, session):
+    music_file = MusicFileDB(path="/test/old.mp3", title="Old Song")
+    session.add(music_file)
+    session.flush()
+    for genre in ["Rock", "Pop", "Rock"]:
+        session.add(TrackGenreDB(parent_type="music_file", music_file_id=music_file.id, genre=genre))
+    session.commit()
+
+    migrate_music_file_genres(engine)
+    session.expire_all()
+
+    assert [g.name for g in session.query(MusicFileDB).one().genres] == ["Rock", "Pop"]
+    assert session.query(TrackGenreDB).count() == 0
+
+def test_search_uses_full_text_index(repo, session, sample_music_file):
+    repo.add_music_file(sample_music_file.model_copy(update={"path": "/test/1.mp3", "title": "Hyperballad", "artist": "Björk", "album": "Post"}))
+    repo.add_music_file(sample_music_file.model_copy(update={"path": "/test/2.mp3", "title": "Post", "artist": "Someone", "album": "Other"}))
+    repo.add_music_file(sample_music_file.model_copy(update={"path": "/test/3.mp3", "title": "Song", "artist": "Post Malone", "album": "Other"}))
+
+    # title matches rank above artist matches, which rank above album matches
+    assert [f.path for f in repo.search("post")] == ["/test/2.mp3", "/test/3.mp3", "/test/1.mp3"]
+    # diacritics are folded and the last token matches as a prefix
+    assert [f.path for f in repo.search("bjork hyperbal")] == ["/test/1.mp3"]
+
+    # the triggers keep the index in step with music_files
+    music_file = session.query(MusicFileDB).filter(MusicFileDB.path == "/test/1.mp3").one()
+    music_file.title = "Army of Me"
+    session.commit()
+    assert repo.search("hyperballad") == []
+    assert [f.path for f in repo.search("army")] == ["/test/1.mp3"]
+
+def test_search_falls_back_without_index(engine, repo, session, sample_music_file):
+    repo.add_music_file(sample_music_file)
+    session.execute(text("DROP TABLE music_files_fts"))
+    session.commit()
+
+    assert [f.path for f in repo.search("test song")] == [sample_music_file.path]
+
+    # the migration rebuilds the index for existing rows
+    add_search_index(engine)
+    assert session.execute(text("SELECT count(*) FROM music_files_fts WHERE music_files_fts MATCH 'song'")).scalar() == 1
+
+def test_fuzzy_search(repo, sample_music_file):
+    repo.add_music_file(sample_music_file.model_copy(update={"path": "/test/1.mp3", "title": "Halo", "artist": "Beyoncé", "album": "I Am... Sasha Fierce"}))
+    repo.add_music_file(sample_music_file.model_copy(update={"path": "/test/2.mp3", "title": "Creep", "artist": "Radiohead", "album": "Pablo Honey"}))
+
+    assert repo.search("beyonse") == []
+    assert [f.path for f in repo.search("beyonse", fuzzy=True)] == ["/test/1.mp3"]
+    assert [f.path for f in repo.search("radiohed crep", fuzzy=True)] == ["/test/2.mp3"]
+    assert repo.search("metallica", fuzzy=True) == []
+
+def test_fuzzy_search_ranks_exact_matches_first(repo, session, sample_music_file):
+    # a short, rare "light" scores better under bm25 than the common, longer "night" titles
+    for i in range(4):
+        repo.add_music_file(sample_music_file.model_copy(update={"path": f"/test/night{i}.mp3", "title": f"Night Song Number {i} Extended Mix"}))
+    repo.add_music_file(sample_music_file.model_copy(update={"path": "/test/light.mp3", "title": "Light"}))
+
+    # words the vocabulary knows are not expanded to their typo neighbours
+    assert sorted(f.path for f in repo.search("night", fuzzy=True)) == [f"/test/night{i}.mp3" for i in range(4)]
+
+    # when the vocabulary lags the index, typo matches still come after the exact ones
+    session.query(SearchTermDB).filter(SearchTermDB.term == "night").delete()
+    paths = [f.path for f in repo.search("night", fuzzy=True)]
+    assert sorted(paths[:4]) == [f"/test/night{i}.mp3" for i in range(4)]
+    assert paths[4:] == ["/test/light.mp3"]
+
+    page = repo.search_page("night", fuzzy=True, limit=3)
+    rest = repo.search_page("night", fuzzy=True, limit=3, cursor=page.next_cursor)
+    assert [f.path for f in page.results + rest.results] == paths
+    assert rest.next_cursor is None
+
+@pytest.mark.parametrize("query", ["&", "-", '"'])
+def test_fuzzy_search_without_words_matches_nothing(repo, sample_music_file, query):
+    repo.add_music_file(sample_music_file)
+
+    assert repo.search(query) == []
+    assert repo.search(query, fuzzy=True) == []
+
+def test_filter_matches_normalized_keys(repo, session, sample_music_file):
+    repo.add_music_file(sample_music_file.model_copy(update={"path": "/test/1.mp3", "title": "Something", "artist": "The Beatles", "album": "Abbey Road"}))
+    repo.add_music_file(sample_music_file.model_copy(update={"path": "/test/2.mp3", "title": "Jóga", "artist": "Björk", "album": "Homogenic"}))
+
+    for artist in ["The Beatles", "the beatles", "Beatles, The", "BEATLES"]:
+        assert [f.path for f in repo.filter(artist=artist, title="something", exact=True)] == ["/test/1.mp3"]
+    assert [f.path for f in repo.filter(artist="bjork", title="JOGA", exact=True)] == ["/test/2.mp3"]
+    assert repo.filter(artist="Beat", exact=True) == []
+
+    # without exact the value's key is anywhere in the key
+    assert [f.path for f in repo.filter(artist="beat")] == ["/test/1.mp3"]
+    assert [f.path for f in repo.filter(album="abbey")] == ["/test/1.mp3"]
+    assert [f.path for f in repo.filter(album="road")] == ["/test/1.mp3"]
+    assert repo.filter(album="abbey road", exact=True) != []
+    assert repo.filter(album="homogenic road") == []
+
+    # keys follow the tags when they change
+    music_file = session.query(MusicFileDB).filter(MusicFileDB.path == "/test/2.mp3").one()
+    music_file.artist = "Sigur Rós"
+    session.commit()
+    assert [f.path for f in repo.filter(artist="sigur ros", exact=True)] == ["/test/2.mp3"]
+
+def test_filter_matches_within_words(repo, sample_music_file):
+    for i, title in enumerate(["Night", "Light", "Sight Unseen", "Day"]):
+        repo.add_music_file(sample_music_file.model_copy(update={"path": f"/test/{i}.mp3", "title": title}))
+
+    assert [f.path for f in repo.filter(title="ight")] == ["/test/0.mp3", "/test/1.mp3", "/test/2.mp3"]
+    assert [f.path for f in repo.filter(title="GHT UNS")] == ["/test/2.mp3"]
+    assert repo.filter(title="ight", exact=True) == []
+
+def test_exact_filter_seeks_key_index(repo, session):
+    plan = session.execute(
+        text("EXPLAIN QUERY PLAN SELECT id FROM music_files WHERE artist_key = :artist AND title_key = :title"),
+        {"artist": "beatles", "title": "something"},
+    ).all()
+    assert "ix_music_files_artist_key_title_key" in plan[0][-1]
+
+def test_backfill_match_keys(engine, session):
+    session.add(MusicFileDB(path="/test/old.mp3", title="Old Song", artist="Beatles, The", album_artist="The Beatles"))
+    session.commit()
+    session.execute(text("UPDATE music_files SET title_key = NULL, artist_key = NULL, album_artist_key = NULL"))
+    session.commit()
+
+    backfill_match_keys(engine)
+    session.expire_all()
+
+    music_file = session.query(MusicFileDB).one()
+    assert (music_file.title_key, music_file.artist_key, music_file.album_key) == ("old song", "beatles", None)
+    assert music_file.album_artist_key == "beatles"
+
+def read_pages(get_page, limit):
+    paths, cursor = [], None
+    while True:
+        page = get_page(limit=limit, cursor=cursor)
+        assert len(page.results) <= limit
+        paths += [f.path for f in page.results]
+        if page.next_cursor is None:
+            return paths
+        cursor = page.next_cursor
+
+@pytest.mark.parametrize("full_text", [True, False])
+def test_search_pages_follow_on(repo, session, sample_music_file, full_text):
+    for i in range(7):
+        # titles tie on relevance in pairs, so pages also have to continue by id
+        repo.add_music_file(sample_music_file.model_copy(update={"path": f"/test/{i}.mp3", "title": "Love " * (i // 2 + 1)}))
+    if not full_text:
+        session.execute(text("DROP TABLE music_files_fts"))
+        session.commit()
+
+    everything = [f.path for f in repo.search("love", limit=50)]
+    assert len(everything) == 7
+    assert read_pages(lambda **kw: repo.search_page("love", **kw), limit=2) == everything
+    assert read_pages(lambda **kw: repo.search_page("love", **kw), limit=7) == everything
+
+def test_filter_pages_follow_on(repo, sample_music_file):
+    for i in range(5):
+        repo.add_music_file(sample_music_file.model_copy(update={"path": f"/test/{i}.mp3"}))
+
+    assert read_pages(lambda **kw: repo.filter_page(artist="test", **kw), limit=2) == [f"/test/{i}.mp3" for i in range(5)]
+
+def test_facets(repo, session, sample_music_file):
+    library_facets.clear()
+    for i, (artist, album, year, genres) in enumerate([
+        ("The Beatles", "Abbey Road", "1969", ["Rock"]),
+        ("Beatles, The", "Help!", "1965", ["Rock", "Pop"]),
+        ("Björk", "Post", "1995", ["Electronic"]),
+    ]):
+        repo.add_music_file(sample_music_file.model_copy(update={"path": f"/test/{i}.mp3", "artist": artist, "album": album, "year": year, "genres": genres}))
+
+    facets = repo.facets(top=2)
+    # spellings sharing a match key are counted together
+    assert facets["artist"] == [("Beatles, The", 2, None), ("Björk", 1, None)]
+    assert facets["genre"] == [("Rock", 2, None), ("Electronic", 1, None)]
+    assert facets["year"] == [("1965", 1, None), ("1969", 1, None)]
+
+    assert repo.facets(genre="pop") == {
+        "artist": [("Beatles, The", 1, None)],
+        "album": [("Help!", 1, "Test Artist")],
+        "genre": [("Pop", 1, None), ("Rock", 1, None)],
+        "year": [("1965", 1, None)],
+    }
+
+    # unfiltered counts are cached until the library changes
+    session.query(MusicFileDB).filter(MusicFileDB.path == "/test/2.mp3").delete()
+    session.commit()
+    assert repo.facets(top=2) == facets
+    library_facets.clear()
+    assert repo.facets(top=2)["artist"] == [("Beatles, The", 2, None)]
+    library_facets.clear()
+
+def test_album_facets_count_per_artist(repo, sample_music_file):
+    library_facets.clear()
+    for i, (artist, album_artist) in enumerate([
+        ("Weezer", None),
+        ("Weezer", None),
+        ("Rivers Cuomo", "Weezer"),
+        ("Peter Gabriel", None),
+    ]):
+        repo.add_music_file(sample_music_file.model_copy(update={"path": f"/test/{i}.mp3", "artist": artist, "album_artist": album_artist, "album": "Self Titled"}))
+
+    # the same title by two artists is two albums; the album artist keeps a guest track on its album
+    assert repo.facets()["album"] == [("Self Titled", 3, "Weezer"), ("Self Titled", 1, "Peter Gabriel")]
+    assert repo.facets(artist="peter gabriel")["album"] == [("Self Titled", 1, "Peter Gabriel")]
+    library_facets.clear()
+
+def test_find_local_files_in_constant_queries(engine, repo, sample_music_file):
+    for i in range(30):
+        repo.add_music_file(sample_music_file.model_copy(update={"path": f"/test/{i}.mp3", "title": f"Song {i}", "artist": "The Band"}))
+
+    tracks = [TrackDetails(title=f"song {i}", artist="Band, The") for i in range(29, -1, -1)]
+    tracks.insert(5, TrackDetails(title="Not Here", artist="The Band"))
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    results = repo.find_local_files(tracks)
+
+    # one lookup, the files, and their genres
+    assert len(statements) == 3
+    assert results[5] is tracks[5]
+    assert [r.path for r in results[:5] + results[6:]] == [f"/test/{i}.mp3" for i in range(29, -1, -1)]
+    assert results[0].genres == sample_music_file.genres
+
+def test_find_local_files_with_tolerance(repo, sample_music_file):
+    repo.add_music_file(sample_music_file.model_copy(update={"path": "/test/1.mp3", "title": "Paranoid Android", "artist": "Radiohead"}))
+    repo.add_music_file(sample_music_file.model_copy(update={"path": "/test/2.mp3", "title": "Karma Police", "artist": "Radiohead"}))
+
+    tracks = [
+        TrackDetails(title="Paranoid Andriod", artist="Radiohead"),
+        TrackDetails(title="Karma Police", artist="Radio Head"),
+        TrackDetails(title="Creep", artist="Radiohead"),
+        TrackDetails(title="Karma Police"),
+    ]
+    assert repo.match_local_files(tracks) == [None, None, None, None]
+
+    ids = repo.match_local_files(tracks, tolerance=2)
+    paths = [repo.get_by_id(music_file_id).path if music_file_id else None for music_file_id in ids]
+    assert paths == ["/test/1.mp3", "/test/2.mp3", None, None]
+
+def test_contains_and_annotate_local_files(repo, sample_music_file):
+    local = repo.add_music_file(sample_music_file.model_copy(update={"title": "Hyperballad", "artist": "Björk"}))
+    tracks = [
+        LastFMTrack(title="Army of Me", artist="Björk", url="https://last.fm/1"),
+        LastFMTrack(title="hyperballad", artist="Bjork", url="https://last.fm/2"),
+    ]
+
+    assert [r["exists"] for r in repo.contains(tracks)] == [False, True]
+    assert [t.music_file_id for t in repo.annotate_local_files(tracks)] == [None, local.id]
@@ -1,7 +1,9 @@
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, select, text
 from sqlalchemy.orm import sessionmaker
-from repositories.playlist import PlaylistRepository
+from repositories.playlist import ENTRY_DETAILS, PlaylistRepository
+from repositories.genre import GenreRepository
+from migrations import space_playlist_orders
 from models import *
 from response_models import *
 import datetime
@@ -153,7 +155,6 @@ def test_reorder(test_db, playlist_repo, sample_playlist, sample_music_file):
     result = playlist_repo.get_with_entries(sample_playlist.id)
     assert [e.details.title for e in result.entries] == [e.details.title for e in initial_entries]
 
-@pytest.mark.skip
 def test_playlist_pagination(playlist_repo, test_db):
     # Create a playlist with multiple entries
     playlist = PlaylistDB(name="Test Playlist")
@@ -184,3 +185,187 @@ def test_playlist_pagination(playlist_repo, test_db):
     result = playlist_repo.get_with_entries(playlist.id, limit=2, offset=2)
     assert len(result.entries) == 2
 
+
+def count_statements(test_db, run):
+    statements = []
+    engine = test_db.get_bind()
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        result = run()
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    return result, len(statements)
+
+def test_get_with_entries_statement_count(test_db, playlist_repo, sample_playlist):
+    playlist_id = sample_playlist.id
+
+    def grow(count):
+        entries = []
+        for i in range(count):
+            f = add_music_file(test_db, f"Song {i}-{count}")
+            GenreRepository(test_db).link([(f.id, ["Rock", "Pop"])])
+            entries.append(MusicFileEntry(entry_type="music_file", music_file_id=f.id))
+        entries.append(LastFMEntry(entry_type="lastfm", url=f"https://last.fm/{count}", details=LastFMTrack(title="Last", artist="FM", url=f"https://last.fm/{count}")))
+        entries.append(RequestedTrackEntry(entry_type="requested", details=TrackDetails(title=f"Wanted {count}", artist="Someone")))
+        playlist_repo.add_entries(playlist_id, entries)
+        test_db.expunge_all()
+
+    grow(3)
+    small, small_count = count_statements(test_db, lambda: playlist_repo.get_with_entries(playlist_id))
+    grow(40)
+    large, large_count = count_statements(test_db, lambda: playlist_repo.get_with_entries(playlist_id))
+
+    assert len(small.entries) == 5 and len(large.entries) == 47
+    # playlist, entries, music files, their genres, last.fm tracks, requested tracks
+    assert small_count == large_count == 6
+    assert large.entries[0].details.genres == ["Rock", "Pop"]
+    assert [e.entry_type for e in large.entries[3:5]] == ["lastfm", "requested"]
+
+def test_add_entries_statement_count(test_db, playlist_repo, sample_playlist):
+    playlist_id = sample_playlist.id
+    file_ids = [add_music_file(test_db, f"Song {i}").id for i in range(60)]
+    test_db.add(LastFMTrackDB(url="https://last.fm/known", title="Known", artist="FM"))
+    test_db.commit()
+
+    def entries(start, count):
+        batch = [MusicFileEntry(entry_type="music_file", music_file_id=i) for i in file_ids[start:start + count]]
+        batch.append(LastFMEntry(entry_type="lastfm", url="https://last.fm/known", details=LastFMTrack(title="Known", artist="FM", url="https://last.fm/known")))
+        batch.append(RequestedTrackEntry(entry_type="requested", details=TrackDetails(title="Wanted", artist="Someone")))
+        return batch
+
+    playlist_repo.add_entries(playlist_id, entries(0, 5))
+    small, large = entries(5, 5), entries(10, 50)
+    _, small_count = count_statements(test_db, lambda: playlist_repo.add_entries(playlist_id, small))
+    _, large_count = count_statements(test_db, lambda: playlist_repo.add_entries(playlist_id, large))
+
+    assert small_count == large_count
+    assert test_db.query(LastFMTrackDB).count() == 1
+    assert test_db.query(RequestedTrackDB).count() == 1
+
+    playlist = playlist_repo.get_with_entries(playlist_id)
+    assert [e.order for e in playlist.entries] == list(range(66))
+    assert playlist.entries[5].details.title == "Known"
+    assert playlist.entries[6].details.title == "Wanted"
+    assert playlist.entries[-1].details.title == "Wanted"
+
+def entry_keys(test_db, playlist_id):
+    return dict(test_db.execute(
+        select(PlaylistEntryDB.id, PlaylistEntryDB.order).where(PlaylistEntryDB.playlist_id == playlist_id)
+    ).all())
+
+def add_songs(test_db, playlist_repo, playlist_id, count):
+    entries = [MusicFileEntry(entry_type="music_file", music_file_id=add_music_file(test_db, f"Song {i}").id) for i in range(count)]
+    playlist_repo.add_entries(playlist_id, entries)
+    return [f"Song {i}" for i in range(count)]
+
+def titles(playlist_repo, playlist_id):
+    return [e.details.title for e in playlist_repo.get_with_entries(playlist_id).entries]
+
+def test_reorder_updates_only_moved_entries(test_db, playlist_repo, sample_playlist):
+    playlist_id = sample_playlist.id
+    expected = add_songs(test_db, playlist_repo, playlist_id, 50)
+    before = entry_keys(test_db, playlist_id)
+
+    playlist_repo.reorder_entries(playlist_id, [10, 20, 30], 2)
+
+    after = entry_keys(test_db, playlist_id)
+    assert sum(before[i] != after[i] for i in before) == 3
+    moved = [expected[i] for i in (10, 20, 30)]
+    expected = [t for t in expected if t not in moved]
+    expected[2:2] = moved
+    assert titles(playlist_repo, playlist_id) == expected
+
+    details = playlist_repo.get_playlist_entry_details(playlist_id, [2, 3, 49])
+    assert [(e.order, e.details.title) for e in details] == [(2, "Song 10"), (3, "Song 20"), (49, "Song 49")]
+
+def test_reorder_spaces_out_keys_when_gap_runs_out(test_db, playlist_repo, sample_playlist, caplog):
+    caplog.set_level("INFO")
+    playlist_id = sample_playlist.id
+    expected = add_songs(test_db, playlist_repo, playlist_id, 5)
+
+    # keep squeezing the last entry in after the first, halving the gap each time
+    for _ in range(15):
+        playlist_repo.reorder_entries(playlist_id, [4], 1)
+        expected.insert(1, expected.pop(4))
+        assert titles(playlist_repo, playlist_id) == expected
+
+    assert "Spacing out order keys" in caplog.text
+    keys = sorted(entry_keys(test_db, playlist_id).values())
+    assert keys[0] >= 0 and len(set(keys)) == 5
+
+    playlist_repo.undo_reorder_entries(playlist_id, [4], 1)
+    expected.insert(4, expected.pop(1))
+    assert titles(playlist_repo, playlist_id) == expected
+
+def test_space_playlist_orders(test_db, playlist_repo, sample_playlist):
+    playlist_id = sample_playlist.id
+    expected = add_songs(test_db, playlist_repo, playlist_id, 4)
+    engine = test_db.get_bind()
+    test_db.execute(text("DROP INDEX playlist_entries_playlist_order_idx"))
+    test_db.execute(text('UPDATE playlist_entries SET "order" = "order" / 1024 + 7'))
+    test_db.commit()
+
+    space_playlist_orders(engine)
+    assert sorted(entry_keys(test_db, playlist_id).values()) == [0, 1024, 2048, 3072]
+    assert titles(playlist_repo, playlist_id) == expected
+
+def test_remove_entries_in_sql(test_db, playlist_repo, sample_playlist):
+    playlist_id = sample_playlist.id
+    expected = add_songs(test_db, playlist_repo, playlist_id, 20)
+    playlist_repo.add_entries(playlist_id, [RequestedTrackEntry(entry_type="requested", details=TrackDetails(title="Wanted", artist="Someone"))])
+    before = entry_keys(test_db, playlist_id)
+
+    _, statements = count_statements(test_db, lambda: playlist_repo.remove_entries(playlist_id, [0, 5, 20]))
+
+    # positions, entries, one delete per entry type
+    assert statements == 2 + len(ENTRY_DETAILS)
+    assert titles(playlist_repo, playlist_id) == [t for i, t in enumerate(expected) if i not in (0, 5)]
+    after = entry_keys(test_db, playlist_id)
+    assert all(before[i] == after[i] for i in after)
+    assert test_db.query(MusicFileEntryDB).count() == 18
+    assert test_db.query(RequestedTrackEntryDB).count() == 0
+
+    playlist_repo.undo_add_entries(playlist_id, [None] * 3)
+    assert titles(playlist_repo, playlist_id) == [t for i, t in enumerate(expected) if i not in (0, 5)][:-3]
+    assert test_db.query(MusicFileEntryDB).count() == 15
+
+def test_replace_entries_deletes_in_batches(test_db, playlist_repo, sample_playlist, monkeypatch):
+    monkeypatch.setattr("repositories.playlist.LOOKUP_BATCH_SIZE", 4)
+    playlist_id = sample_playlist.id
+    add_songs(test_db, playlist_repo, playlist_id, 10)
+
+    bound = []
+    listener = lambda conn, cursor, statement, parameters, *args: bound.append(len(parameters)) if statement.startswith("DELETE") else None
+    event.listen(test_db.get_bind(), "before_cursor_execute", listener)
+    try:
+        with pytest.warns(DeprecationWarning):
+            playlist_repo.replace_entries(playlist_id, [])
+    finally:
+        event.remove(test_db.get_bind(), "before_cursor_execute", listener)
+
+    # the entries go in one statement, their per-type rows at most a batch of ids at a time
+    assert max(bound[1:]) == 4
+    assert len(bound) == 1 + 3 * len(ENTRY_DETAILS)
+    assert test_db.query(PlaylistEntryDB).count() == 0
+    assert test_db.query(MusicFileEntryDB).count() == 0
+
+def test_entries_keyset_pages(test_db, playlist_repo, sample_playlist):
+    playlist_id = sample_playlist.id
+    expected = add_songs(test_db, playlist_repo, playlist_id, 25)
+    playlist_repo.reorder_entries(playlist_id, [24], 0)
+    expected.insert(0, expected.pop(24))
+
+    pages, after_order = [], None
+    while True:
+        page, statements = count_statements(test_db, lambda: playlist_repo.get_entries_page(playlist_id, after_order, limit=10))
+        # entries, music files, their genres
+        assert statements == 3
+        pages.append(page)
+        after_order = page.next_after_order
+        if after_order is None:
+            break
+
+    assert [len(p.entries) for p in pages] == [10, 10, 5]
+    assert [e.details.title for p in pages for e in p.entries] == expected
+    assert pages[0].next_after_order == pages[0].entries[-1].order
@@ -0,0 +1,72 @@
+import threading
+import pytest
+from models import MusicFileDB
+from response_models import ScanResults
+from scan_jobs import ScanJobManager, ScanAlreadyRunning, scan_job_manager
+from tests.test_scanner import library
+
+
+def blocking_scan(started: threading.Event):
+    def run_scan(full, progress):
+        started.set()
+        while True:
+            progress.check_cancelled()
+            progress.files_seen += 1
+            threading.Event().wait(0.01)
+
+    return run_scan
+
+
+def test_scan_job_endpoints(client, test_db, library, monkeypatch):
+    monkeypatch.setenv("MUSIC_PATH", str(library))
+    monkeypatch.setenv("SCAN_WORKERS", "1")
+
+    response = client.post("/api/scan/jobs", params={"full": True})
+    assert response.status_code == 202
+    job_id = response.json()["id"]
+
+    scan_job_manager.get(job_id).done.wait(timeout=30)
+
+    response = client.get(f"/api/scan/jobs/{job_id}")
+    assert response.status_code == 200
+    status = response.json()
+    assert status["status"] == "completed"
+    assert status["files_seen"] == 5
+    assert status["results"]["new_files_added"] == 5
+    assert test_db.query(MusicFileDB).count() == 5
+
+    assert client.get("/api/scan/jobs").json()[0]["id"] == job_id
+    assert client.get("/api/scan/jobs/unknown").status_code == 404
+
+
+def test_only_one_scan_runs_at_a_time():
+    started = threading.Event()
+    manager = ScanJobManager(run_scan=blocking_scan(started))
+
+    job = manager.start()
+    started.wait(timeout=5)
+
+    with pytest.raises(ScanAlreadyRunning):
+        manager.start(full=True)
+
+    manager.cancel(job.id)
+    assert job.done.wait(timeout=5)
+    assert job.status == "cancelled"
+    assert job.to_status().files_seen > 0
+
+    # once the first job is finished another one can start
+    manager.run_scan = lambda full, progress: ScanResults(
+        files_scanned=0, files_indexed=0, new_files_added=0, files_updated=0, files_missing=0
+    )
+    assert manager.run().status == "completed"
+    assert [j.id for j in manager.list()][1] == job.id
+
+
+def test_failed_scan_is_reported():
+    def failing_scan(full, progress):
+        raise FileNotFoundError("Music directory /nowhere does not exist")
+
+    job = ScanJobManager(run_scan=failing_scan).run()
+
+    assert job.status == "failed"
+    assert "does not exist" in job.error
@@ -0,0 +1,257 @@
+import os
+import shutil
+import pytest
+from contextlib import contextmanager
+from mutagen.easyid3 import EasyID3
+from sqlalchemy import event
+import scanner
+from models import MusicFileDB, ScanCheckpointDB
+from scanner import scan_directory, prune_music_files, walk_music_files
+from repositories.search_term import SearchTermRepository
+
+
+def write_mp3(path, title, artist="Test Artist", album="Test Album", genre="Rock"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+
+    tags = EasyID3()
+    tags["title"] = title
+    tags["artist"] = artist
+    tags["album"] = album
+    tags["genre"] = genre
+    tags.save(str(path))
+
+    return path
+
+
+@contextmanager
+def count_queries(session):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture
+def library(tmp_path):
+    for i in range(5):
+        write_mp3(tmp_path / "Test Artist" / "Test Album" / f"{i:02d}.mp3", f"Test Song {i}")
+
+    (tmp_path / "cover.jpg").write_bytes(b"not music")
+
+    return tmp_path
+
+
+def test_walk_music_files(library):
+    (library / "Test Artist" / "Test Album" / "notes.txt").write_text("liner notes")
+    (library / "UPPER.MP3").write_bytes(b"")
+
+    entries = list(walk_music_files(str(library)))
+
+    assert sorted(e.path for e in entries) == sorted(
+        [str(library / "UPPER.MP3")]
+        + [str(library / "Test Artist" / "Test Album" / f"{i:02d}.mp3") for i in range(5)]
+    )
+    assert all(e.mtime > 0 and e.size >= 0 for e in entries)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_scan_directory(test_db, library, workers):
+    results = scan_directory(str(library), full=True, workers=workers)
+
+    assert results["files_scanned"] == 5
+    assert results["new_files_added"] == 5
+    assert results["workers"] == workers
+
+    titles = sorted(f.title for f in test_db.query(MusicFileDB).all())
+    assert titles == [f"Test Song {i}" for i in range(5)]
+
+    # the fuzzy search vocabulary is filled as files are written
+    assert SearchTermRepository(test_db).similar("albun") == ["album"]
+
+    # as are the match keys
+    keys = test_db.query(MusicFileDB.artist_key, MusicFileDB.album_key, MusicFileDB.title_key).distinct().all()
+    assert sorted(keys)[0] == ("test artist", "test album", "test song 0")
+
+
+def test_incremental_scan_skips_unchanged(test_db, library):
+    scan_directory(str(library), workers=1)
+    results = scan_directory(str(library), workers=1)
+
+    assert results["files_scanned"] == 5
+    assert results["files_indexed"] == 0
+    assert results["new_files_added"] == 0
+
+
+def test_incremental_scan_skips_unchanged_directories(test_db, library):
+    scan_directory(str(library), workers=1)
+
+    results = scan_directory(str(library), workers=1)
+    assert results["directories_skipped"] == 3
+
+    write_mp3(library / "Test Artist" / "Test Album" / "05.mp3", "Test Song 5")
+    results = scan_directory(str(library), workers=1)
+
+    assert results["directories_skipped"] == 2
+    assert results["new_files_added"] == 1
+    assert results["files_scanned"] == 6
+
+
+def test_full_scan_ignores_directory_state(test_db, library):
+    scan_directory(str(library), workers=1)
+    results = scan_directory(str(library), full=True, workers=1)
+
+    assert results["directories_skipped"] == 0
+    assert results["files_indexed"] == 5
+
+
+def test_incremental_scan_query_count(test_db, library):
+    for i in range(5, 50):
+        write_mp3(library / "Test Artist" / "Other Album" / f"{i:02d}.mp3", f"Test Song {i}")
+
+    scan_directory(str(library), workers=1)
+
+    with count_queries(test_db) as statements:
+        scan_directory(str(library), workers=1)
+
+    # the file index, the directory records and the checkpoint
+    assert len(statements) <= 5
+
+
+def test_interrupted_full_scan_resumes(test_db, library, monkeypatch):
+    for i in range(5):
+        write_mp3(library / "Other Artist" / "Other Album" / f"{i:02d}.mp3", f"Other Song {i}", artist="Other Artist")
+
+    monkeypatch.setattr(scanner, "SCAN_BATCH_SIZE", 3)
+    read_file = scanner.read_file
+    calls = []
+
+    def failing_read_file(path):
+        calls.append(path)
+        if len(calls) > 6:
+            raise OSError("disk went away")
+        return read_file(path)
+
+    monkeypatch.setattr(scanner, "read_file", failing_read_file)
+    with pytest.raises(OSError):
+        scan_directory(str(library), full=True, workers=1)
+
+    # the first two chunks were committed
+    assert test_db.query(MusicFileDB).count() == 6
+    generation, last_directory, completed = test_db.query(
+        ScanCheckpointDB.generation, ScanCheckpointDB.last_directory, ScanCheckpointDB.completed
+    ).one()
+    assert not completed
+    assert last_directory == "Test Artist"
+
+    calls.clear()
+    monkeypatch.setattr(scanner, "read_file", lambda path: calls.append(path) or read_file(path))
+    results = scan_directory(str(library), full=True, workers=1)
+    test_db.expire_all()
+
+    assert results["resumed"]
+    assert results["scan_generation"] == generation
+    assert results["files_scanned"] == 10
+    assert all("Test Album" in path for path in calls)
+    assert test_db.query(MusicFileDB).count() == 10
+    assert test_db.query(ScanCheckpointDB).one().completed
+
+    # the next full scan starts over
+    results = scan_directory(str(library), full=True, workers=1)
+    assert not results["resumed"]
+    assert results["scan_generation"] == generation + 1
+
+
+def test_rescan_updates_in_place(test_db, library):
+    scan_directory(str(library), workers=1)
+    ids = {f.path: f.id for f in test_db.query(MusicFileDB).all()}
+
+    results = scan_directory(str(library), full=True, workers=1)
+    test_db.expire_all()
+
+    assert results["files_updated"] == 5
+    assert {f.path: f.id for f in test_db.query(MusicFileDB).all()} == ids
+    assert all(f.genres[0].name == "Rock" for f in test_db.query(MusicFileDB).all())
+
+
+def test_prune_marks_missing(test_db, library):
+    scan_directory(str(library), workers=1)
+    (library / "Test Artist" / "Test Album" / "00.mp3").unlink()
+
+    results = prune_music_files()
+
+    assert results["files_missing"] == 1
+    missing = test_db.query(MusicFileDB).filter(MusicFileDB.missing == True).all()
+    assert [f.title for f in missing] == ["Test Song 0"]
+
+
+def test_prune_with_seen_paths(test_db, library):
+    scan_directory(str(library), workers=1)
+    album = library / "Test Artist" / "Test Album"
+    (album / "00.mp3").rename(library / "00.mp3.bak")
+
+    seen_paths = set()
+    scan_directory(str(library), workers=1, seen_paths=seen_paths)
+    results = prune_music_files(seen_paths)
+
+    assert len(seen_paths) == 4
+    assert results["files_missing"] == 1
+    assert results["files_found"] == 0
+
+    (library / "00.mp3.bak").rename(album / "00.mp3")
+    results = prune_music_files({str(album / f"{i:02d}.mp3") for i in range(5)})
+    test_db.expire_all()
+
+    assert results["files_missing"] == 0
+    assert results["files_found"] == 1
+    assert test_db.query(MusicFileDB).filter(MusicFileDB.missing == True).count() == 0
+
+
+def test_prune_skips_directories_that_failed_to_list(test_db, library, monkeypatch):
+    scan_directory(str(library), workers=1)
+    album = library / "Test Artist" / "Test Album"
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if str(path) == str(album):
+            raise PermissionError(13, "Permission denied", str(path))
+        return scandir(path)
+
+    monkeypatch.setattr(scanner.os, "scandir", failing_scandir)
+    results = scanner.run_library_scan(str(library))
+
+    assert results["files_missing"] == 0
+    assert test_db.query(MusicFileDB).filter(MusicFileDB.missing == True).count() == 0
+
+
+def test_moved_files_keep_their_ids(test_db, library):
+    scan_directory(str(library), workers=1)
+    album = library / "Test Artist" / "Test Album"
+    ids = {f.title: f.id for f in test_db.query(MusicFileDB).all()}
+
+    # a rename keeps the inode; a copy to a new file keeps only size, mtime and content
+    (library / "Reorganised").mkdir()
+    os.rename(album / "00.mp3", library / "Reorganised" / "00.mp3")
+    shutil.copy2(album / "01.mp3", library / "Reorganised" / "01.mp3")
+    (album / "01.mp3").unlink()
+
+    seen_paths = set()
+    results = scan_directory(str(library), workers=1, seen_paths=seen_paths)
+    prune_results = prune_music_files(seen_paths)
+    test_db.expire_all()
+
+    assert results["files_moved"] == 2
+    assert results["new_files_added"] == 0
+    assert prune_results["files_missing"] == 0
+    assert test_db.query(MusicFileDB).count() == 5
+
+    moved = {f.title: f for f in test_db.query(MusicFileDB).filter(MusicFileDB.id.in_([ids["Test Song 0"], ids["Test Song 1"]]))}
+    assert moved["Test Song 0"].path == str(library / "Reorganised" / "00.mp3")
+    assert moved["Test Song 1"].path == str(library / "Reorganised" / "01.mp3")
@@ -0,0 +1,197 @@
+import struct
+import wave
+import pytest
+from mutagen.easyid3 import EasyID3
+from mutagen.flac import FLAC, Picture
+from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB, TYER, TCON
+from mutagen.ogg import OggPage
+from mutagen.oggvorbis import OggVorbis
+from benchmarks.scan_benchmark import MP3_FRAME, write_silent_flac, write_silent_mp3
+from scanner import extract_metadata, read_metadata
+from tag_reader import TagFile, TagReadError, read_tag_file, read_tags
+
+TAGS = {"title": "Café Song", "artist": "Björk", "album": "Debut", "albumartist": "Björk", "date": "1993", "genre": ["Pop", "Electronic"]}
+COVER = b"\x89PNG" + bytes(1024 * 1024)
+
+
+def read_counting(path):
+    with open(path, "rb") as fileobj:
+        f = TagFile(fileobj, path.stat().st_size)
+        return read_tag_file(f, path.suffix), f.bytes_read
+
+
+def vorbis_comment(tags: dict) -> bytes:
+    comments = [f"{key.upper()}={value}".encode() for key, values in tags.items() for value in ([values] if isinstance(values, str) else values)]
+    data = struct.pack("<I", 4) + b"test" + struct.pack("<I", len(comments))
+    return data + b"".join(struct.pack("<I", len(comment)) + comment for comment in comments)
+
+
+def write_ogg(path, identification: bytes, comment: bytes, granule: int):
+    pages = []
+    for sequence, packets in enumerate([[identification], [comment], [bytes(100)]]):
+        page = OggPage()
+        page.serial = 1234
+        page.sequence = sequence
+        page.packets = packets
+        page.first = sequence == 0
+        page.last = sequence == 2
+        page.position = granule if sequence == 2 else 0
+        pages.append(page.write())
+    path.write_bytes(b"".join(pages))
+
+
+def atom(name: bytes, *children: bytes) -> bytes:
+    body = b"".join(children)
+    return struct.pack(">I4s", len(body) + 8, name) + body
+
+
+def mp4_text(name: bytes, value: str) -> bytes:
+    return atom(name, atom(b"data", struct.pack(">II", 1, 0) + value.encode()))
+
+
+def test_mp3_matches_easyid3(tmp_path):
+    path = tmp_path / "song.mp3"
+    write_silent_mp3(path, TAGS)
+
+    metadata = read_tags(str(path))
+    expected = extract_metadata(str(path), EasyID3)
+
+    for field in ("title", "artist", "album", "album_artist", "year", "genres"):
+        assert metadata[field] == expected[field]
+    assert metadata["kind"] == "audio/mp3"
+    assert metadata["length"] == 0
+
+
+def test_mp3_skips_pictures_and_audio(tmp_path):
+    path = tmp_path / "song.mp3"
+    path.write_bytes(MP3_FRAME * 2500)
+    tags = ID3()
+    tags.add(APIC(encoding=3, mime="image/png", type=3, desc="cover", data=COVER))
+    tags.add(TIT2(encoding=1, text=["Title"]))
+    tags.add(TPE1(encoding=1, text=["Artist"]))
+    tags.add(TALB(encoding=0, text=["Album"]))
+    tags.add(TYER(encoding=0, text=["2001"]))
+    tags.add(TCON(encoding=0, text=["(17)"]))
+    tags.save(path, v2_version=3)
+
+    metadata, bytes_read = read_counting(path)
+
+    assert metadata["title"] == "Title"
+    assert metadata["artist"] == "Artist"
+    assert metadata["year"] == "2001"
+    assert metadata["genres"] == ["Rock"]
+    # 2500 frames of 128 kbps audio
+    assert metadata["length"] == 65
+    assert bytes_read < 64 * 1024
+
+
+def test_mp3_with_only_id3v1(tmp_path):
+    path = tmp_path / "old.mp3"
+    id3v1 = b"TAG" + b"Old Song".ljust(30, b"\x00") + b"Old Artist".ljust(30, b"\x00")
+    id3v1 += b"Old Album".ljust(30, b"\x00") + b"1999" + bytes(30) + bytes([9])
+    path.write_bytes(MP3_FRAME * 10 + id3v1)
+
+    metadata = read_tags(str(path))
+
+    assert metadata["title"] == "Old Song"
+    assert metadata["album"] == "Old Album"
+    assert metadata["year"] == "1999"
+    assert metadata["genres"] == ["Metal"]
+
+
+def test_flac_matches_mutagen(tmp_path):
+    path = tmp_path / "song.flac"
+    write_silent_flac(path, TAGS)
+    audio = FLAC(path)
+    picture = Picture()
+    picture.data = COVER
+    audio.add_picture(picture)
+    audio.save()
+
+    metadata, bytes_read = read_counting(path)
+    expected = extract_metadata(str(path), FLAC)
+
+    assert metadata == expected
+    assert bytes_read < 4096
+
+
+def test_ogg_vorbis(tmp_path):
+    path = tmp_path / "song.ogg"
+    identification = b"\x01vorbis" + struct.pack("<IBIiiiBB", 0, 2, 44100, 0, 128000, 0, 0xB8, 1)
+    write_ogg(path, identification, b"\x03vorbis" + vorbis_comment(TAGS) + b"\x01", granule=44100 * 200)
+
+    metadata = read_tags(str(path))
+
+    assert metadata["title"] == "Café Song"
+    assert metadata["album_artist"] == "Björk"
+    assert metadata["genres"] == ["Pop", "Electronic"]
+    assert metadata["length"] == 200
+    assert metadata["title"] == OggVorbis(path)["title"][0]
+
+
+def test_ogg_opus(tmp_path):
+    path = tmp_path / "song.opus.ogg"
+    identification = b"OpusHead" + struct.pack("<BBHIhB", 1, 2, 312, 48000, 0, 0)
+    write_ogg(path, identification, b"OpusTags" + vorbis_comment({"title": "Opus Song"}), granule=48000 * 90 + 312)
+
+    metadata = read_tags(str(path))
+
+    assert metadata["title"] == "Opus Song"
+    assert metadata["length"] == 90
+
+
+def test_mp4(tmp_path):
+    path = tmp_path / "song.m4a"
+    ilst = atom(
+        b"ilst",
+        mp4_text(b"\xa9nam", "MP4 Song"),
+        mp4_text(b"\xa9ART", "MP4 Artist"),
+        mp4_text(b"\xa9day", "2010"),
+        atom(b"gnre", atom(b"data", struct.pack(">II", 0, 0) + struct.pack(">H", 18))),
+        atom(b"covr", atom(b"data", struct.pack(">II", 14, 0) + COVER)),
+    )
+    meta = atom(b"meta", bytes(4), atom(b"hdlr", bytes(25)), ilst)
+    mvhd = atom(b"mvhd", struct.pack(">IIIII", 0, 0, 0, 1000, 245000) + bytes(80))
+    path.write_bytes(atom(b"ftyp", b"M4A " + bytes(4)) + atom(b"mdat", bytes(512 * 1024)) + atom(b"moov", mvhd, atom(b"udta", meta)))
+
+    metadata, bytes_read = read_counting(path)
+
+    assert metadata["title"] == "MP4 Song"
+    assert metadata["artist"] == "MP4 Artist"
+    assert metadata["year"] == "2010"
+    assert metadata["genres"] == ["Rock"]
+    assert metadata["length"] == 245
+    assert metadata["kind"] == "audio/mp4"
+    assert bytes_read < 4096
+
+
+def test_wav_info_chunk(tmp_path):
+    path = tmp_path / "song.wav"
+    with wave.open(str(path), "wb") as audio:
+        audio.setnchannels(2)
+        audio.setsampwidth(2)
+        audio.setframerate(44100)
+        audio.writeframes(bytes(44100 * 4 * 3))
+
+    info = b"INFO"
+    for chunk_id, value in ((b"INAM", b"Wave Song\x00"), (b"IART", b"Wave Artist\x00")):
+        info += struct.pack("<4sI", chunk_id, len(value)) + value + b"\x00" * (len(value) & 1)
+    data = path.read_bytes() + struct.pack("<4sI", b"LIST", len(info)) + info
+    path.write_bytes(data[:4] + struct.pack("<I", len(data) - 8) + data[8:])
+
+    metadata = read_tags(str(path))
+
+    assert metadata["title"] == "Wave Song"
+    assert metadata["artist"] == "Wave Artist"
+    assert metadata["length"] == 3
+    assert metadata["kind"] == "audio/wav"
+
+
+def test_read_metadata_falls_back_to_mutagen(tmp_path):
+    path = tmp_path / "broken.flac"
+    path.write_bytes(b"fLaC" + bytes([0x7F]) + bytes(3))
+
+    with pytest.raises(TagReadError):
+        read_tags(str(path))
+    assert read_metadata(str(path)) == {}
+    assert read_metadata(str(tmp_path / "missing.mp3")) == {}
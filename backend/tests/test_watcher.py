@@ -0,0 +1,88 @@
+import os
+import threading
+import pytest
+import scanner
+from watchdog.events import FileCreatedEvent, FileDeletedEvent, FileMovedEvent, DirMovedEvent, FileModifiedEvent
+from models import MusicFileDB
+from scanner import apply_file_changes, scan_directory
+from watcher import LibraryEventHandler, LibraryWatcher
+from tests.test_scanner import write_mp3, library
+
+
+def test_events_are_coalesced():
+    handler = LibraryEventHandler()
+
+    handler.dispatch(FileCreatedEvent("/music/a.mp3"))
+    handler.dispatch(FileModifiedEvent("/music/a.mp3"))
+    handler.dispatch(FileMovedEvent("/music/a.mp3", "/music/b.mp3"))
+    handler.dispatch(FileMovedEvent("/music/c.mp3", "/music/d.mp3"))
+    handler.dispatch(FileMovedEvent("/music/d.mp3", "/music/e.mp3"))
+    handler.dispatch(FileDeletedEvent("/music/f.flac"))
+    handler.dispatch(FileCreatedEvent("/music/cover.jpg"))
+
+    changes = handler.drain()
+
+    assert changes["changed"] == {"/music/b.mp3"}
+    assert changes["moved"] == {"/music/c.mp3": "/music/e.mp3"}
+    assert changes["removed"] == {"/music/f.flac"}
+    assert handler.drain() is None
+
+
+def test_watcher_flush_applies_changes(test_db, library):
+    scan_directory(str(library), workers=1)
+    album = library / "Test Artist" / "Test Album"
+    original_id = test_db.query(MusicFileDB).filter(MusicFileDB.title == "Test Song 0").one().id
+
+    # move one file, delete another and add a new one
+    os.rename(album / "00.mp3", album / "moved.mp3")
+    (album / "01.mp3").unlink()
+    write_mp3(album / "05.mp3", "Test Song 5")
+
+    watcher = LibraryWatcher(str(library), debounce=0)
+    watcher.handler.dispatch(FileMovedEvent(str(album / "00.mp3"), str(album / "moved.mp3")))
+    watcher.handler.dispatch(FileDeletedEvent(str(album / "01.mp3")))
+    watcher.handler.dispatch(FileCreatedEvent(str(album / "05.mp3")))
+    assert watcher.is_due()
+    results = watcher.flush()
+
+    assert results["files_moved"] == 1
+    assert results["files_missing"] == 1
+    assert results["new_files_added"] == 1
+
+    os.rename(library / "Test Artist", library / "Renamed Artist")
+    watcher.handler.dispatch(DirMovedEvent(str(library / "Test Artist"), str(library / "Renamed Artist")))
+    results = watcher.flush()
+    test_db.expire_all()
+
+    # includes the row for the deleted file, which stays missing under its new path
+    assert results["files_moved"] == 6
+    moved = test_db.query(MusicFileDB).filter(MusicFileDB.id == original_id).one()
+    assert moved.path == str(library / "Renamed Artist" / "Test Album" / "moved.mp3")
+    assert not moved.missing
+
+
+def test_watcher_holds_changes_while_a_scan_runs(test_db, library):
+    lock = threading.Lock()
+    applied = []
+    watcher = LibraryWatcher(str(library), debounce=0, apply=lambda **changes: applied.append(changes), library_lock=lock)
+    watcher.handler.dispatch(FileCreatedEvent(str(library / "new.mp3")))
+
+    with lock:
+        assert watcher.flush() is None
+    assert not applied and watcher.handler.pending() == 1
+
+    watcher.flush()
+    assert applied[0]["changed"] == {str(library / "new.mp3")}
+
+
+def test_failed_batch_rolls_back(test_db, library, monkeypatch):
+    scan_directory(str(library), workers=1)
+    album = library / "Test Artist" / "Test Album"
+    monkeypatch.setattr(scanner, "read_file", lambda path: (_ for _ in ()).throw(OSError("unreadable")))
+    write_mp3(album / "05.mp3", "Test Song 5")
+
+    with pytest.raises(OSError):
+        apply_file_changes(changed=[str(album / "05.mp3")], removed=[str(album / "00.mp3")])
+
+    test_db.expire_all()
+    assert test_db.query(MusicFileDB).filter(MusicFileDB.missing == True).count() == 0
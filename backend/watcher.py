@@ -0,0 +1,217 @@
+import os
+import time
+import logging
+import threading
+from typing import Callable, Optional
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+from scanner import SUPPORTED_FILETYPES, apply_file_changes
+from scan_jobs import scan_job_manager
+
+import dotenv
+dotenv.load_dotenv(override=True)
+
+logger = logging.getLogger(__name__)
+
+# shortest wait between checks for due changes, so a zero debounce does not spin
+MIN_CHECK_INTERVAL = 0.1
+
+
+def is_music_file(path: str) -> bool:
+    return path.lower().endswith(SUPPORTED_FILETYPES)
+
+
+class LibraryEventHandler(FileSystemEventHandler):
+    """Coalesces filesystem events until they are drained as one batch of changes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_event = None
+        self._reset()
+
+    def _reset(self):
+        self.first_event = None
+        self.changed = set()
+        self.removed = set()
+        self.moved = {}
+        self.removed_directories = set()
+        self.moved_directories = {}
+
+    def _touch(self):
+        now = time.monotonic()
+        self.last_event = now
+        if self.first_event is None:
+            self.first_event = now
+
+    def pending(self) -> int:
+        return (
+            len(self.changed) + len(self.removed) + len(self.moved)
+            + len(self.removed_directories) + len(self.moved_directories)
+        )
+
+    def on_created(self, event):
+        self.on_modified(event)
+
+    def on_modified(self, event):
+        if event.is_directory or not is_music_file(event.src_path):
+            return
+
+        with self.lock:
+            self.removed.discard(event.src_path)
+            self.changed.add(event.src_path)
+            self._touch()
+
+    def on_closed(self, event):
+        self.on_modified(event)
+
+    def on_deleted(self, event):
+        with self.lock:
+            if event.is_directory:
+                self.removed_directories.add(event.src_path)
+            elif is_music_file(event.src_path):
+                self.changed.discard(event.src_path)
+
+                # a file that was moved and then deleted is a delete of the original path
+                origin = next((old for old, new in self.moved.items() if new == event.src_path), None)
+                if origin is not None:
+                    del self.moved[origin]
+                    self.removed.add(origin)
+                else:
+                    self.removed.add(event.src_path)
+            else:
+                return
+
+            self._touch()
+
+    def on_moved(self, event):
+        with self.lock:
+            if event.is_directory:
+                self.moved_directories[event.src_path] = event.dest_path
+            elif is_music_file(event.src_path) and is_music_file(event.dest_path):
+                self.removed.discard(event.dest_path)
+
+                if event.src_path in self.changed:
+                    # not indexed yet, so just index it under the new name
+                    self.changed.discard(event.src_path)
+                    self.changed.add(event.dest_path)
+                else:
+                    origin = next((old for old, new in self.moved.items() if new == event.src_path), event.src_path)
+                    self.moved[origin] = event.dest_path
+            elif is_music_file(event.dest_path):
+                self.changed.add(event.dest_path)
+            elif is_music_file(event.src_path):
+                self.removed.add(event.src_path)
+            else:
+                return
+
+            self._touch()
+
+    def drain(self) -> Optional[dict]:
+        with self.lock:
+            if not self.pending():
+                return None
+
+            changes = {
+                "changed": self.changed,
+                "removed": self.removed,
+                "moved": self.moved,
+                "removed_directories": self.removed_directories,
+                "moved_directories": self.moved_directories,
+            }
+            self._reset()
+
+            return changes
+
+
+class LibraryWatcher:
+    """Watches the music library and applies debounced changes to the index in the background."""
+
+    def __init__(
+        self,
+        path: str,
+        polling=False,
+        debounce: float = 2.0,
+        max_delay: float = 30.0,
+        poll_interval: float = 60.0,
+        apply: Callable = apply_file_changes,
+        library_lock: Optional[threading.Lock] = None,
+    ):
+        self.path = path
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.apply = apply
+        # batches wait for a running scan, which would otherwise index the same files twice
+        self.library_lock = library_lock or scan_job_manager.library_lock
+        self.handler = LibraryEventHandler()
+        # each poll snapshots the whole tree, so it runs far less often than the debounce
+        self.observer = PollingObserver(timeout=poll_interval) if polling else Observer()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="library-watcher", daemon=True)
+
+    def start(self):
+        logger.info(f"Watching {self.path} for library changes ({type(self.observer).__name__})")
+        self.observer.schedule(self.handler, self.path, recursive=True)
+        self.observer.start()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.observer.stop()
+        self.observer.join()
+        self._thread.join()
+
+    def is_due(self) -> bool:
+        """True once events have been quiet for the debounce period, or have waited too long."""
+        with self.handler.lock:
+            if self.handler.last_event is None or not self.handler.pending():
+                return False
+
+            now = time.monotonic()
+            return (
+                now - self.handler.last_event >= self.debounce
+                or now - self.handler.first_event >= self.max_delay
+            )
+
+    def flush(self):
+        """Apply the pending changes, unless a scan is running; they are kept for later then."""
+        if not self.library_lock.acquire(blocking=False):
+            return None
+
+        try:
+            changes = self.handler.drain()
+            if changes is None:
+                return None
+
+            results = self.apply(**changes)
+            logger.info(f"Applied library changes: {results}")
+            return results
+        except Exception as e:
+            logger.error(f"Failed to apply library changes: {e}", exc_info=True)
+        finally:
+            self.library_lock.release()
+
+    def _run(self):
+        while not self._stop.wait(max(min(self.debounce, 1.0), MIN_CHECK_INTERVAL)):
+            if self.is_due():
+                self.flush()
+
+        self.flush()
+
+
+def create_library_watcher() -> Optional[LibraryWatcher]:
+    """Build the watcher from the environment; watching is opt-in via LIBRARY_WATCH."""
+    if os.getenv("LIBRARY_WATCH", "false").lower() not in ("1", "true", "yes"):
+        return None
+
+    music_path = os.getenv("MUSIC_PATH", "/music")
+    if not os.path.isdir(music_path):
+        logger.warning(f"Not watching music path {music_path}: directory does not exist")
+        return None
+
+    return LibraryWatcher(
+        music_path,
+        polling=os.getenv("LIBRARY_WATCH_POLLING", "false").lower() in ("1", "true", "yes"),
+        debounce=float(os.getenv("LIBRARY_WATCH_DEBOUNCE", "2.0")),
+        poll_interval=float(os.getenv("LIBRARY_WATCH_POLL_INTERVAL", "60")),
+    )